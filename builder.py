@@ -1,16 +1,54 @@
-import requests, sys, json, numpy
+import sys, os, json, time, threading, hashlib, math, sqlite3, multiprocessing, traceback
 import xml.etree.ElementTree as ET
-import networkx as nx
 from itertools import groupby
-from functools import reduce
-from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from common import *
 
-
 # Constants
 walking_distance = 0.05 # 50m
 
+# National demographics, the sectors of every city are extracted from it
+national_demographics_path = "us_demographics.csv"
+demographics_buffer = 1 # km around the stops, can be changed with --buffer=KM
+
+# Network building, can be changed with --incremental, --checkpoints=STAGE,... and --restart
+incremental_build = False
+checkpoint_stages = ['static', 'road_distances', 'times']
+resume_from_checkpoint = True
+
+# HTTP fetching limits, can be changed with --workers=N and --rate=N
+max_concurrent_requests = 8
+requests_per_second = 10
+request_timeout = 60 # seconds
+request_retries = 3
+max_total_requests = 16 # of all processes together, with many cities (--total-workers=N)
+retry_delay = 1 # seconds, doubled after every failed attempt
+
+# OSRM road distance API, can be changed with --osrm=URL (e.g. to a local OSRM server)
+distance_api_base = "http://router.project-osrm.org/route/v1/driving/"
+max_waypoints_per_request = 100
+
+# NextBus server of the transit APIs, can be changed with --nextbus=URL (e.g. to a local stand-in), None for the one in cities
+transit_api_server = None
+
+# Shared HTTP state
+global_request_semaphore = None
+http_session = None
+session_lock = threading.Lock()
+rate_limit_lock = threading.Lock()
+next_request_time = 0
+
+# Response cache, kept in the agency folder of the city (see configure_cache)
+cache_directory = None
+offline_mode = False
+
+# How long cached responses of every API command stay valid, in seconds (None never expires)
+cache_ttls = {
+	'route_list': 12*3600,
+	'route_data': 12*3600,
+	'predictions': 0,
+	'distances': None}
 
 
 def main():
@@ -19,94 +57,464 @@ def main():
 	Args:
 		static - build the static network of stops and connections between them
 		distances - calculate the straight-line and road distances between stops
+		times - calculate the wait and travel times from a snapshot of the time predictions
+		sample - keep sampling the time predictions of all routes on a schedule
+		consolidate - calculate the wait and travel times from all the stored samples
+		clean - remove invalid routes and cleanup data
+		all - run every step of the network building in a row
+		arrays - save the network files as memory-mappable NumPy arrays
+		demographics - extract the sectors around the network from the national demographics
+
+		city - the city for which we want to get results, or many comma-separated cities to build at once
+
+		--workers=N - the number of API requests that are made at once
+		--total-workers=N - the number of API requests that are made at once by all cities together
+		--rate=N - the maximum number of API requests per second
+		--osrm=URL - the base url of the OSRM route service to use for road distances
+		--nextbus=URL - the server to send the NextBus API requests of every agency to, instead of webservices.nextbus.com
+		--offline - only use the cached API responses, without making any requests
+		--no-cache - neither use nor store cached API responses
+		--incremental - only extract again the routes that changed since the last static build
+		--checkpoints=STAGE,... - the stages after which "all" saves the network, or "none" (static,road_distances,times)
+		--restart - run "all" from the start, even if a previous run left a checkpoint
+		--interval=S - the number of seconds between prediction samples (sample)
+		--duration=S - the number of seconds to keep sampling for, forever if not given (sample)
+		--days=N - only use the samples of the last N days (consolidate)
+		--buffer=KM - the distance around the bounding box of the stops to extract sectors from (demographics)
+		--radius=KM - only extract the sectors within this distance of a stop (demographics)
+
+	"""
+
+	# Separate the --name=value options from the arguments
+	arguments, options = parse_arguments(sys.argv)
+	configure_pipeline(options)
+	configure_fetching(options)
+
+	# With the "help" argument, list the supported cities
+	if len(arguments) > 1 and arguments[1] == "help":
+
+		print("Supported cities:")
+		for city in cities:
+			print("\t- " + city)
+
+	# With a command and one city, run it right here
+	elif len(arguments) > 2 and arguments[1] in commands and arguments[2] in cities:
+
+		configure_cache(arguments[2], options)
+		run_command(commands[arguments[1]], arguments[2], options)
+
+	# With a command and many cities, run it for every city in its own process
+	elif len(arguments) > 2 and arguments[1] in commands and all([city in cities for city in arguments[2].split(",")]):
+
+		run_cities_command(commands[arguments[1]], arguments[2].split(","), options)
+
+	# With wrong arguments, print usage help message
+	else:
+		print("Usage: builder <static|distances|times|sample|consolidate|clean|all|arrays|demographics> <city>[,<city_2>,...] [--workers=N] [--total-workers=N] [--rate=N] [--osrm=URL] [--nextbus=URL] [--offline|--no-cache] [--incremental] [--checkpoints=STAGE,...] [--restart]")
+
+
+def run_command(command, city, options):
+	"""Run one of the builder commands for a city.
+
+	Returns:
+		The network that was built, or None if the command doesn't build one.
 
-		city - the city for which we want to get results
-		
 	"""
 
 	# With the "static" argument, build the static network
-	if len(sys.argv) > 2 and (sys.argv[1] == "static" or sys.argv[1] == "-s" ):
+	if command == "static":
 
-		build_static_network(sys.argv[2])
+		return run_pipeline(city, ['static'])
 
 	# With the "distances" argument, calculate the distances between stops
-	elif len(sys.argv) > 2 and (sys.argv[1] == "distances" or sys.argv[1] == "-d" ):
+	elif command == "distances":
 
-		calculate_distances(sys.argv[2])
-		calculate_road_distances(sys.argv[2])
+		return run_pipeline(city, ['distances', 'road_distances'])
 
 	# With the "times" argument, calculate the times between stops
-	elif len(sys.argv) > 2 and (sys.argv[1] == "times" or sys.argv[1] == "-t" ):
+	elif command == "times":
 		
-		calculate_times(sys.argv[2])
+		return run_pipeline(city, ['times'])
 		
+	# With the "sample" argument, keep sampling the time predictions
+	elif command == "sample":
+
+		sample_predictions(city, float(options.get('interval', 300)),
+			float(options['duration']) if 'duration' in options else None)
+
+	# With the "consolidate" argument, calculate the times from the stored samples
+	elif command == "consolidate":
+
+		consolidate_samples(city, int(options['days']) if 'days' in options else None)
+
 	# With the "cleanup" argument, remove invalid routes and cleanup data
-	elif len(sys.argv) > 2 and (sys.argv[1] == "clean" or sys.argv[1] == "-c" ):
+	elif command == "clean":
 		
-		cleanup(sys.argv[2])
+		return run_pipeline(city, ['clean'])
 		
-	# With the "all" argument, calculate everything in a row
-	elif len(sys.argv) > 2 and (sys.argv[1] == "all" or sys.argv[1] == "-a" ):
+	# With the "all" argument, calculate everything in a row, resuming from the last checkpoint
+	elif command == "all":
 		
-		build_static_network(sys.argv[2])
+		return run_pipeline(city, list(pipeline_stages), checkpoint_stages)
 
-		calculate_distances(sys.argv[2])
-		calculate_road_distances(sys.argv[2])
+	# With the "demographics" argument, extract the sectors of the city from the national demographics
+	elif command == "demographics":
 
-		calculate_times(sys.argv[2])
-		
-		cleanup(sys.argv[2])
-		
-	# With the "help" argument, calculate the distances between stops
-	elif len(sys.argv) > 1 and sys.argv[1] == "help":
+		extract_demographics(city, read_network(city), float(options.get('buffer', demographics_buffer)),
+			float(options['radius']) if 'radius' in options else None)
 
-		print("Supported cities:")
-		for city in cities:
-			print("\t- " + city)
+	# With the "arrays" argument, save the network files as arrays
+	elif command == "arrays":
 
-	# With wrong arguments, print usage help message
-	else:
-		print("Usage: builder <static|distances> <city>")
+		network = read_network(city)
+		write_network_arrays(cities[city]['tag'], network['routes'], network['stops'], network['connections'])
+		return network
+
+	return None
+
+
+# ===============================================
+# =				Multi-city Builds 				=
+# ===============================================
+
+def run_cities_command(command, cities_list, options):
+	"""Run a builder command for many cities at once, every city in its own process.
+
+	The output of every city goes to the build.log file in its agency folder, all processes
+	share one limit on the number of API requests made at once (--total-workers=N), and a
+	summary of all the cities is printed at the end.
+
+	"""
+
+	request_semaphore = multiprocessing.BoundedSemaphore(max_total_requests)
+
+	print("Running " + command + " for " + str(len(cities_list)) + " cities, see build.log in every agency folder")
+
+	with ProcessPoolExecutor(max_workers=len(cities_list), initializer=initialize_city_process,
+		initargs=(request_semaphore,)) as executor:
+		summaries_list = list(executor.map(run_city_command, [command]*len(cities_list), cities_list, [options]*len(cities_list)))
+
+	print("Summary:")
+	for summary in summaries_list:
+		print("\t- " + summary['city'] + ": " + summary['status'] + " in " + str(round(summary['time'])) + "s"
+			+ (", " + str(summary['routes']) + " routes, " + str(summary['stops']) + " stops, "
+				+ str(summary['connections']) + " connections" if 'routes' in summary else ""))
+
+
+def initialize_city_process(request_semaphore):
+	"""Share the limit on the requests made at once by all processes."""
+
+	global global_request_semaphore
+
+	global_request_semaphore = request_semaphore
+
+
+def run_city_command(command, city, options):
+	"""Run a builder command for a city inside its own process, with its output in the city's log file.
+
+	Returns:
+		A summary dictionary of the city, the status, the time taken and the network counts.
+
+	"""
+
+	summary = {'city': city, 'status': "done"}
+	start_time = time.monotonic()
+
+	configure_pipeline(options)
+	configure_fetching(options)
+
+	create_agencies_folder(cities[city]['tag'])
+	log_file = open(cities[city]['tag'] + "/build.log", "w", buffering=1)
+	sys.stdout = log_file
+	sys.stderr = log_file
+
+	try:
+		configure_cache(city, options)
+		network = run_command(command, city, options)
+
+		if network is not None:
+			summary['routes'] = len(network['routes'])
+			summary['stops'] = len(network['stops'])
+			summary['connections'] = len(network['connections'])
+
+	except (Exception, SystemExit) as error:
+		traceback.print_exc()
+		summary['status'] = "failed (" + (type(error).__name__ + ": " + str(error)).strip() + ")"
+
+	finally:
+		sys.stdout = sys.__stdout__
+		sys.stderr = sys.__stderr__
+		log_file.close()
+
+	summary['time'] = time.monotonic() - start_time
+
+	return summary
+
+
+
+# ===============================================
+# =				Building Pipeline 				=
+# ===============================================
+
+def run_pipeline(city, stages_list, checkpoints=[]):
+	"""Run stages of the network building one after the other, keeping the network in memory between them.
+
+	The network is only written to the files after the stages in checkpoints and at the end.
+	When a run with checkpoints stops half-way, the next one continues after the last
+	checkpoint that was written, unless resume_from_checkpoint is off or the network files
+	were written again since (see read_checkpoint_file).
+
+	Args:
+		city: The city whose network is built.
+		stages_list: The names of the stages to run (see pipeline_stages), in order.
+		checkpoints: The names of the stages after which the network is saved.
+
+	Returns:
+		The network after the last stage.
+
+	"""
+
+	directory = cities[city]['tag']
+	network = None
+
+	# Skip the stages up to the last checkpoint of a previous run
+	last_stage = read_checkpoint_file(directory) if checkpoints and resume_from_checkpoint else None
+	if last_stage in stages_list[:-1]:
+		print("Resuming after the " + last_stage + " checkpoint")
+		stages_list = stages_list[stages_list.index(last_stage) + 1:]
+
+	# Every stage but building the static network works on the previously-built one
+	if stages_list[0] != 'static':
+		network = read_network(city)
+
+	for stage in stages_list:
+		network = pipeline_stages[stage](city, network)
+
+		if stage in checkpoints and stage != stages_list[-1]:
+			write_network(city, network)
+			write_checkpoint_file(directory, stage)
+
+	# Write results to files, the checkpoint of an earlier run is out of date once they're written again
+	write_network(city, network)
+	remove_checkpoint_file(directory)
+
+	return network
+
+
+def configure_pipeline(options):
+	"""Set the network building options from the command line (--incremental, --checkpoints=STAGE,..., --restart)."""
+
+	global incremental_build, checkpoint_stages, resume_from_checkpoint
+
+	incremental_build = 'incremental' in options
+	resume_from_checkpoint = 'restart' not in options
+
+	if 'checkpoints' in options:
+		checkpoint_stages = [stage for stage in str(options['checkpoints']).split(",") if stage in pipeline_stages]
+
+
+def read_network(city):
+	"""Read the previously-built network of the city from its files."""
+
+	return {'routes': read_routes_file(cities[city]['tag']),
+		'stops': read_stops_file(cities[city]['tag']),
+		'connections': read_connections_file(cities[city]['tag'])}
+
+
+def write_network(city, network):
+	"""Write the network of the city to its files, along with the route fingerprints if it has them."""
+
+	write_routes_file(cities[city]['tag'], network['routes'])
+	write_stops_file(cities[city]['tag'], network['stops'])
+	write_connections_file(cities[city]['tag'], network['connections'])
+
+	if 'fingerprints' in network:
+		write_fingerprints_file(cities[city]['tag'], network['routes'], network['fingerprints'])
+
+	# The arrays go last, so that they are only used if they are newer than the CSV files
+	write_network_arrays(cities[city]['tag'], network['routes'], network['stops'], network['connections'])
 
 
 # ===============================================
 # =			Static Network Construction 		=
 # ===============================================
 
-def build_static_network(city):
-	"""Construct the atops & connection network of the transport system from all the routes"""
+def build_static_network(city, network=None):
+	"""Construct the atops & connection network of the transport system from all the routes
+
+	With incremental_build, the network that was already built is kept and only the routes whose
+	routeConfig payload changed since then are extracted and merged again.
+
+	"""
 
 	# Get the list of routes and stops for this city
 	routes_list = get_routes_list(city)
 	print("Found " + str(len(routes_list)) + " routes")
 
-	# Hold all the stops and their connections
-	stops_list = []
-	connections_list = []
+	# Retrieve the data of all routes, a few requests at a time
+	routes_xml = call_transit_APIs([(cities[city]['apis'][route['api']], "route_data", route["tag"]) for route in routes_list])
+	fingerprints = {route['tag']: fingerprint_route(route_xml) for route, route_xml in zip(routes_list, routes_xml)}
 
-	# Iterate through routes
+	# Only update the existing network if there is one to update
+	old_fingerprints = read_fingerprints_file(cities[city]['tag']) if incremental_build else {}
+	if old_fingerprints:
+		routes_list, stops_list, connections_list = (
+			update_static_network(city, routes_list, routes_xml, fingerprints, old_fingerprints))
+
+	else:
+
+		# Hold all the stops and their connections
+		stops_list = []
+		connections_list = []
+
+		# Iterate through routes
+		for index, route in enumerate(routes_list):
+			route_xml = ET.fromstring(routes_xml[index])[0]
+			route_stops = get_route_stops(route_xml)
+			route['stops_count'] = len(route_stops)
+			stops_list.extend(route_stops)
+
+			connections_list.extend(get_route_connections(route_xml))
+
+			print("Extracted data from " + str( index + 1 ) + "/" + str(len(routes_list)) + " routes", end="\r")
+
+		# After all routes, clean and consolidate data (merging nearby stops has fewer connections to go through this way)
+		stops_list = consolidate_stops(stops_list)
+		connections_list = consolidate_connections(connections_list)
+		stops_list = remove_isolated_stops(stops_list, connections_list)
+		stops_list, connections_list = merge_nearby_stops(stops_list, connections_list, cities[city]['radius'])
+		connections_list = consolidate_connections(connections_list)
+
+	print("Found " + str(len(stops_list)) + " stops and " + str(len(connections_list)) + " connections")
+
+	return {'routes': routes_list,
+		'stops': stops_list,
+		'connections': connections_list,
+		'fingerprints': fingerprints}
+
+
+def update_static_network(city, routes_list, routes_xml, fingerprints, old_fingerprints):
+	"""Update the previously-built network with the routes that changed since it was built.
+
+	Every route is parsed again, which is cheap next to fetching it, but only the stops around the
+	changed routes are merged again. The merged stops that the changed routes touch, or that have
+	stops no route serves any more, are split back into the stops of the routes and merged again
+	with the stops around them, the same way a full build merges them. Connections between the
+	other stops keep their distances and times, and so do the new connections whose stops didn't move.
+
+	Returns:
+		The updated lists of routes, stops and connections.
+
+	"""
+
+	radius = cities[city]['radius']
+
+	# read the previously-built network data
+	old_network = read_network(city)
+	old_routes_dict = {route['tag']: route for route in old_network['routes']}
+	old_stops = {stop['tag']: stop for stop in old_network['stops']}
+
+	# Routes that are new, were changed or no longer exist
+	changed_routes = set([route['tag'] for route in routes_list
+		if (route['tag'] not in old_routes_dict or old_fingerprints.get(route['tag']) != fingerprints[route['tag']])])
+	changed_routes |= set(old_routes_dict) - set(fingerprints)
+
+	print("Found " + str(len(changed_routes)) + " changed routes")
+
+	route_stops_list = []
+	route_connections_list = []
+
+	# Keep the previous data of the unchanged routes, but take the stops and connections of all of them
 	for index, route in enumerate(routes_list):
-		route_xml = ET.fromstring( call_transit_API(cities[city]['apis'][route['api']], "route_data", route["tag"]) )[0]
+
+		route_xml = ET.fromstring(routes_xml[index])[0]
 		route_stops = get_route_stops(route_xml)
-		route['stops_count'] = len(route_stops)
-		stops_list = stops_list + route_stops
+		route_stops_list.extend(route_stops)
+		route_connections_list.extend(get_route_connections(route_xml))
 
-		connections_list = connections_list + get_route_connections(route_xml)
+		if route['tag'] not in changed_routes:
+			routes_list[index] = old_routes_dict[route['tag']]
+			routes_list[index]['api'] = route['api']
+		else:
+			route['stops_count'] = len(route_stops)
 
 		print("Extracted data from " + str( index + 1 ) + "/" + str(len(routes_list)) + " routes", end="\r")
 
-	# After all routes, clean and consolidate data
-	stops_list = consolidate_stops(stops_list)
-	stops_list = remove_isolated_stops(stops_list, connections_list)
-	stops, connections_list = merge_nearby_stops(stops_list, connections_list, cities[city]['radius'])
-	connections_list = consolidate_connections(connections_list)
+	# The stops and connections of the routes before merging nearby stops, as in a full build
+	route_connections_list = consolidate_connections(route_connections_list)
+	route_stops_list = remove_isolated_stops(consolidate_stops(route_stops_list), route_connections_list)
+	route_stops = {stop['tag']: stop for stop in route_stops_list}
+
+	# Tags of the existing stops that every stop of the routes was merged into
+	merged_tags = {tag: stop['tag'] for stop in old_network['stops'] for tag in stop['merged']}
+
+	# Split the stops that the changed routes go through (before or now), or that have stops no longer served
+	touched_stops = set()
+	for connection in old_network['connections']:
+		if any([route in changed_routes for route in connection['routes']]):
+			touched_stops.update([connection['from'], connection['to']])
+	for connection in route_connections_list:
+		if any([route in changed_routes for route in connection['routes']]):
+			touched_stops.update([merged_tags[tag] for tag in (connection['from'], connection['to']) if tag in merged_tags])
+	touched_stops.update([stop['tag'] for stop in old_network['stops'] if any([tag not in route_stops for tag in stop['merged']])])
+
+	# Along with the new stops, and then the existing stops around all of them (which they may merge with)
+	split_tags = set([tag for tag in route_stops if tag not in merged_tags])
+	split_tags.update([tag for stop_tag in touched_stops if stop_tag in old_stops
+		for tag in old_stops[stop_tag]['merged'] if tag in route_stops])
+
+	stops_grid, cell_func = create_stops_grid(route_stops_list, walking_distance, radius)
+	split_cells = set([cell_func(route_stops[tag]['lat'], route_stops[tag]['lon']) for tag in split_tags])
+	for cell in split_cells:
+		for index in get_grid_neighbours(stops_grid, cell):
+			stop_tag = merged_tags.get(route_stops_list[index]['tag'])
+			if stop_tag is not None and stop_tag not in touched_stops:
+				touched_stops.add(stop_tag)
+				split_tags.update([tag for tag in old_stops[stop_tag]['merged'] if tag in route_stops])
+
+	print("Merging " + str(len(split_tags)) + " stops again")
+
+	# Merge the split stops again, with their connections pointing to the untouched stops they were merged into
+	split_connections_list = [connection for connection in route_connections_list
+		if connection['from'] in split_tags or connection['to'] in split_tags]
+	for connection in split_connections_list:
+		for end in ('from', 'to'):
+			if connection[end] not in split_tags:
+				connection[end] = merged_tags[connection[end]]
+
+	split_stops_list, split_connections_list = merge_nearby_stops(
+		[route_stops[tag] for tag in sorted(split_tags)], split_connections_list, radius)
+
+	# Untouched stops keep their connections, without the ones of the changed routes
+	stops_list = [stop for stop in old_network['stops'] if stop['tag'] not in touched_stops] + split_stops_list
+	connections_list = []
+	for connection in old_network['connections']:
+		if connection['from'] not in touched_stops and connection['to'] not in touched_stops:
+			connection['routes'] = [route for route in connection['routes'] if route not in changed_routes]
+			if connection['routes']:
+				connections_list.append(connection)
 
-	print("Found " + str(len(stops_list)) + " stops and " + str(len(connections_list)) + " connections")
+	# New connections between stops that didn't move keep the distances and times they had
+	positions = {stop['tag']: (float(stop['lat']), float(stop['lon'])) for stop in stops_list}
+	old_positions = {stop['tag']: (float(stop['lat']), float(stop['lon'])) for stop in old_network['stops']}
+	old_connections = {(connection['from'], connection['to']): connection for connection in old_network['connections']}
+	for connection in split_connections_list:
+		old_connection = old_connections.get((connection['from'], connection['to']))
+		if (old_connection is not None and positions.get(connection['from']) == old_positions.get(connection['from'])
+			and positions.get(connection['to']) == old_positions.get(connection['to'])):
+			for name in ('length', 'road_length', 'travel_time'):
+				connection[name] = old_connection[name]
 
-	# Write results to files
-	write_routes_file(cities[city]['tag'], routes_list)
-	write_stops_file(cities[city]['tag'], stops_list)
-	write_connections_file(cities[city]['tag'], connections_list)
+	connections_list = consolidate_connections(connections_list + split_connections_list)
+	stops_list = remove_isolated_stops(consolidate_stops(stops_list), connections_list)
+
+	return routes_list, stops_list, connections_list
+
+
+def fingerprint_route(route_xml):
+	"""Hash the routeConfig payload of a route, to find out whether it changed between builds."""
+
+	return hashlib.sha256(route_xml.encode("utf-8")).hexdigest()
 
 
 def get_routes_list(city):
@@ -114,9 +522,12 @@ def get_routes_list(city):
 
 	routes_list = []
 
-	for api in cities[city]['apis']:
+	apis_list = list(cities[city]['apis'])
+	routes_lists_xml = call_transit_APIs([(cities[city]['apis'][api], "route_list") for api in apis_list])
+
+	for api, routes_list_xml in zip(apis_list, routes_lists_xml):
 
-		routes_tree = ET.fromstring(call_transit_API(cities[city]['apis'][api], "route_list"))
+		routes_tree = ET.fromstring(routes_list_xml)
 		# we are only interested in the route tags
 		routes_map = map((lambda x: {"tag":x.attrib["tag"],
 			"api":api,
@@ -124,7 +535,7 @@ def get_routes_list(city):
 			"wait_time_mean":-1,
 			"wait_time_std":-1}), routes_tree)
 		# convert to list
-		routes_list = routes_list + list(routes_map)
+		routes_list.extend(routes_map)
 
 	return routes_list # DEBUG only the first 10 routes
 
@@ -186,120 +597,159 @@ def consolidate_stops(stops_list):
 
 
 def consolidate_connections(connections_list):
-	"""Merge duplicates from the list of connections."""
+	"""Merge duplicates from the list of connections.
 
-	# Sort list (optional)
-	connections_list.sort(key=(lambda x: (x['from'], x['to']) ))
+	Connections are gathered by their (from, to) stops in a single pass, the first one of
+	every group is kept and the routes of the rest are added to it in the order they appear.
 
-	# Remove self loops
-	for i in reversed(range(0,len(connections_list))):
-		if (connections_list[i]['from'] == connections_list[i]['to']):
-			del(connections_list[i])
+	"""
 
-	# Split list to groups that have the same from and to stops
-	same_connection_groups = groupby(connections_list, key=lambda x: x['from'] + "_" + x['to'])
+	connections_dict = {}
+	routes_dict = {}
 
-	# Merge these groups together by concating the routes for each connection using "|"
-	connections_list = [reduce(merge_connections, group) for _,group in same_connection_groups]
+	for connection in connections_list:
+		key = (connection['from'], connection['to'])
 
-	return connections_list
+		# Remove self loops
+		if (key[0] == key[1]):
+			continue
 
+		if key not in connections_dict:
+			connections_dict[key] = connection
+			routes_dict[key] = {}
 
-def merge_connections(connection_1, connection_2):
-	"""Merge two connections by comparing routes."""
+		# Concat the routes of every connection, discarding duplicates
+		routes_dict[key].update(dict.fromkeys(connection['routes']))
 
-	# Turn into set to discard duplicates 
-	routes_set = set(connection_1['routes'] + connection_2['routes'])
+	for key, connection in connections_dict.items():
+		connection['routes'] = list(routes_dict[key])
 
-	return {
-		'from': connection_1['from'],
-		'to': connection_1['to'],
-		'routes': list(routes_set),
-		'length': connection_1['length'],
-		'road_length': connection_1['road_length'],
-		'travel_time': connection_1['travel_time']}
+	# Sort list (optional)
+	return [connections_dict[key] for key in sorted(connections_dict)]
 
 
 def remove_isolated_stops(stops_list, connections_list):
-	"""Use NetworkX to remove isolated or obsolete stops."""
-
-	# Build the graph object, add stops and connections
-	G = nx.Graph()
-	G.add_nodes_from(convert_stops_to_tuples(stops_list))
-	G.add_edges_from(convert_connections_to_tuples(connections_list))
+	"""Remove isolated or obsolete stops, that are in no connections."""
 
-	# remove isolated nodes that are in no connections
-	isolated_stops = list(nx.isolates(G))
+	connected_stops = set()
+	for connection in connections_list:
+		connected_stops.add(connection['from'])
+		connected_stops.add(connection['to'])
 
-	return list(filter(lambda stop: stop['tag'] not in isolated_stops, stops_list))
+	return [stop for stop in stops_list if stop['tag'] in connected_stops]
 
 
 def merge_nearby_stops(stops_list, connections_list, radius):
-	"""Merge stops that are within walking distance."""
+	"""Merge stops that are within walking distance.
+
+	Stops are bucketed into a grid of walking distance sized cells so that every stop is
+	only compared with the ones in the neighbouring cells. Merges are recorded in a
+	union-find structure where the first stop of every group keeps its tag, and the
+	connections are rewritten to the surviving tags in a single pass at the end.
+
+	"""
+
+	import numpy
 
-	# Turn list of connections into dictionary for direct access
-	connections_dict = {connection['from'] + "_" + connection['to'] : connection for connection in connections_list}
+	# Index stops into a grid, so that close stops can only be in neighbouring cells
+	stops_grid, cell_func = create_stops_grid(stops_list, walking_distance, radius)
+	stops_index = {stop['tag']: index for index, stop in enumerate(stops_list)}
+
+	# Find the stops that have an actual transit route connecting them
+	adjacent_stops = [set() for stop in stops_list]
+	for connection in connections_list:
+		from_index = stops_index.get(connection['from'])
+		to_index = stops_index.get(connection['to'])
+		if from_index is not None and to_index is not None and from_index != to_index:
+			adjacent_stops[from_index].add(to_index)
+			adjacent_stops[to_index].add(from_index)
+
+	# Union-find of merged stops, every group is represented by its first stop
+	parents = list(range(len(stops_list)))
+	lat_array = numpy.array([float(stop['lat']) for stop in stops_list])
+	lon_array = numpy.array([float(stop['lon']) for stop in stops_list])
+	merged_stops = [set(stop['merged']) for stop in stops_list]
+	merged_groups = set()
+
+	def find_group(index):
+		while parents[index] != index:
+			parents[index] = parents[parents[index]]
+			index = parents[index]
+		return index
 
 	# Counters
 	stops_merged = 0
 	initial_length = len(stops_list)
 
-	# Iterate over every stop with every other in a triangle (in reverse because we are changing it)
+	# Go over every stop in reverse, only comparing it with the later stops in the cells around it
 	for i in reversed(range(0, initial_length)):
-		new_length = len(stops_list)
-		for j in reversed(range(i+1, new_length)):
 
-			# Calculate distance between any two stops
-			stop_1 = stops_list[i]
-			stop_2 = stops_list[j]
+		candidates = get_grid_neighbours(stops_grid, cell_func(stops_list[i]['lat'], stops_list[i]['lon']))
+
+		# Compare with the groups of the later stops, latest first (a stop is always its own group here)
+		candidate_groups = set([find_group(j) for j in candidates if j > i])
+
+		candidate_groups = sorted(candidate_groups, reverse=True)
 
-			distance = calculate_straight_distance(stop_1['lat'], stop_1['lon'], stop_2['lat'], stop_2['lon'], radius)
+		# Compare the current (possibly already merged) positions of the stops, all at once
+		distances = calculate_straight_distances(lat_array[i], lon_array[i],
+			lat_array[candidate_groups], lon_array[candidate_groups], radius)
 
-			# If the two stops are within 50m
-			if distance < walking_distance:
+		for k, j in enumerate(candidate_groups):
 
-				# If there is no actual transit route connecting the two, merge 2nd to 1st
-				if (stops_list[i]['tag'] + "_" + stops_list[j]['tag'] not in connections_dict and
-					stops_list[j]['tag'] + "_" + stops_list[i]['tag'] not in connections_dict):
+			# If the two stops are within 50m and no actual transit route connects them, merge 2nd to 1st
+			if distances[k] < walking_distance and j not in adjacent_stops[i]:
 
-					# Set 1st stop position to average of two
-					stops_list[i]['lat'] = (float(stops_list[i]['lat']) + float(stops_list[j]['lat'])) /2
-					stops_list[i]['lon'] = (float(stops_list[i]['lon']) + float(stops_list[j]['lon'])) /2
+				parents[j] = i
+				merged_groups.add(i)
 
-					# Add stop to merged stops
-					stops_list[i]['merged'] = list(set(stops_list[i]['merged'] + stops_list[j]['merged']))
+				# Set 1st stop position to average of two
+				lat_array[i] = (lat_array[i] + lat_array[j]) /2
+				lon_array[i] = (lon_array[i] + lon_array[j]) /2
 
-					# Change connections to tag of 1st stop
-					for connection in connections_list:
-						if connection['from'] == stops_list[j]['tag']:
-							connection['from'] = stops_list[i]['tag']
+				# Add stop to merged stops
+				merged_stops[i] |= merged_stops[j]
 
-					for connection in connections_list:
-						if connection['to'] == stops_list[j]['tag']:
-							connection['to'] = stops_list[i]['tag']
+				stops_merged = stops_merged + 1
 
-					# Delete the second stop
-					del stops_list[j]
+				# The position moved, so the rest are compared with the new one
+				distances[k+1:] = calculate_straight_distances(lat_array[i], lon_array[i],
+					lat_array[candidate_groups[k+1:]], lon_array[candidate_groups[k+1:]], radius)
 
-					stops_merged = stops_merged + 1
+		print("Calculated distances for " + str( initial_length - i ) + "/" + str(initial_length) + " stops", end="\r")
 
-		print("Calculated distances for " + str( initial_length - i + 1 ) + "/" + str(initial_length) + " stops", end="\r")
+	# Keep only the first stop of every group, with the merged position
+	merged_tags = {}
+	merged_list = []
+	for index, stop in enumerate(stops_list):
+		group = find_group(index)
+		merged_tags[stop['tag']] = stops_list[group]['tag']
+
+		if group == index:
+			if index in merged_groups:
+				stop['lat'], stop['lon'] = float(lat_array[index]), float(lon_array[index])
+				stop['merged'] = list(merged_stops[index])
+			merged_list.append(stop)
+
+	# Change connections to tag of 1st stop, in a single pass
+	for connection in connections_list:
+		connection['from'] = merged_tags.get(connection['from'], connection['from'])
+		connection['to'] = merged_tags.get(connection['to'], connection['to'])
 
 	print("\nComparison done! Merged: " + str(stops_merged) + " pairs of nearby stops.")
-	
-	return stops_list, connections_list
+
+	return merged_list, connections_list
 
 
 # ===============================================
 # =				Distance Calculation			=
 # ===============================================
 
-def calculate_distances(city):
-	"""Calculate the straight-line and road distances between the connected stops of the network."""
+def calculate_distances(city, network):
+	"""Calculate the straight-line distances between the connected stops of the network."""
 
-	# read the previously-built network data
-	stops_list = read_stops_file(cities[city]['tag'])
-	connections_list = read_connections_file(cities[city]['tag'])
+	stops_list = network['stops']
+	connections_list = network['connections']
 	
 	# Get Earth radius at city
 	radius = cities[city]['radius']
@@ -307,54 +757,83 @@ def calculate_distances(city):
 	# Turn list of stops into dictionary for direct access
 	stops_dict = {stop['tag']: stop for stop in stops_list}
 
-	# Calculate the length of every connection
-	for connection in connections_list:
-		stop_1 = stops_dict[connection['from']]
-		stop_2 = stops_dict[connection['to']]
-		connection['length'] = calculate_straight_distance(stop_1['lat'], stop_1['lon'], stop_2['lat'], stop_2['lon'], radius)
+	# Calculate the length of every connection, all at once
+	lengths = calculate_pairwise_distances(
+		[float(stops_dict[connection['from']]['lat']) for connection in connections_list],
+		[float(stops_dict[connection['from']]['lon']) for connection in connections_list],
+		[float(stops_dict[connection['to']]['lat']) for connection in connections_list],
+		[float(stops_dict[connection['to']]['lon']) for connection in connections_list], radius)
 
-	# pprint(connections_list)
-	write_connections_file(cities[city]['tag'], connections_list)
+	for connection, length in zip(connections_list, lengths.tolist()):
+		connection['length'] = length
+
+	return network
 
 
-def calculate_road_distances(city):
-	#
+def calculate_road_distances(city, network):
+	"""Calculate the road distances of the connections through the OSRM API.
+
+	Every pair of stop positions is only looked up once (in either direction), first packed
+	into as few requests as possible and then, for the distances that look suspiciously long,
+	once more on its own. The results are kept in a persistent cache of position pairs.
+
+	"""
 	
-	# read the previously-built network data
-	connections_list = read_connections_file(cities[city]['tag'])
-	stops_list = read_stops_file(cities[city]['tag'])
+	connections_list = network['connections']
+	stops_list = network['stops']
 
 	# Turn list of stops into dictionary for direct access
 	stops_dict = {stop['tag']: stop for stop in stops_list}
 
+	road_distances = read_road_distances_cache()
 
-	sources_list = [stops_dict[connection['from']] for connection in connections_list]
-	destinations_list = [stops_dict[connection['to']] for connection in connections_list]
+	# Only look up the connections whose positions haven't been looked up before
+	missing_connections = [connection for connection in connections_list if (get_stops_pair_key(
+		stops_dict[connection['from']], stops_dict[connection['to']]) not in road_distances)]
 
+	print("Found " + str(len(connections_list) - len(missing_connections)) + "/" + str(len(connections_list))
+		+ " connection distances in the cache")
+
+	sources_list = [stops_dict[connection['from']] for connection in missing_connections]
+	destinations_list = [stops_dict[connection['to']] for connection in missing_connections]
 
 	distances_list = call_distance_API(sources_list, destinations_list)
 
-	index = 0
+	# Missing distances and suspiciously big differences, recalculate all of them in a second pass,
+	# since one point without a road route fails every pair packed in the same request
+	suspicious_indices = [index for index, connection in enumerate(missing_connections)
+		if (distances_list[index] is None or (connection['length'] != 0 and distances_list[index]/connection['length'] > 2))]
+
+	rechecked_distances_list = call_distance_API([sources_list[index] for index in suspicious_indices],
+		[destinations_list[index] for index in suspicious_indices], packed=False)
+
+	for index, distance in zip(suspicious_indices, rechecked_distances_list):
+		distances_list[index] = distance
+
+	# Pairs that still failed are left out of the cache, so they are looked up again next time
+	for source, destination, distance in zip(sources_list, destinations_list, distances_list):
+		if distance is not None:
+			road_distances[get_stops_pair_key(source, destination)] = distance
+
+	failed_count = distances_list.count(None)
+	if failed_count:
+		print("Found no road distance for " + str(failed_count) + " connections, using their straight distance")
+
+	write_road_distances_cache(road_distances)
+
 	for connection in connections_list:
 
-		connection['road_length'] = distances_list[index]
+		connection['road_length'] = road_distances.get(get_stops_pair_key(stops_dict[connection['from']], stops_dict[connection['to']]), 0)
 
 		if (connection['length'] == 0):
 			connection['road_length'] = 0
 
-		# Suspiciously big difference in distances, recalculate
-		elif (connection['road_length']/connection['length'] > 2 ):
-			connection['road_length'] = call_distance_API([stops_dict[connection['from']]],[stops_dict[connection['to']]])[0]
-
-		if (connection['length'] > distances_list[index]):
+		if (connection['length'] > connection['road_length']):
 			connection['road_length'] = connection['length']
 
-		index = index + 1
+	print("Calculated distances for " + str(len(connections_list)) + " connections")
 
-		print("Calculated distances for " + str( index + 1 ) + "/" + str(len(connections_list)) + " connections", end="\r")
-
-
-	write_connections_file(cities[city]['tag'], connections_list)
+	return network
 
 
 # ===============================================
@@ -362,32 +841,33 @@ def calculate_road_distances(city):
 # ===============================================
 
 
-def calculate_times(city):
+def calculate_times(city, network):
 
-	# read the previously-built network data
-	routes_list = read_routes_file(cities[city]['tag'])
-	stops_list = read_stops_file(cities[city]['tag'])
-	connections_list = read_connections_file(cities[city]['tag'])
+	routes_list = network['routes']
+	stops_list = network['stops']
+	connections_list = network['connections']
+	network_index = create_network_index(routes_list, stops_list, connections_list)
 
-	# Turn list of stops into dictionary for direct access
-	stops_dict = {stop['tag']: stop for stop in stops_list}
+	# Tags of the stops that were merged into every stop
+	merged_tags = {tag: stop['tag'] for stop in stops_list for tag in stop['merged']}
 
 	# Add an empty array to connections for holding all possible travel times
 	for connection in connections_list:
 		connection['travel_time-array'] = []
 
-	# Iterate through routes
-	for index, route in enumerate(routes_list):
+	# Retrieve stops again to make sure they are correct
+	routes_xml = call_transit_APIs([(cities[city]['apis'][route['api']], "route_data", route["tag"]) for route in routes_list])
+	routes_stops = [[stop['tag'] for stop in get_route_stops(ET.fromstring(route_xml)[0])] for route_xml in routes_xml]
 
-		# Retrieve stops again to make sure they are correct
-		route_xml = ET.fromstring( call_transit_API(cities[city]['apis'][route['api']], "route_data", route["tag"]) )[0]
-		route_stops = [stop['tag'] for stop in get_route_stops(route_xml)]
+	# Retrieve time predictions for every route and its stops
+	predictions_xml = call_transit_APIs([(cities[city]['apis'][route['api']], "predictions", route["tag"], route_stops)
+		for route, route_stops in zip(routes_list, routes_stops)])
 
-		# Retrieve time predictions for this route and these stops
-		predictions_xml = call_transit_API(cities[city]['apis'][route['api']], "predictions", route["tag"], route_stops)
+	# Iterate through routes
+	for index, route in enumerate(routes_list):
 
 		# Convert from xml to actual objects
-		route_predictions = get_route_predictions(ET.fromstring(predictions_xml))
+		route_predictions = get_route_predictions(ET.fromstring(predictions_xml[index]))
 
 		# If this an actual entry without errors
 		if (len(route_predictions) > 0):
@@ -398,19 +878,17 @@ def calculate_times(city):
 			if (route['wait_time_mean'] != -1):
 
 				# Get the connections involved in this route
-				route_connections = [connection for connection in connections_list if (route['tag'] in connection['routes']) ]
+				route_connections = network_index['route_connections'][route['tag']]
 
 				# Calculate travel times
-				calculate_connection_travel_times(route_predictions, route_connections, stops_dict)
+				calculate_connection_travel_times(route_predictions, route_connections, merged_tags)
 		
 		print("Calculated times from " + str( index + 1 ) + "/" + str(len(routes_list)) + " routes", end="\r")
 
 
 	consolidate_connection_times(connections_list)
 
-	# Write results to files
-	write_routes_file(cities[city]['tag'], routes_list)
-	write_connections_file(cities[city]['tag'], connections_list)
+	return network
 
 
 def get_route_predictions(predictions_xml):
@@ -457,6 +935,24 @@ def get_route_predictions(predictions_xml):
 
 def calculate_route_wait_time(route_predictions):
 
+	import numpy
+
+	trip_wait_times = get_route_wait_times(route_predictions)
+
+	if(len(trip_wait_times) > 0):
+		wait_time_average = numpy.mean(trip_wait_times)
+		wait_time_standard_deviation = numpy.std(trip_wait_times)
+	else:
+		wait_time_average = -1
+		wait_time_standard_deviation = -1
+
+
+	return wait_time_average, wait_time_standard_deviation
+
+
+def get_route_wait_times(route_predictions):
+	"""List the times between consecutive trips in the same direction, at every stop of the route."""
+
 	trip_wait_times = []
 
 	# Go through every stop in route
@@ -475,53 +971,61 @@ def calculate_route_wait_time(route_predictions):
 
 				index = index + 1
 
-	if(len(trip_wait_times) > 0):
-		wait_time_average = numpy.mean(trip_wait_times)
-		wait_time_standard_deviation = numpy.std(trip_wait_times)
-	else:
-		wait_time_average = -1
-		wait_time_standard_deviation = -1
+	return trip_wait_times
 
 
-	return wait_time_average, wait_time_standard_deviation
+def calculate_connection_travel_times(route_predictions, route_connections, merged_tags):
+	"""Add the average travel time of the trips seen at both ends of every connection of the route.
 
+	Predictions are grouped by the stop they were merged into and every prediction gets a
+	tripTag to minutes dictionary, so every connection only looks at the predictions of its
+	own two stops and matching the trips is a dictionary lookup.
 
-def calculate_connection_travel_times(route_predictions, route_connections, stops_dict):
+	Args:
+		route_predictions: The list of predictions for the stops of the route.
+		route_connections: The connections of the route.
+		merged_tags: The dictionary of every stop tag to the tag of the stop it was merged into.
 
-	# Go through all possible combinations of stops in the predictions
-	for from_prediction in route_predictions:
-		for to_prediction in route_predictions:
+	"""
+
+	import numpy
 
-			from_stop = from_prediction['stop']
-			to_stop = to_prediction['stop']
+	# Index the trips of every prediction by trip tag, and the predictions by (merged) stop
+	predictions_dict = {}
+	for prediction in route_predictions:
 
-			# Find pairs of stops that correspond to actual connections (including merged stops)
-			for connection in route_connections:
-				if ((from_stop == connection['from'] or from_stop in stops_dict[connection['from']]['merged'])
-					and (to_stop == connection['to'] or to_stop in stops_dict[connection['to']]['merged'])):
+		trip_minutes = {}
+		for trip in prediction['trips']:
+			trip_minutes.setdefault(trip['tag'], trip['minutes'])
 
-					connection_times = []
+		stop = merged_tags.get(prediction['stop'], prediction['stop'])
+		predictions_dict.setdefault(stop, []).append(trip_minutes)
 
-					# Find individual trips
-					for from_trip in from_prediction['trips']:
-						for to_trip in to_prediction['trips']:
-							if (from_trip['tag']==to_trip['tag']):
+	# Find pairs of predictions at both ends of the actual connections (including merged stops)
+	for connection in route_connections:
+		for from_trips in predictions_dict.get(connection['from'], []):
+			for to_trips in predictions_dict.get(connection['to'], []):
 
-								# And finally calculate time
-								trip_time = to_trip['minutes'] - from_trip['minutes']
+				# Find individual trips, going over the smaller of the two
+				if len(to_trips) < len(from_trips):
+					common_trips = [trip for trip in to_trips if trip in from_trips]
+				else:
+					common_trips = [trip for trip in from_trips if trip in to_trips]
 
-								# If trip in the right direction (a.k.a. time positive)
-								if (trip_time >= 0):
-									connection_times.append(trip_time)
+				# Calculate times of trips in the right direction (a.k.a. time positive)
+				connection_times = [to_trips[trip] - from_trips[trip] for trip in common_trips
+					if (to_trips[trip] - from_trips[trip] >= 0)]
 
-					# If trips were found, calculate the average trip time
-					if (len(connection_times) > 0):
-						travel_time = numpy.mean(connection_times)
-						connection['travel_time-array'].append(travel_time)
+				# If trips were found, calculate the average trip time
+				if (len(connection_times) > 0):
+					travel_time = numpy.mean(connection_times)
+					connection['travel_time-array'].append(travel_time)
 
 
 def consolidate_connection_times(connections_list):
 
+	import numpy
+
 	for connection in connections_list:
 
 		if (len(connection['travel_time-array']) > 0):
@@ -533,12 +1037,12 @@ def consolidate_connection_times(connections_list):
 
 
 
-def cleanup(city):
+def cleanup(city, network):
 
-	# read the previously-built network data
-	routes_list = read_routes_file(cities[city]['tag'])
-	stops_list = read_stops_file(cities[city]['tag'])
-	connections_list = read_connections_file(cities[city]['tag'])
+	routes_list = network['routes']
+	stops_list = network['stops']
+	connections_list = network['connections']
+	network_index = create_network_index(routes_list, stops_list, connections_list)
 
 
 	average_city_speed = 0
@@ -556,17 +1060,25 @@ def cleanup(city):
 
 	average_city_speed = average_city_speed/index
 
-	invalid_routes = []
+	invalid_routes = set()
 	valid_routes = []
 
 	# Find invalid routes (nightly, etc.)
 	for route in routes_list:
 		if (route['wait_time_mean'] <= 0 ):
 
-			invalid_routes.append(route['tag'])
+			invalid_routes.add(route['tag'])
 		else:
 			valid_routes.append(route)
 
+	# Only the connections of invalid routes can belong only in invalid routes
+	invalid_connections = set()
+	for route in invalid_routes:
+		for connection in network_index['route_connections'][route]:
+			key = (connection['from'], connection['to'])
+			if (network_index['connection_routes'][key] <= invalid_routes):
+				invalid_connections.add(key)
+
 	valid_connections = []
 
 	# Find connections with invalid times
@@ -575,7 +1087,7 @@ def cleanup(city):
 		if(connection['travel_time'] < 0):
 	
 			# Only keep connections if they don't belong only in invalid routes
-			if ( [route for route in connection['routes'] if (route not in invalid_routes) ] ):
+			if ((connection['from'], connection['to']) not in invalid_connections):
 
 			# Else approximate travel time using length and average city speed
 				valid_connections.append(connection)
@@ -587,9 +1099,278 @@ def cleanup(city):
 		+ " routes, " + str(len(stops_list))
 		+ " stops, " + str(len(valid_connections)) + " connections.")
 
+	network['routes'] = valid_routes
+	network['connections'] = valid_connections
+
+	return network
+
+
+
+# ===============================================
+# =				Demographics 					=
+# ===============================================
+
+def extract_demographics(city, network, buffer, radius=None):
+	"""Extract the sectors of the city from the national demographics, through its spatial index.
+
+	Args:
+		city: The city whose sectors are extracted.
+		network: The network of the city, whose stops decide the area.
+		buffer: The distance in km to extend the bounding box of the stops by.
+		radius: If given, only keep the sectors within this distance in km of a stop.
+
+	"""
+
+	import numpy
+
+	stops_list = network['stops']
+	earth_radius = cities[city]['radius']
+
+	lat_array = numpy.array([float(stop['lat']) for stop in stops_list])
+	lon_array = numpy.array([float(stop['lon']) for stop in stops_list])
+
+	# Turn the buffer into degrees, longitude degrees get shorter away from the equator
+	margin = max(buffer, radius or 0)
+	margin_lat = margin * 180 / (math.pi * earth_radius)
+	margin_lon = margin_lat / max(math.cos(max(abs(lat_array.min()), abs(lat_array.max())) * math.pi/180), 0.01)
+
+	demographics_index = read_demographics_index(national_demographics_path)
+	sectors_list = get_sectors_in_box(demographics_index,
+		lat_array.min() - margin_lat, lat_array.max() + margin_lat,
+		lon_array.min() - margin_lon, lon_array.max() + margin_lon)
+
+	# Keep only the sectors close enough to their nearest stop
+	if radius is not None and sectors_list:
+		least_distances = numpy.concatenate([block.min(axis=1) for row, block in calculate_distance_matrix(
+			[sector['lat'] for sector in sectors_list], [sector['lon'] for sector in sectors_list],
+			lat_array, lon_array, earth_radius)])
+		sectors_list = [sector for sector, distance in zip(sectors_list, least_distances.tolist()) if distance <= radius]
+
+	# Don't replace the sectors of a city outside the national demographics with nothing
+	if not sectors_list:
+		print("Error: No sectors found around the network of this city!")
+		return
+
+	write_demographics_file(cities[city]['tag'], sectors_list)
+
+	print("Extracted " + str(len(sectors_list)) + " sectors with a population of "
+		+ str(sum([sector['population'] for sector in sectors_list])))
+
+
+# ===============================================
+# =				Prediction Sampling 			=
+# ===============================================
+
+def sample_predictions(city, interval, duration=None):
+	"""Poll the time predictions of all routes every interval seconds and store the trips seen.
+
+	Every poll requests all routes at once through the fetching pool, and the observations are
+	appended to the samples database of the day. A poll that takes longer than the interval
+	skips the time slots it missed instead of piling up requests.
+
+	Args:
+		city: The city whose routes are sampled.
+		interval: The number of seconds between polls.
+		duration: The number of seconds to keep sampling for (forever if None).
+
+	"""
+
+	routes_list = read_routes_file(cities[city]['tag'])
+
+	start_time = time.monotonic()
+	next_poll_time = start_time
+	samples_day = None
+	polls = 0
+
+	while duration is None or time.monotonic() - start_time < duration:
+
+		# Start a new partition every day, and retrieve the stops of the routes again with it
+		day = time.strftime("%Y-%m-%d")
+		if day != samples_day:
+			if samples_day is not None:
+				samples_database.close()
+
+			samples_day = day
+			samples_database = open_samples_database(get_samples_path(city, day))
+
+			routes_xml = call_transit_APIs([(cities[city]['apis'][route['api']], "route_data", route["tag"]) for route in routes_list])
+			routes_stops = [[stop['tag'] for stop in get_route_stops(ET.fromstring(route_xml)[0])] for route_xml in routes_xml]
+
+		# Retrieve time predictions for every route and its stops
+		sample_time = int(time.time())
+		predictions_xml = call_transit_APIs([(cities[city]['apis'][route['api']], "predictions", route["tag"], route_stops)
+			for route, route_stops in zip(routes_list, routes_stops)])
+
+		routes_predictions = [get_route_predictions(ET.fromstring(prediction_xml)) for prediction_xml in predictions_xml]
+		write_prediction_samples(samples_database, sample_time, routes_predictions)
+
+		polls = polls + 1
+		print("Sampled predictions " + str(polls) + " times", end="\r")
+
+		# Wait for the next free time slot
+		now = time.monotonic()
+		next_poll_time = next_poll_time + interval
+		if next_poll_time < now:
+			next_poll_time = now + interval - (now - next_poll_time) % interval
+		time.sleep(next_poll_time - now)
+
+	if samples_day is not None:
+		samples_database.close()
+
+	print("")
+
+
+def consolidate_samples(city, days=None):
+	"""Calculate the route wait times and connection travel times over all the stored samples.
+
+	The samples are streamed one route snapshot at a time, and only running sums are kept
+	for every route and connection, so memory doesn't grow with the number of samples.
+
+	Args:
+		city: The city whose samples are consolidated.
+		days: The number of most recent days of samples to use (all if None).
+
+	"""
+
+	# read the previously-built network data
+	routes_list = read_routes_file(cities[city]['tag'])
+	stops_list = read_stops_file(cities[city]['tag'])
+	connections_list = read_connections_file(cities[city]['tag'])
+	network_index = create_network_index(routes_list, stops_list, connections_list)
+
+	# Tags of the stops that were merged into every stop
+	merged_tags = {tag: stop['tag'] for stop in stops_list for tag in stop['merged']}
+
+	# Running count, sum and sum of squares of the wait times of every route
+	wait_times = {route['tag']: [0, 0, 0] for route in routes_list}
+
+	# Running sum and count of the travel times of every connection
+	for connection in connections_list:
+		connection['travel_time-array'] = []
+		connection['travel_time-sum'] = [0, 0]
+
+	samples_paths = get_samples_paths(city)
+	if days is not None:
+		samples_paths = samples_paths[-days:]
+
+	snapshots = 0
+	for samples_path in samples_paths:
+		for route_tag, route_predictions in read_prediction_samples(samples_path):
+
+			if route_tag not in wait_times:
+				continue
+
+			route_wait_times = get_route_wait_times(route_predictions)
+			wait_times[route_tag][0] = wait_times[route_tag][0] + len(route_wait_times)
+			wait_times[route_tag][1] = wait_times[route_tag][1] + sum(route_wait_times)
+			wait_times[route_tag][2] = wait_times[route_tag][2] + sum([wait_time**2 for wait_time in route_wait_times])
+
+			# Only routes that are running have travel times, fold them into the sums right away
+			if route_wait_times:
+				route_connections = network_index['route_connections'][route_tag]
+				calculate_connection_travel_times(route_predictions, route_connections, merged_tags)
+
+				for connection in route_connections:
+					connection['travel_time-sum'][0] = connection['travel_time-sum'][0] + sum(connection['travel_time-array'])
+					connection['travel_time-sum'][1] = connection['travel_time-sum'][1] + len(connection['travel_time-array'])
+					connection['travel_time-array'] = []
+
+			snapshots = snapshots + 1
+			print("Consolidated " + str(snapshots) + " route samples", end="\r")
+
+	print("")
+
+	for route in routes_list:
+		count, total, squares_total = wait_times[route['tag']]
+
+		if (count > 0):
+			route['wait_time_mean'] = total/count
+			route['wait_time_std'] = math.sqrt(max(squares_total/count - route['wait_time_mean']**2, 0))
+		else:
+			route['wait_time_mean'] = -1
+			route['wait_time_std'] = -1
+
+	for connection in connections_list:
+		total, count = connection.pop('travel_time-sum')
+		connection['travel_time'] = total/count if count > 0 else -1
+		connection.pop('travel_time-array', None)
+
 	# Write results to files
-	write_routes_file(cities[city]['tag'], valid_routes)
-	write_connections_file(cities[city]['tag'], valid_connections)	
+	write_routes_file(cities[city]['tag'], routes_list)
+	write_connections_file(cities[city]['tag'], connections_list)
+
+
+def get_samples_path(city, day):
+	"""Find the samples database of a day, in the agency folder of the city."""
+
+	return cities[city]['tag'] + "/samples/" + day + ".sqlite"
+
+
+def get_samples_paths(city):
+	"""List the samples databases of all days, oldest first."""
+
+	samples_directory = cities[city]['tag'] + "/samples"
+	if not os.path.isdir(samples_directory):
+		return []
+
+	return [samples_directory + "/" + name for name in sorted(os.listdir(samples_directory)) if name.endswith(".sqlite")]
+
+
+def open_samples_database(samples_path):
+	"""Open (and create if needed) the samples database of a day.
+
+	Every row is one trip seen in one prediction, and rows are only ever appended, so the
+	rows of one poll and one route are always next to each other in insertion order.
+
+	"""
+
+	create_agencies_folder(os.path.dirname(samples_path))
+
+	samples_database = sqlite3.connect(samples_path)
+	samples_database.execute("CREATE TABLE IF NOT EXISTS trips (time INTEGER, route TEXT, stop TEXT,"
+		+ " direction TEXT, trip TEXT, minutes INTEGER)")
+
+	return samples_database
+
+
+def write_prediction_samples(samples_database, sample_time, routes_predictions):
+	"""Append the trips of the predictions of all routes in one poll to the samples database."""
+
+	rows = [(sample_time, prediction['route'], prediction['stop'], trip['direction'], trip['tag'], trip['minutes'])
+		for route_predictions in routes_predictions
+		for prediction in route_predictions
+		for trip in prediction['trips']]
+
+	with samples_database:
+		samples_database.executemany("INSERT INTO trips VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+
+def read_prediction_samples(samples_path):
+	"""Read the samples database of a day one route snapshot at a time.
+
+	Returns:
+		A generator of (route tag, route predictions) pairs, with the predictions in the
+		same form as get_route_predictions gives them.
+
+	"""
+
+	samples_database = sqlite3.connect(samples_path)
+
+	try:
+		rows = samples_database.execute("SELECT time, route, stop, direction, trip, minutes FROM trips ORDER BY rowid")
+
+		for (sample_time, route_tag), route_rows in groupby(rows, key=lambda x: (x[0], x[1])):
+
+			route_predictions = []
+			for stop, stop_rows in groupby(route_rows, key=lambda x: x[2]):
+				route_predictions.append({'route': route_tag,
+					'stop': stop,
+					'trips': [{'tag': row[4], 'minutes': row[5], 'direction': row[3]} for row in stop_rows]})
+
+			yield route_tag, route_predictions
+
+	finally:
+		samples_database.close()
 
 
 
@@ -611,6 +1392,27 @@ def call_transit_API(api, command, route = "", stops=[]):
 
 	"""
 
+	return fetch_url(get_transit_API_url(api, command, route, stops), command)
+
+
+def call_transit_APIs(calls_list):
+	"""Call the agency's API for many commands at once, using a bounded pool of concurrent requests.
+
+	Args:
+		calls_list: The list of (api, command, route, stops) tuples, with the same meaning
+			as the call_transit_API arguments.
+
+	Returns:
+		The list of response bodies, in the same order as the calls.
+
+	"""
+
+	return fetch_urls([get_transit_API_url(*call) for call in calls_list], [call[1] for call in calls_list])
+
+
+def get_transit_API_url(api, command, route = "", stops=[]):
+	"""Build the request url of the agency's API for a specific command, on the transit_api_server if there is one."""
+
 	if command == 'route_list':
 		options_url = ''
 
@@ -619,52 +1421,407 @@ def call_transit_API(api, command, route = "", stops=[]):
 
 	elif command == 'predictions' and route != '':
 
-		options_url = ''
-		for stop in stops:
-			options_url = options_url + '&stops=' + route + "|" + stop
+		options_url = ''.join(['&stops=' + route + "|" + stop for stop in stops])
 
-	return requests.get(api['base'] + api['commands'][command] +  options_url).text
+	base_url = api['base']
+	if transit_api_server is not None:
+		base_url = transit_api_server + base_url[base_url.index("/", base_url.index("//") + 2):]
 
+	return base_url + api['commands'][command] +  options_url
 
-def call_distance_API(sources_list, destinations_list):
+
+def call_distance_API(sources_list, destinations_list, packed=True):
 	"""Call the OSRM road distance API to get the distances between a list of points.
 
+	Pairs of points are looked up only once, regardless of their direction. When packed,
+	pairs that share a point are chained into the same route, so that every leg between two
+	waypoints is a distance we need, and the requests are made in parallel.
+
 	Args:
 		sources_list: The list of source points.
 		destinations_list: The list of destination points.
+		packed: Whether to pack many pairs in a request, or request every pair on its own.
 
 	Returns:
-		The response body.
+		The list of distances in km, in the same order as the pairs of points, None for the
+		pairs whose request failed or found no road route.
 
 	"""
 
+	points_pairs = [(get_stop_point(source), get_stop_point(destination))
+		for source, destination in zip(sources_list, destinations_list)]
 
-	source_points_list = [stop['lon'] + "," + stop['lat'] for stop in sources_list]
-	destination_points_list = [stop['lon'] + "," + stop['lat'] for stop in destinations_list]
+	# Keep every pair once, in the direction it was first seen
+	unique_pairs = {}
+	for pair in points_pairs:
+		unique_pairs.setdefault(get_points_pair_key(pair), pair)
+	unique_pairs_list = list(unique_pairs.values())
 
-	points_list = [None]*(len(source_points_list)+len(destination_points_list))
-	points_list[::2] = source_points_list
-	points_list[1::2] = destination_points_list
+	if packed:
+		requests_list = pack_distance_requests(unique_pairs_list)
+	else:
+		requests_list = [(list(pair), [(0, index)]) for index, pair in enumerate(unique_pairs_list)]
 
-	api_base = "http://router.project-osrm.org/route/v1/driving/"
 	api_options = "?overview=false"
+	responses_text = fetch_urls([distance_api_base + ';'.join(waypoints) + api_options for waypoints, legs in requests_list],
+		["distances"]*len(requests_list))
 
-	distances = []
+	distances = {}
+	for (waypoints, legs), response_text in zip(requests_list, responses_text):
 
-	# Do a request per 100 stops
-	for x in range(0, len(points_list), 100):
-		
-		response_text = requests.get(api_base + ';'.join(points_list[x:x+100]) + api_options).text	
-		response_json = json.loads(response_text)
+		# Error pages and points without a road route between them get no distance
+		try:
+			response_json = json.loads(response_text)
+		except ValueError:
+			continue
+		if not isinstance(response_json, dict) or not response_json.get('routes'):
+			continue
+
+		route_legs = response_json['routes'][0]['legs']
+		for leg_index, pair_index in legs:
+			distances[get_points_pair_key(unique_pairs_list[pair_index])] = route_legs[leg_index]['distance']*0.001
+
+	return [distances.get(get_points_pair_key(pair)) for pair in points_pairs]
+
+
+def pack_distance_requests(pairs_list):
+	"""Chain pairs of points into routes of at most max_waypoints_per_request waypoints.
+
+	Starting from a pair, the route keeps following any pair that wasn't used yet from its
+	last point, so connected stops make one long route where every leg is useful. Only the
+	jumps between two chains are legs whose distance is not needed.
+
+	Returns:
+		The list of (waypoints, legs) requests, where legs are (leg index, pair index) tuples.
+
+	"""
+
+	# Pairs of every point, regardless of direction
+	point_pairs = {}
+	for index, (point_1, point_2) in enumerate(pairs_list):
+		point_pairs.setdefault(point_1, []).append(index)
+		point_pairs.setdefault(point_2, []).append(index)
+
+	used_pairs = [False]*len(pairs_list)
+	requests_list = []
+	waypoints = []
+	legs = []
+
+	for start_index, (start_point, _) in enumerate(pairs_list):
+
+		# Follow unused pairs from the last point for as long as possible, until this pair is used too
+		while not used_pairs[start_index]:
+			point = start_point
+			chain_started = False
+			while True:
+				candidates = point_pairs[point]
+				while candidates and used_pairs[candidates[-1]]:
+					candidates.pop()
+				if not candidates:
+					break
+
+				index = candidates.pop()
+				used_pairs[index] = True
+				next_point = pairs_list[index][1] if pairs_list[index][0] == point else pairs_list[index][0]
+
+				# Start a new request if this leg doesn't fit in the current one
+				if len(waypoints) + (1 if chain_started else 2) > max_waypoints_per_request:
+					requests_list.append((waypoints, legs))
+					waypoints = []
+					legs = []
+					chain_started = False
+
+				if not chain_started:
+					waypoints.append(point)
+					chain_started = True
+
+				legs.append((len(waypoints) - 1, index))
+				waypoints.append(next_point)
+				point = next_point
+
+	if legs:
+		requests_list.append((waypoints, legs))
+
+	return requests_list
+
+
+def get_stop_point(stop):
+	"""Format the position of a stop as an OSRM "lon,lat" point."""
+
+	return str(stop['lon']) + "," + str(stop['lat'])
+
+
+def get_points_pair_key(pair):
+	"""Key of a pair of points that is the same in both directions."""
+
+	return (pair[0], pair[1]) if pair[0] <= pair[1] else (pair[1], pair[0])
+
+
+def get_stops_pair_key(stop_1, stop_2):
+	"""Key of the positions of two stops that is the same in both directions."""
+
+	return get_points_pair_key((get_stop_point(stop_1), get_stop_point(stop_2)))
+
+
+# ===============================================
+# =					HTTP fetching 				=
+# ===============================================
+
+def configure_fetching(options):
+	"""Set the fetching limits and the API servers from the command line options
+	(--workers=N, --total-workers=N, --rate=N, --osrm=URL, --nextbus=URL)."""
+
+	global max_concurrent_requests, max_total_requests, requests_per_second, distance_api_base, transit_api_server, http_session
+
+	if 'workers' in options:
+		max_concurrent_requests = max(int(options['workers']), 1)
+	if 'total-workers' in options:
+		max_total_requests = max(int(options['total-workers']), 1)
+	if 'rate' in options:
+		requests_per_second = float(options['rate'])
+	if 'osrm' in options:
+		distance_api_base = options['osrm'].rstrip("/") + "/"
+	if 'nextbus' in options:
+		transit_api_server = options['nextbus'].rstrip("/")
+
+	# The connection pool has to be resized with the new limits
+	http_session = None
+
+
+def get_http_session():
+	"""Create the shared HTTP session once, so that connections are reused between requests."""
+
+	global http_session
+
+	import requests, requests.adapters
+
+	with session_lock:
+		if http_session is None:
+			adapter = requests.adapters.HTTPAdapter(pool_connections=max_concurrent_requests,
+				pool_maxsize=max_concurrent_requests)
+			http_session = requests.Session()
+			http_session.mount("http://", adapter)
+			http_session.mount("https://", adapter)
+
+	return http_session
+
+
+def wait_for_rate_limit():
+	"""Block until the next request is allowed by the requests-per-second limit."""
+
+	global next_request_time
+
+	if requests_per_second <= 0:
+		return
+
+	# Reserve the next free time slot, then sleep outside the lock until it comes
+	with rate_limit_lock:
+		now = time.monotonic()
+		request_time = max(now, next_request_time)
+		next_request_time = request_time + 1/requests_per_second
+
+	time.sleep(request_time - now)
+
+
+def fetch_url(url, command=None):
+	"""Request a url through the response cache, the shared session and the rate limit.
+
+	Args:
+		url: The url to request.
+		command: The API command of the request, which decides how long a cached response is valid.
+
+	Returns:
+		The response body.
+
+	"""
+
+	import requests
+
+	# Serve from the cache if there is a response that is still valid
+	cached_text = read_cached_response(url, cache_ttls.get(command, 0))
+	if cached_text is not None:
+		return cached_text
+
+	if offline_mode:
+		print("Error: No cached response for " + url + " in offline mode!")
+		sys.exit()
+
+	# Retry failed connections, server errors and rate limiting, waiting longer every time
+	for attempt in range(request_retries + 1):
+
+		wait_for_rate_limit()
+
+		try:
+			response = get_http_response(url)
+			if response.status_code < 500 and response.status_code != 429:
+				break
+		except requests.exceptions.RequestException:
+			if attempt == request_retries:
+				raise
+
+		if attempt < request_retries:
+			time.sleep(retry_delay * 2**attempt)
+
+	if response.ok:
+		write_cached_response(url, response.text)
+
+	return response.text
+
+
+def get_http_response(url):
+	"""Make the request, holding one of the requests shared by all processes when building many cities."""
+
+	if global_request_semaphore is None:
+		return get_http_session().get(url, timeout=request_timeout)
+
+	with global_request_semaphore:
+		return get_http_session().get(url, timeout=request_timeout)
+
+
+def fetch_urls(urls_list, commands_list=None):
+	"""Request many urls with a bounded number of requests at once.
+
+	Returns:
+		The list of response bodies, in the same order as the urls.
+
+	"""
+
+	if commands_list is None:
+		commands_list = [None]*len(urls_list)
+
+	if len(urls_list) <= 1 or max_concurrent_requests == 1:
+		return [fetch_url(url, command) for url, command in zip(urls_list, commands_list)]
+
+	with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+		return list(executor.map(fetch_url, urls_list, commands_list))
+
+
+# ===============================================
+# =				Response cache 					=
+# ===============================================
+
+def configure_cache(city, options):
+	"""Keep the response cache in the agency folder, unless disabled with --no-cache.
+
+	With --offline every response is served from the cache regardless of its age,
+	and no requests are made at all.
+
+	"""
+
+	global cache_directory, offline_mode
+
+	offline_mode = 'offline' in options
+
+	if 'no-cache' in options and not offline_mode:
+		cache_directory = None
+	else:
+		cache_directory = cities[city]['tag'] + "/cache"
+
+
+def get_cache_path(url):
+	"""Find the cache file of a url, named by the hash of the url."""
+
+	return cache_directory + "/" + hashlib.sha256(url.encode("utf-8")).hexdigest() + ".txt"
+
+
+def read_cached_response(url, ttl):
+	"""Read the cached response of a url if it is younger than ttl seconds (None never expires).
+
+	Returns:
+		The response body, or None if there is no valid cached response.
+
+	"""
+
+	if cache_directory is None or (ttl is not None and ttl <= 0 and not offline_mode):
+		return None
+
+	cache_path = get_cache_path(url)
+
+	try:
+		if not offline_mode and ttl is not None and time.time() - os.path.getmtime(cache_path) > ttl:
+			return None
+
+		with open(cache_path, "r", encoding="utf-8") as cache_file:
+			return cache_file.read()
+
+	except FileNotFoundError:
+		return None
+
+
+def write_cached_response(url, text):
+	"""Store the response of a url in the cache, through a temporary file so readers never see half of it."""
+
+	if cache_directory is None:
+		return
+
+	create_agencies_folder(cache_directory)
+	cache_path = get_cache_path(url)
+
+	temporary_path = cache_path + "." + str(os.getpid()) + "-" + str(threading.get_ident()) + ".tmp"
+	with open(temporary_path, "w", encoding="utf-8") as cache_file:
+		cache_file.write(text)
+	os.replace(temporary_path, cache_path)
+
+
+def read_road_distances_cache():
+	"""Read the road distances of all the pairs of positions that were looked up before.
+
+	Returns:
+		A dictionary of position pair keys (see get_points_pair_key) to road distances in km.
+
+	"""
+
+	if cache_directory is None:
+		return {}
+
+	try:
+		with open(cache_directory + "/road_distances.csv", "r", encoding="utf-8") as distances_file:
+			distances_rows = [row.split(",") for row in distances_file.read().split("\n")[1:] if row]
+	except FileNotFoundError:
+		return {}
+
+	return {(row[0] + "," + row[1], row[2] + "," + row[3]): float(row[4]) for row in distances_rows}
+
+
+def write_road_distances_cache(road_distances):
+	"""Store the road distances of all pairs of positions, through a temporary file."""
+
+	if cache_directory is None:
+		return
+
+	create_agencies_folder(cache_directory)
+	distances_path = cache_directory + "/road_distances.csv"
+
+	temporary_path = distances_path + "." + str(os.getpid()) + ".tmp"
+	with open(temporary_path, "w", encoding="utf-8") as distances_file:
+		distances_file.write("from_lon,from_lat,to_lon,to_lat,road_length\n")
+		distances_file.write("".join([point_1 + "," + point_2 + "," + str(distance) + "\n"
+			for (point_1, point_2), distance in road_distances.items()]))
+	os.replace(temporary_path, distances_path)
 
-		results = response_json['routes'][0]['legs'][::2]
-		distances = distances + [connection['distance']*0.001 for connection in results]
 
-	return distances
 
 
 
+# Commands of the builder and their short forms
+commands = {
+	'static': "static", '-s': "static",
+	'distances': "distances", '-d': "distances",
+	'times': "times", '-t': "times",
+	'sample': "sample", '-p': "sample",
+	'consolidate': "consolidate", '-o': "consolidate",
+	'clean': "clean", '-c': "clean",
+	'all': "all", '-a': "all",
+	'arrays': "arrays", '-r': "arrays",
+	'demographics': "demographics", '-g': "demographics"}
 
+# Stages of the network building, in the order they run
+pipeline_stages = {
+	'static': build_static_network,
+	'distances': calculate_distances,
+	'road_distances': calculate_road_distances,
+	'times': calculate_times,
+	'clean': cleanup}
 
 
 
@@ -1,4 +1,6 @@
-import os, sys, math
+import os, sys, math, csv
+
+# numpy is only imported in the functions that need it, so that importing common stays fast
 
 
 cities = {
@@ -103,6 +105,310 @@ def calculate_straight_distance(stop_1_lat, stop_1_lon, stop_2_lat, stop_2_lon,
 	return d
 
 
+def calculate_straight_distances(lat, lon, lat_array, lon_array, radius):
+	"""Calculate the straight-line distances from one point to many points at once.
+
+	Args:
+		lat, lon: The position of the point in degrees.
+		lat_array, lon_array: The positions of the other points in degrees (anything numpy.asarray takes).
+		radius: The Earth radius at the city in km (see cities).
+
+	Returns:
+		The array of distances in km.
+
+	"""
+
+	return calculate_pairwise_distances(lat, lon, lat_array, lon_array, radius)
+
+
+def calculate_pairwise_distances(lat_array_1, lon_array_1, lat_array_2, lon_array_2, radius):
+	"""Calculate the straight-line distances between the points of two arrays, row by row.
+
+	The arrays are broadcast against each other, so one side can also be a single point.
+
+	Returns:
+		The array of distances in km.
+
+	"""
+
+	import numpy
+
+	rad_pi = math.pi/180
+
+	lat_1 = numpy.asarray(lat_array_1, dtype=numpy.float64) * rad_pi
+	lon_1 = numpy.asarray(lon_array_1, dtype=numpy.float64) * rad_pi
+
+	lat_2 = numpy.asarray(lat_array_2, dtype=numpy.float64) * rad_pi
+	lon_2 = numpy.asarray(lon_array_2, dtype=numpy.float64) * rad_pi
+
+	a = numpy.sin((lat_2 - lat_1)/2)**2 + numpy.cos(lat_1) * numpy.cos(lat_2) * numpy.sin((lon_2 - lon_1)/2)**2
+
+	return radius * 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+
+
+def calculate_distance_matrix(lat_array_1, lon_array_1, lat_array_2, lon_array_2, radius, chunk_size=2**20):
+	"""Calculate the straight-line distances between every point of the first and every point of the second array.
+
+	The matrix is calculated a block of rows at a time, so that no block has more than
+	chunk_size distances in it and memory stays bounded for any number of points.
+
+	Returns:
+		A generator of (first row, block of distances in km) pairs, in row order.
+
+	"""
+
+	import numpy
+
+	lat_array_1 = numpy.asarray(lat_array_1, dtype=numpy.float64)
+	lon_array_1 = numpy.asarray(lon_array_1, dtype=numpy.float64)
+	lat_array_2 = numpy.asarray(lat_array_2, dtype=numpy.float64)
+	lon_array_2 = numpy.asarray(lon_array_2, dtype=numpy.float64)
+
+	rows_per_chunk = max(chunk_size // max(len(lat_array_2), 1), 1)
+
+	for row in range(0, len(lat_array_1), rows_per_chunk):
+		yield row, calculate_pairwise_distances(lat_array_1[row:row + rows_per_chunk, None], lon_array_1[row:row + rows_per_chunk, None],
+			lat_array_2[None, :], lon_array_2[None, :], radius)
+
+
+def create_stops_grid(stops_list, cell_size, radius):
+	"""Bucket the stops into a grid of lat/lon cells that are at least cell_size km wide.
+
+	Returns:
+		A dictionary of (row, column) cell keys to lists of stop indices and a function
+		that gives the cell key of any position.
+
+	"""
+
+	# Degrees of latitude per km are constant, degrees of longitude grow away from the equator
+	cell_lat = cell_size * 180 / (math.pi * radius)
+	max_lat = max([abs(float(stop['lat'])) for stop in stops_list], default=0)
+	cell_lon = cell_lat / max(math.cos(max_lat * math.pi/180), 0.01)
+
+	cell_func = lambda lat, lon: (math.floor(float(lat) / cell_lat), math.floor(float(lon) / cell_lon))
+
+	stops_grid = {}
+	for index, stop in enumerate(stops_list):
+		stops_grid.setdefault(cell_func(stop['lat'], stop['lon']), []).append(index)
+
+	return stops_grid, cell_func
+
+
+def get_grid_neighbours(stops_grid, cell):
+	"""List the stop indices in a grid cell and the 8 cells around it."""
+
+	neighbours = []
+	for row in range(cell[0] - 1, cell[0] + 2):
+		for column in range(cell[1] - 1, cell[1] + 2):
+			neighbours.extend(stops_grid.get((row, column), []))
+
+	return neighbours
+
+
+def create_stops_index(positions, cell_size=0.0072):
+	"""Index the stops into a grid of cell_size degree cells, for fast box, radius and nearest stop queries.
+
+	Args:
+		positions: The array of the (lat, lon) of every stop, like the positions of the stops of a
+			CompactNetwork, so that the indices of the stops are also their ids.
+
+	Returns:
+		A dictionary with the positions of the stops as arrays, the array of stop indices
+		in every (row, column) cell and the same cells as sorted keys and slices of the stops order.
+
+	"""
+
+	import numpy
+
+	lat_array = positions[:, 0]
+	lon_array = positions[:, 1]
+
+	# Sort the stops by cell, so every cell is a slice of the sorted indices
+	rows = numpy.floor(lat_array / cell_size).astype(numpy.int64)
+	columns = numpy.floor(lon_array / cell_size).astype(numpy.int64)
+	order = numpy.lexsort((columns, rows))
+
+	sorted_keys = get_cell_keys(rows[order], columns[order])
+	cell_keys, cell_starts = numpy.unique(sorted_keys, return_index=True)
+	cell_ends = numpy.append(cell_starts[1:], len(order))
+
+	cells = {(int(rows[order[start]]), int(columns[order[start]])): order[start:end]
+		for start, end in zip(cell_starts.tolist(), cell_ends.tolist())}
+
+	return {'lat': lat_array,
+		'lon': lon_array,
+		'cell_size': cell_size,
+		'cells': cells,
+		'order': order,
+		'cell_keys': cell_keys,
+		'cell_starts': cell_starts,
+		'cell_ends': cell_ends}
+
+
+def get_cell_keys(rows, columns):
+	"""Pack (row, column) cell arrays into single integers that sort in the same order."""
+
+	return rows * 2**32 + columns
+
+
+def get_stops_indices_in_box(stops_index, lat, lon, lat_cutoff, lon_cutoff=None):
+	"""Find the stops strictly closer than the cutoffs (in degrees) to a position on both axes.
+
+	Returns:
+		The sorted array of the indices of the stops, so they are in the same order as the stops list.
+
+	"""
+
+	import numpy
+
+	if lon_cutoff is None:
+		lon_cutoff = lat_cutoff
+
+	cell_size = stops_index['cell_size']
+	first_row, last_row = math.floor((lat - lat_cutoff) / cell_size), math.floor((lat + lat_cutoff) / cell_size)
+	first_column, last_column = math.floor((lon - lon_cutoff) / cell_size), math.floor((lon + lon_cutoff) / cell_size)
+
+	# Go through the cells in the box, or through all the stops if that is less work
+	if (last_row - first_row + 1) * (last_column - first_column + 1) > len(stops_index['cells']):
+		candidates = numpy.arange(len(stops_index['lat']))
+	else:
+		cells_list = [stops_index['cells'].get((row, column)) for row in range(first_row, last_row + 1)
+			for column in range(first_column, last_column + 1)]
+		cells_list = [cell for cell in cells_list if cell is not None]
+		if not cells_list:
+			return numpy.zeros(0, dtype=numpy.int64)
+		candidates = numpy.concatenate(cells_list)
+
+	lat_array = stops_index['lat'][candidates]
+	lon_array = stops_index['lon'][candidates]
+	in_box = ((lat < lat_array + lat_cutoff) & (lat > lat_array - lat_cutoff)
+		& (lon < lon_array + lon_cutoff) & (lon > lon_array - lon_cutoff))
+
+	return numpy.sort(candidates[in_box])
+
+
+def get_stops_indices_in_radius(stops_index, lat, lon, distance, radius):
+	"""Find the stops within a straight-line distance (in km) of a position, in the order of the stops list.
+
+	Returns:
+		The array of the indices of the stops and the array of their distances.
+
+	"""
+
+	lat_cutoff, lon_cutoff = get_degrees_cutoffs(lat, distance, radius)
+	candidates = get_stops_indices_in_box(stops_index, lat, lon, lat_cutoff, lon_cutoff)
+	distances = calculate_straight_distances(lat, lon, stops_index['lat'][candidates], stops_index['lon'][candidates], radius)
+
+	return candidates[distances <= distance], distances[distances <= distance]
+
+
+def get_stops_pairs_in_boxes(stops_index, lat_array, lon_array, cutoff):
+	"""Find the stops strictly closer than the cutoff (in degrees) on both axes to each of many positions.
+
+	Returns:
+		The array of the position indices and the array of the stop indices of every position and stop pair.
+
+	"""
+
+	import numpy
+
+	lat_array = numpy.asarray(lat_array, dtype=numpy.float64)
+	lon_array = numpy.asarray(lon_array, dtype=numpy.float64)
+
+	if len(stops_index['lat']) == 0:
+		return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+
+	cell_size = stops_index['cell_size']
+	rows = numpy.floor(lat_array / cell_size).astype(numpy.int64)
+	columns = numpy.floor(lon_array / cell_size).astype(numpy.int64)
+	span = int(math.ceil(cutoff / cell_size))
+
+	points_list = []
+	stops_list = []
+	for row_offset in range(-span, span + 1):
+		for column_offset in range(-span, span + 1):
+
+			# Find the slice of the stops order for this neighbour cell of every position
+			keys = get_cell_keys(rows + row_offset, columns + column_offset)
+			positions = numpy.searchsorted(stops_index['cell_keys'], keys)
+			positions = numpy.minimum(positions, len(stops_index['cell_keys']) - 1)
+			found = stops_index['cell_keys'][positions] == keys
+			starts = stops_index['cell_starts'][positions][found]
+			counts = stops_index['cell_ends'][positions][found] - starts
+
+			# Expand the slices into one pair per position and stop
+			points = numpy.repeat(numpy.nonzero(found)[0], counts)
+			offsets = numpy.arange(len(points)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+			points_list.append(points)
+			stops_list.append(stops_index['order'][numpy.repeat(starts, counts) + offsets])
+
+	points = numpy.concatenate(points_list)
+	stops = numpy.concatenate(stops_list)
+
+	stops_lat = stops_index['lat'][stops]
+	stops_lon = stops_index['lon'][stops]
+	in_box = ((lat_array[points] < stops_lat + cutoff) & (lat_array[points] > stops_lat - cutoff)
+		& (lon_array[points] < stops_lon + cutoff) & (lon_array[points] > stops_lon - cutoff))
+
+	return points[in_box], stops[in_box]
+
+
+def get_closest_stop_index(stops_index, lat, lon, radius):
+	"""Find the closest stop to a position, the first one in the stops list if many are equally close.
+
+	Returns:
+		The index of the stop, or None if there are no stops.
+
+	"""
+
+	import numpy
+
+	if len(stops_index['lat']) == 0:
+		return None
+
+	# Look in growing squares around the position until there is a stop
+	cutoff = stops_index['cell_size']
+	candidates = get_stops_indices_in_box(stops_index, lat, lon, cutoff)
+	while len(candidates) == 0:
+		cutoff = cutoff * 2
+		candidates = get_stops_indices_in_box(stops_index, lat, lon, cutoff)
+
+	# A closer stop can be outside the square, but not further away than the closest one in it
+	least_distance = float(calculate_straight_distances(lat, lon,
+		stops_index['lat'][candidates], stops_index['lon'][candidates], radius).min())
+	lat_cutoff, lon_cutoff = get_degrees_cutoffs(lat, least_distance, radius)
+	candidates = get_stops_indices_in_box(stops_index, lat, lon, lat_cutoff*1.01 + 1e-9, lon_cutoff*1.01 + 1e-9)
+
+	distances = calculate_straight_distances(lat, lon, stops_index['lat'][candidates], stops_index['lon'][candidates], radius)
+
+	return int(candidates[int(numpy.argmin(distances))])
+
+
+def get_degrees_cutoffs(lat, distance, radius):
+	"""Turn a distance in km into the latitude and longitude degrees it can span around a position."""
+
+	lat_cutoff = distance * 180 / (math.pi * radius)
+	lon_cutoff = lat_cutoff / max(math.cos(min(abs(lat) + lat_cutoff, 90) * math.pi/180), 0.01)
+
+	return lat_cutoff, lon_cutoff
+
+
+def parse_arguments(argv):
+	"""Split the command line into the positional arguments and a dictionary of --name=value options."""
+
+	arguments = []
+	options = {}
+
+	for argument in argv:
+		if argument.startswith("--"):
+			name, _, value = argument[2:].partition("=")
+			options[name] = value if value else True
+		else:
+			arguments.append(argument)
+
+	return arguments, options
+
+
 
 # ===============================================
 # =					File IO 					=
@@ -118,259 +424,270 @@ def create_agencies_folder(directory):
 def read_routes_file(directory):
 	"""Opens routes file and reads contents into a list."""
 
-	# read the file and split the rows into a list
-	try:
-		routes_file = open(directory + "/routes.csv","r+")
-	except FileNotFoundError:
-		print("Error: Routes file missing for this city!")
-		sys.exit()
+	return list(iterate_routes_file(directory))
 
-	routes_list_csv = routes_file.read().split("\n")
-	routes_file.close()
 
-	# split every row into a route entry by applying read_route_entry
-	routes_map = map(read_route_entry, routes_list_csv)
-	# filter out first (header) and last (empty) lines
-	routes_list = list(filter(lambda x: x != None, routes_map))
+def read_stops_file(directory):
+	"""Opens stops file and reads contents into a list."""
 
-	return routes_list
+	return list(iterate_stops_file(directory))
 
 
-def read_stops_file(directory):
-	"""Opens stops file and reads contents into a list."""
+def read_connections_file(directory):
+	"""Opens connections file and reads contents into a list."""
 
-	# read the file and split the rows into a list
-	try:
-		stops_file = open(directory + "/stops.csv","r+")
-	except FileNotFoundError:
-		print("Error: Stops file missing for this city!")
-		sys.exit()
+	return list(iterate_connections_file(directory))
 
-	stops_list_csv = stops_file.read().split("\n")
-	stops_file.close()
 
-	# split every row into a stop entry by applying read_stop_entry
-	stops_map = map(read_stop_entry, stops_list_csv)
-	# filter out first (header) and last (empty) lines
-	stops_list = list(filter(lambda x: x != None, stops_map))
+def read_demographics_file(directory):
+	"""Opens demographics file and reads contents into a list."""
 
-	return stops_list
+	return list(iterate_demographics_file(directory))
 
 
-def read_connections_file(directory):
-	"""Opens connections file and reads contents into a list."""
+def read_poi_file(directory):
+	"""Opens points of interest file and reads contents into a list."""
 
-	# read the file and split the rows into a list
-	try:
-		connections_file = open(directory + "/connections.csv","r+")
-	except FileNotFoundError:
-		print("Error: Connections file missing for this city!")
-		sys.exit()
+	return list(iterate_poi_file(directory))
 
-	connections_list_csv = connections_file.read().split("\n")
-	connections_file.close()
 
-	# split every row into a connection entry by applying read_connection_entry
-	connections_map = map(read_connection_entry, connections_list_csv)
-	# filter out first (header) and last (empty) lines
-	connections_list = list(filter(lambda x: x != None, connections_map))
+def iterate_routes_file(directory):
+	"""Opens routes file and reads it one route at a time."""
 
-	return connections_list
+	return iterate_csv_file(directory + "/routes.csv", read_route_entry, "Routes")
 
 
-def read_demographics_file(directory):
-	"""Opens demographics file and reads contents into a list."""
+def iterate_stops_file(directory):
+	"""Opens stops file and reads it one stop at a time."""
+
+	return iterate_csv_file(directory + "/stops.csv", read_stop_entry, "Stops")
+
+
+def iterate_connections_file(directory):
+	"""Opens connections file and reads it one connection at a time."""
+
+	return iterate_csv_file(directory + "/connections.csv", read_connection_entry, "Connections")
+
+
+def iterate_demographics_file(directory):
+	"""Opens demographics file and reads it one sector at a time."""
+
+	return iterate_csv_file(directory + "/demographics.csv", read_sector_entry, "Demographics")
+
+
+def iterate_poi_file(directory):
+	"""Opens points of interest file and reads it one point of interest at a time."""
+
+	return iterate_csv_file(directory + "/poi.csv", read_poi_entry, "Points of interest")
+
+
+def iterate_csv_file(path, read_entry, name):
+	"""Open a CSV file and parse it one row at a time, so that memory stays flat for any file size.
+
+	The file is opened right away, so a missing file stops the program when this is called
+	and not at the first row.
+
+	Args:
+		path: The path of the CSV file.
+		read_entry: The function that parses a row (list of values) into dictionary form.
+		name: The name of the file contents, for the error message.
+
+	Returns:
+		A generator of the parsed entries, without the header and empty rows.
+
+	"""
 
-	# read the file and split the rows into a list
 	try:
-		demographics_file = open(directory + "/demographics.csv","r+")
+		csv_file = open(path, "r", newline="", encoding="utf-8")
 	except FileNotFoundError:
-		print("Error: Demographics file missing for this city!")
+		print("Error: " + name + " file missing for this city!")
 		sys.exit()
 
-	sectors_list_csv = demographics_file.read().split("\n")
-	demographics_file.close()
+	return read_csv_entries(csv_file, read_entry)
 
-	# split every row into a sector entry by applying read_sector_entry
-	sectors_map = map(read_sector_entry, sectors_list_csv)
-	# filter out first (header) and last (empty) lines
-	sectors_list = list(filter(lambda x: x != None, sectors_map))
 
-	return sectors_list
+def read_csv_entries(csv_file, read_entry):
+	"""Parse the rows of an open CSV file after the header, closing it at the end."""
 
+	with csv_file:
+		rows = csv.reader(csv_file)
 
-def read_poi_file(directory):
-	"""Opens points of interest file and reads contents into a list."""
+		# skip the header
+		next(rows, None)
+
+		for row in rows:
+			if row:
+				yield read_entry(row)
+
+
+def read_fingerprints_file(directory):
+	"""Opens route fingerprints file and reads contents into a dictionary of route tags to fingerprints.
+
+	Unlike the network files, a missing fingerprints file is not an error (nothing was built yet).
+
+	"""
+
+	if not os.path.isfile(directory + "/fingerprints.csv"):
+		return {}
+
+	return dict(iterate_csv_file(directory + "/fingerprints.csv", lambda row: (row[0], row[2]), "Fingerprints"))
+
+
+def read_checkpoint_file(directory):
+	"""Opens the checkpoint file and reads the name of the last stage that was saved, or None if there is none
+	or the network files were written again since (by another command)."""
 
-	# read the file and split the rows into a list
 	try:
-		poi_file = open(directory + "/poi.csv","r+")
+		checkpoint_file = open(directory + "/checkpoint.txt","r+")
 	except FileNotFoundError:
-		print("Error: Points of interest file missing for this city!")
-		sys.exit()
+		return None
 
-	poi_list_csv = poi_file.read().split("\n")
-	poi_file.close()
+	lines = checkpoint_file.read().split("\n")
+	checkpoint_file.close()
 
-	# split every row into a sector entry by applying read_sector_entry
-	poi_map = map(read_poi_entry, poi_list_csv)
-	# filter out first (header) and last (empty) lines
-	poi_list = list(filter(lambda x: x != None, poi_map))
+	if len(lines) < 2 or lines[1].strip() != get_network_files_stamp(directory):
+		return None
 
-	return poi_list
+	return lines[0].strip()
 	
 	
-def read_route_entry(route_text):
-	"""Parses a route entry from comma-separated to dictionary form."""
+def read_route_entry(route_row):
+	"""Parses a route entry from a CSV row to dictionary form."""
 	
-	# split comma-separated values
-	route_list = route_text.split(",")
-
-	# handle invalid lines
-	if len(route_list) > 1 and route_list[0] != "tag":
-		return {
-			"tag": route_list[0],
-			"api": route_list[1],
-			"stops_count": int(route_list[2]),
-			"wait_time_mean": float(route_list[3]),
-			"wait_time_std": float(route_list[4])}
-	else:
-		return None
+	return {
+		"tag": route_row[0],
+		"api": route_row[1],
+		"stops_count": int(route_row[2]),
+		"wait_time_mean": float(route_row[3]),
+		"wait_time_std": float(route_row[4])}
 
 	
-def read_stop_entry(stop_text):
-	"""Parses a stop entry from comma-separated to dictionary form."""
+def read_stop_entry(stop_row):
+	"""Parses a stop entry from a CSV row to dictionary form."""
 	
-	# split comma-separated values
-	stop_list = stop_text.split(",")
-
-	# handle invalid lines
-	if len(stop_list) > 1 and stop_list[0] != "tag":
-		return {
-			"tag": stop_list[0],
-			"title": stop_list[1],
-			"lat": stop_list[2],
-			"lon": stop_list[3],
-			"merged": stop_list[4].split("|")}
-	else:
-		return None
+	return {
+		"tag": stop_row[0],
+		"title": stop_row[1],
+		"lat": float(stop_row[2]),
+		"lon": float(stop_row[3]),
+		"merged": stop_row[4].split("|")}
 	
 	
-def read_connection_entry(connection_text):
-	"""Parses a connection entry from comma-separated to dictionary form."""
+def read_connection_entry(connection_row):
+	"""Parses a connection entry from a CSV row to dictionary form."""
 	
-	# split comma-separated values
-	connection_list = connection_text.split(",")
-
-	# handle invalid lines
-	if len(connection_list) > 1 and connection_list[0] != "from":
-		return {
-			"from": connection_list[0],
-			"to": connection_list[1],
-			"routes": connection_list[2].split("|"),
-			"length": float(connection_list[3]),
-			"road_length": float(connection_list[4]),
-			"travel_time": float(connection_list[5])}
-	else:
-		return None
+	return {
+		"from": connection_row[0],
+		"to": connection_row[1],
+		"routes": connection_row[2].split("|"),
+		"length": float(connection_row[3]),
+		"road_length": float(connection_row[4]),
+		"travel_time": float(connection_row[5])}
 	
 	
-def read_sector_entry(sector_text):
-	"""Parses a sector entry from comma-separated to dictionary form."""
+def read_sector_entry(sector_row):
+	"""Parses a sector entry from a CSV row to dictionary form."""
 	
-	# split comma-separated values
-	sector_list = sector_text.split(",")
-
-	# handle invalid lines
-	if len(sector_list) > 1 and sector_list[1] != "lat":
-		return {"id": sector_list[0],
-			"lat": float(sector_list[1]),
-			"lon": float(sector_list[2]),
-			"population": int(sector_list[3]),
-			"area": float(sector_list[4]),
-			"density": float(sector_list[5])}
-	else:
-		return None
+	return {"id": sector_row[0],
+		"lat": float(sector_row[1]),
+		"lon": float(sector_row[2]),
+		"population": int(sector_row[3]),
+		"area": float(sector_row[4]),
+		"density": float(sector_row[5])}
 	
 	
-def read_poi_entry(poi_text):
-	"""Parses a point of interest entry from comma-separated to dictionary form."""
+def read_poi_entry(poi_row):
+	"""Parses a point of interest entry from a CSV row to dictionary form."""
 	
-	# split comma-separated values
-	poi_list = poi_text.split(",")
-
-	# handle invalid lines
-	if len(poi_list) > 1 and poi_list[1] != "lat":
-		return {"type": poi_list[0],
-			"lat": float(poi_list[1]),
-			"lon": float(poi_list[2]),
-			"name": poi_list[3]}
-	else:
-		return None
+	return {"type": poi_row[0],
+		"lat": float(poi_row[1]),
+		"lon": float(poi_row[2]),
+		"name": poi_row[3]}
 
 
 def write_routes_file(directory, routes_list):
-	"""Creates a new or empties the existing routes file and fills it with the list of routes."""
-
-	# (Re)create empty routes file
-	create_agencies_folder(directory)
-	routes_file = open(directory + "/routes.csv", "w+")
-
-	# Write routes file
-	routes_file.write("tag,api,stops_count,wait_time_mean,wait_time_std\n")
-	for route in routes_list:
-		routes_file.write(
-			  route['tag'] + ","
-			+ route['api'] + ","
-			+ str(route['stops_count']) + ","
-			+ str(route['wait_time_mean']) + ","
-			+ str(route['wait_time_std']) + "\n" )
+	"""Creates a new or replaces the existing routes file with the list of routes."""
 
-	# Close the file
-	routes_file.close()
+	write_csv_file(directory + "/routes.csv", ["tag", "api", "stops_count", "wait_time_mean", "wait_time_std"],
+		((route['tag'], route['api'], route['stops_count'], route['wait_time_mean'], route['wait_time_std'])
+			for route in routes_list))
 
 
 def write_stops_file(directory, stops_list):
-	"""Creates a new or empties the existing stops file and fills it with the list of stops."""
-
-	# (Re)create empty stops file
-	create_agencies_folder(directory)
-	stops_file = open(directory + "/stops.csv", "w+")
-
-	# Write stops file
-	stops_file.write("tag,title,lat,lon,merged\n")
-	for stop in stops_list:
-		stops_file.write(
-			  stop['tag'] + ","
-			+ stop['title'] + ","
-			+ str(stop['lat']) + ","
-			+ str(stop['lon']) + ","
-			+ '|'.join(stop['merged']) + "\n" )
+	"""Creates a new or replaces the existing stops file with the list of stops."""
 
-	# Close the file
-	stops_file.close()
+	write_csv_file(directory + "/stops.csv", ["tag", "title", "lat", "lon", "merged"],
+		((stop['tag'], stop['title'], stop['lat'], stop['lon'], '|'.join(stop['merged']))
+			for stop in stops_list))
 
 
 def write_connections_file(directory, connections_list):
-	"""Creates a new or empties the existing connections file and fills it with the list of connections with distances."""
+	"""Creates a new or replaces the existing connections file with the list of connections with distances."""
 
-	# (Re)create empty connections file
-	connections_file = open(directory + "/connections.csv", "w+")
+	write_csv_file(directory + "/connections.csv", ["from", "to", "routes", "length", "road_length", "travel_time"],
+		((connection['from'], connection['to'], '|'.join(connection['routes']),
+			connection['length'], connection['road_length'], connection['travel_time'])
+			for connection in connections_list))
 
-	# Write connections file
-	connections_file.write("from,to,routes,length,road_length,travel_time\n")
-	for connection in connections_list:
-		connections_file.write(
-			  connection['from'] + ","
-			+ connection['to'] + ","
-			+ '|'.join(connection['routes']) + ","
-			+ str(connection['length']) + ","
-			+ str(connection['road_length']) + ","
-			+ str(connection['travel_time'])
-			+ "\n" )
 
-	# Close the file
-	connections_file.close()
+def write_fingerprints_file(directory, routes_list, fingerprints):
+	"""Creates a new or replaces the existing fingerprints file with the fingerprint of every route."""
+
+	write_csv_file(directory + "/fingerprints.csv", ["tag", "api", "fingerprint"],
+		((route['tag'], route['api'], fingerprints[route['tag']]) for route in routes_list))
+
+
+def write_csv_file(path, header, rows):
+	"""Write the rows of a CSV file all at once, through a temporary file.
+
+	The temporary file only replaces the existing one after it was completely written,
+	so a crash half-way never leaves a truncated file behind. Values that contain commas
+	(like stop titles) are quoted.
+
+	"""
+
+	create_agencies_folder(os.path.dirname(path) or ".")
+
+	temporary_path = path + "." + str(os.getpid()) + ".tmp"
+	with open(temporary_path, "w", newline="", encoding="utf-8") as csv_file:
+		writer = csv.writer(csv_file, lineterminator="\n")
+		writer.writerow(header)
+		writer.writerows(rows)
+
+	os.replace(temporary_path, path)
+
+
+def write_checkpoint_file(directory, stage):
+	"""Creates a new or empties the existing checkpoint file and writes the name of the last stage that was saved,
+	along with the stamp of the network files it saved."""
+
+	checkpoint_file = open(directory + "/checkpoint.txt", "w+")
+	checkpoint_file.write(stage + "\n" + get_network_files_stamp(directory) + "\n")
+	checkpoint_file.close()
+
+
+def get_network_files_stamp(directory):
+	"""Stamp the routes, stops and connections files with their inodes, sizes and modification times,
+	which all change when the files are written again."""
+
+	stamps = []
+	for name in ["routes", "stops", "connections"]:
+		try:
+			stat = os.stat(directory + "/" + name + ".csv")
+		except FileNotFoundError:
+			stamps.append("-")
+			continue
+
+		stamps.append(str(stat.st_ino) + ":" + str(stat.st_size) + ":" + str(stat.st_mtime_ns))
+
+	return ",".join(stamps)
+
+
+def remove_checkpoint_file(directory):
+	"""Removes the checkpoint file, once a run is complete."""
+
+	if os.path.isfile(directory + "/checkpoint.txt"):
+		os.remove(directory + "/checkpoint.txt")
 
 
 def write_metrics_file(city, metrics_text):
@@ -385,10 +702,406 @@ def write_metrics_file(city, metrics_text):
 	metrics_file.close()
 
 
+# ===============================================
+# =			Compact Network Model 				=
+# ===============================================
+
+class TagTable:
+	"""Interned tags, that give every tag a small integer id and back."""
+
+	__slots__ = ('tags', 'ids')
+
+	def __init__(self, tags=()):
+		self.tags = []
+		self.ids = {}
+		for tag in tags:
+			self.get_id(tag)
+
+	def get_id(self, tag):
+		"""Find the id of a tag, giving it the next free one if it's new."""
+
+		tag_id = self.ids.get(tag)
+		if tag_id is None:
+			tag_id = len(self.tags)
+			self.ids[tag] = tag_id
+			self.tags.append(sys.intern(tag))
+
+		return tag_id
+
+	def __len__(self):
+		return len(self.tags)
+
+
+class CompactNetwork:
+	"""The routes, stops and connections of a network as tables of NumPy columns that refer to each other by id.
+
+	Stop and route tags are interned once in stop_tags and route_tags, and every row of the
+	tables is the record of the id of the same index. The stops table has the titles, positions
+	and merged tags of the stops, the routes table their apis, stops counts and wait times (mean
+	and std), and the connections table the stop ids at both ends, the lengths, road lengths and
+	travel times and the route ids of every connection. The lists of every stop and connection
+	(merged tags, route ids) are one flat column of values plus a column of where every row starts.
+
+	The stops that only appear in connections get stop ids after the rows of the stops table,
+	and so do the routes that only appear in connections, after the rows of the routes table.
+
+	"""
+
+	__slots__ = ('stop_tags', 'route_tags', 'stops', 'routes', 'connections')
+
+	def __init__(self):
+		self.stop_tags = TagTable()
+		self.route_tags = TagTable()
+		self.stops = {}
+		self.routes = {}
+		self.connections = {}
+
+
+def create_compact_network(routes_list, stops_list, connections_list):
+	"""Convert the lists of routes, stops and connections from dictionary form to a CompactNetwork."""
+
+	import numpy
+
+	network = CompactNetwork()
+
+	# Actual stops and routes get the first ids, in order, so their ids are also their rows
+	network.stop_tags = TagTable([stop['tag'] for stop in stops_list])
+	network.route_tags = TagTable([route['tag'] for route in routes_list])
+
+	get_stop_id = network.stop_tags.get_id
+	get_route_id = network.route_tags.get_id
+
+	network.stops = {
+		'titles': numpy.array([stop['title'] for stop in stops_list], dtype=str),
+		'positions': numpy.array([(float(stop['lat']), float(stop['lon'])) for stop in stops_list],
+			dtype=numpy.float64).reshape(-1, 2),
+		'merged_offsets': get_offsets_array([stop['merged'] for stop in stops_list]),
+		'merged_tags': numpy.array([tag for stop in stops_list for tag in stop['merged']], dtype=str)}
+
+	network.routes = {
+		'apis': numpy.array([route['api'] for route in routes_list], dtype=str),
+		'stops_counts': numpy.array([route['stops_count'] for route in routes_list], dtype=numpy.int32),
+		'wait_times': numpy.array([(route['wait_time_mean'], route['wait_time_std']) for route in routes_list],
+			dtype=numpy.float64).reshape(-1, 2)}
+
+	network.connections = {
+		'stops': numpy.array([(get_stop_id(connection['from']), get_stop_id(connection['to']))
+			for connection in connections_list], dtype=numpy.int32).reshape(-1, 2),
+		'lengths': numpy.array([connection['length'] for connection in connections_list], dtype=numpy.float64),
+		'road_lengths': numpy.array([connection['road_length'] for connection in connections_list], dtype=numpy.float64),
+		'travel_times': numpy.array([connection['travel_time'] for connection in connections_list], dtype=numpy.float64),
+		'routes_offsets': get_offsets_array([connection['routes'] for connection in connections_list]),
+		'routes': numpy.array([get_route_id(route) for connection in connections_list
+			for route in connection['routes']], dtype=numpy.int32)}
+
+	return network
+
+
+def convert_compact_network_to_lists(network):
+	"""Convert a CompactNetwork back to the lists of routes, stops and connections in dictionary form."""
+
+	stop_tags = network.stop_tags.tags
+	route_tags = network.route_tags.tags
+
+	merged_tags = network.stops['merged_tags'].tolist()
+	merged_offsets = network.stops['merged_offsets'].tolist()
+	stops_list = [{'tag': stop_tags[index],
+			'title': title,
+			'lat': lat,
+			'lon': lon,
+			'merged': merged_tags[merged_offsets[index]:merged_offsets[index + 1]]}
+		for index, (title, (lat, lon)) in enumerate(zip(network.stops['titles'].tolist(), network.stops['positions'].tolist()))]
+
+	routes_list = [{'tag': route_tags[index],
+			'api': api,
+			'stops_count': stops_count,
+			'wait_time_mean': wait_time_mean,
+			'wait_time_std': wait_time_std}
+		for index, (api, stops_count, (wait_time_mean, wait_time_std)) in enumerate(zip(
+			network.routes['apis'].tolist(), network.routes['stops_counts'].tolist(), network.routes['wait_times'].tolist()))]
+
+	connection_routes = network.connections['routes'].tolist()
+	routes_offsets = network.connections['routes_offsets'].tolist()
+	connections_list = [{'from': stop_tags[from_id],
+			'to': stop_tags[to_id],
+			'routes': [route_tags[route_id] for route_id in connection_routes[routes_offsets[index]:routes_offsets[index + 1]]],
+			'length': length,
+			'road_length': road_length,
+			'travel_time': travel_time}
+		for index, ((from_id, to_id), length, road_length, travel_time) in enumerate(zip(
+			network.connections['stops'].tolist(), network.connections['lengths'].tolist(),
+			network.connections['road_lengths'].tolist(), network.connections['travel_times'].tolist()))]
+
+	return routes_list, stops_list, connections_list
+
+
+def read_compact_network(directory):
+	"""Read the network of an agency as a CompactNetwork, memory-mapped from the network arrays
+	if they are up to date and converted from the CSV files otherwise."""
+
+	network = read_network_arrays(directory)
+	if network is not None:
+		return network
+
+	return create_compact_network(read_routes_file(directory), read_stops_file(directory), read_connections_file(directory))
+
+
+def get_offsets_array(lists_list):
+	"""Find where every list starts (and the last one ends) when all the lists are put one after the other."""
+
+	import numpy
+
+	offsets = numpy.zeros(len(lists_list) + 1, dtype=numpy.int32)
+	numpy.cumsum([len(values) for values in lists_list], out=offsets[1:])
+
+	return offsets
+
+
+
+# ===============================================
+# =				Network Arrays 					=
+# ===============================================
+
+def write_network_arrays(directory, routes_list, stops_list, connections_list):
+	"""Save the columns of the CompactNetwork of the network as NumPy arrays next to the CSV files,
+	in the arrays folder of the agency.
+
+	Every column is saved as <table>_<column>.npy (connection_travel_times.npy, for the travel_times
+	of the connections table), next to stop_tags.npy and route_tags.npy with the tags by id.
+
+	"""
+
+	arrays_directory = directory + "/arrays"
+	create_agencies_folder(arrays_directory)
+
+	for name, array in get_network_arrays(create_compact_network(routes_list, stops_list, connections_list)).items():
+		write_array_file(arrays_directory + "/" + name + ".npy", array)
+
+
+def get_network_arrays(network):
+	"""Get the columns of a CompactNetwork (and its tags) by the names of their array files."""
+
+	import numpy
+
+	arrays = {'stop_tags': numpy.array(network.stop_tags.tags, dtype=str),
+		'route_tags': numpy.array(network.route_tags.tags, dtype=str)}
+
+	for prefix, table in [("stop", network.stops), ("route", network.routes), ("connection", network.connections)]:
+		for column, array in table.items():
+			arrays[prefix + "_" + column] = array
+
+	return arrays
+
+
+def read_network_arrays(directory):
+	"""Memory-map the NumPy columns of the network as a CompactNetwork, so that loading is
+	instant and processes share the pages.
+
+	Returns:
+		A CompactNetwork over the read-only arrays, or None if the arrays are missing
+		or older than the CSV files (and the CSV files should be read instead).
+
+	"""
+
+	import numpy
+
+	arrays_directory = directory + "/arrays"
+	tables = {'stop': ['titles', 'positions', 'merged_offsets', 'merged_tags'],
+		'route': ['apis', 'stops_counts', 'wait_times'],
+		'connection': ['stops', 'lengths', 'road_lengths', 'travel_times', 'routes_offsets', 'routes']}
+	names_list = ['stop_tags', 'route_tags'] + [prefix + "_" + column for prefix, columns in tables.items() for column in columns]
+
+	try:
+		arrays_time = min([os.path.getmtime(arrays_directory + "/" + name + ".npy") for name in names_list])
+		csv_time = max([os.path.getmtime(directory + "/" + name + ".csv") for name in ["routes", "stops", "connections"]])
+	except FileNotFoundError:
+		return None
+
+	if arrays_time < csv_time:
+		return None
+
+	arrays = {name: numpy.load(arrays_directory + "/" + name + ".npy", mmap_mode="r") for name in names_list}
+
+	# Only the tags are read into memory, for the tag to id mappings
+	network = CompactNetwork()
+	network.stop_tags = TagTable(arrays['stop_tags'].tolist())
+	network.route_tags = TagTable(arrays['route_tags'].tolist())
+	network.stops = {column: arrays["stop_" + column] for column in tables['stop']}
+	network.routes = {column: arrays["route_" + column] for column in tables['route']}
+	network.connections = {column: arrays["connection_" + column] for column in tables['connection']}
+
+	return network
+
+
+def read_network_files(directory):
+	"""Read the lists of routes, stops and connections, from the network arrays if they are up to date."""
+
+	network = read_network_arrays(directory)
+	if network is not None:
+		return convert_compact_network_to_lists(network)
+
+	return read_routes_file(directory), read_stops_file(directory), read_connections_file(directory)
+
+
+def write_array_file(path, array):
+	"""Save a NumPy array through a temporary file, like write_csv_file, so that a crash half-way
+	never leaves a truncated array behind (memory-mapped by the readers)."""
+
+	import numpy
+
+	temporary_path = path + "." + str(os.getpid()) + ".tmp"
+	with open(temporary_path, "wb") as array_file:
+		numpy.save(array_file, array)
+
+	os.replace(temporary_path, path)
+
+
+
+# ===============================================
+# =				Demographics Index 				=
+# ===============================================
+
+def create_demographics_index(path):
+	"""Build a spatial index of a national demographics file, saved as NumPy arrays next to it.
+
+	Sectors are sorted by the 1x1 degree cell they are in, so that the sectors of any
+	range of cells in a row of the grid are one contiguous slice of the arrays.
+
+	"""
+
+	import numpy
+
+	index_directory = os.path.splitext(path)[0] + "_index"
+	create_agencies_folder(index_directory)
+
+	# Some sectors have no known position (#N/A), they can't be in any city
+	sectors_list = [sector for sector in iterate_csv_file(path, read_national_sector_entry, "National demographics")
+		if sector is not None]
+
+	cell_keys = numpy.array([get_demographics_cell_key(sector['lat'], sector['lon']) for sector in sectors_list], dtype=numpy.int64)
+	order = numpy.argsort(cell_keys, kind="stable")
+
+	arrays = {
+		'ids': numpy.array([sector['id'] for sector in sectors_list], dtype=str)[order],
+		'positions': numpy.array([(sector['lat'], sector['lon']) for sector in sectors_list], dtype=numpy.float64).reshape(-1, 2)[order],
+		'populations': numpy.array([sector['population'] for sector in sectors_list], dtype=numpy.int64)[order],
+		'areas': numpy.array([sector['area'] for sector in sectors_list], dtype=numpy.float64)[order],
+		'densities': numpy.array([sector['density'] for sector in sectors_list], dtype=numpy.float64)[order],
+		'cell_keys': cell_keys[order]}
+
+	for name, array in arrays.items():
+		write_array_file(index_directory + "/" + name + ".npy", array)
+
+
+def read_demographics_index(path):
+	"""Memory-map the spatial index of a national demographics file, building it first if it's missing or outdated."""
+
+	import numpy
+
+	index_directory = os.path.splitext(path)[0] + "_index"
+	names_list = ['ids', 'positions', 'populations', 'areas', 'densities', 'cell_keys']
+
+	try:
+		index_time = min([os.path.getmtime(index_directory + "/" + name + ".npy") for name in names_list])
+	except FileNotFoundError:
+		index_time = None
+
+	if index_time is None or index_time < os.path.getmtime(path):
+		create_demographics_index(path)
+
+	return {name: numpy.load(index_directory + "/" + name + ".npy", mmap_mode="r") for name in names_list}
+
+
+def read_national_sector_entry(sector_row):
+	"""Parses a sector entry of the national demographics, or returns None if it has missing values."""
+
+	try:
+		return read_sector_entry(sector_row)
+	except ValueError:
+		return None
+
+
+def get_demographics_cell_key(lat, lon):
+	"""Number the 1x1 degree cell of a position, so that the cells of a grid row have consecutive keys."""
+
+	return (math.floor(lat) + 90) * 360 + (math.floor(lon) + 180)
+
+
+def get_sectors_in_box(demographics_index, bottom, top, left, right):
+	"""Find the sectors of the demographics index within a bounding box, in dictionary form."""
+
+	import numpy
+
+	cell_keys = demographics_index['cell_keys']
+	positions = demographics_index['positions']
+
+	# Slices of the cells of every grid row that the box covers
+	rows_list = []
+	for lat_cell in range(math.floor(bottom), math.floor(top) + 1):
+		first = numpy.searchsorted(cell_keys, get_demographics_cell_key(lat_cell, left), side="left")
+		last = numpy.searchsorted(cell_keys, get_demographics_cell_key(lat_cell, right), side="right")
+		rows_list.extend(range(first, last))
+
+	rows = numpy.array(rows_list, dtype=numpy.int64)
+	if len(rows) > 0:
+		in_box = ((positions[rows, 0] >= bottom) & (positions[rows, 0] <= top)
+			& (positions[rows, 1] >= left) & (positions[rows, 1] <= right))
+		rows = rows[in_box]
+
+	return [{'id': str(demographics_index['ids'][row]),
+			'lat': float(positions[row, 0]),
+			'lon': float(positions[row, 1]),
+			'population': int(demographics_index['populations'][row]),
+			'area': float(demographics_index['areas'][row]),
+			'density': float(demographics_index['densities'][row])}
+		for row in rows.tolist()]
+
+
+def write_demographics_file(directory, sectors_list):
+	"""Creates a new or replaces the existing demographics file with the list of sectors."""
+
+	write_csv_file(directory + "/demographics.csv", ["zipcode", "lat", "lon", "population", "land", "density"],
+		((sector['id'], sector['lat'], sector['lon'], sector['population'], sector['area'], sector['density'])
+			for sector in sectors_list))
+
+
+
 # ===============================================
 # =				Graph manipulation				=
 # ===============================================
 
+def create_network_index(routes_list, stops_list, connections_list):
+	"""Index the network once, so that the connections of a route or a stop don't need a scan of the whole network.
+
+	Returns:
+		A dictionary with the routes and stops by tag, the connections by (from, to) stops,
+		the connections of every route and stop, and the set of routes of every connection.
+
+	"""
+
+	network_index = {
+		'routes': {route['tag']: route for route in routes_list},
+		'stops': {stop['tag']: stop for stop in stops_list},
+		'connections': {},
+		'route_connections': {route['tag']: [] for route in routes_list},
+		'stop_connections': {stop['tag']: [] for stop in stops_list},
+		'connection_routes': {}}
+
+	for connection in connections_list:
+		key = (connection['from'], connection['to'])
+
+		network_index['connections'][key] = connection
+		network_index['connection_routes'][key] = set(connection['routes'])
+
+		for route in connection['routes']:
+			network_index['route_connections'].setdefault(route, []).append(connection)
+
+		network_index['stop_connections'].setdefault(connection['from'], []).append(connection)
+		network_index['stop_connections'].setdefault(connection['to'], []).append(connection)
+
+	return network_index
+
+
 def convert_stops_to_tuples(stops_list):
 	"""Convert the list of stops from list to tuple format."""
 
@@ -418,11 +1131,203 @@ def convert_stops_to_positions(stops_list):
 
 
 def convert_connections_to_tuples(connections_list):
-	"""Convert the list of connections from list to tuple format."""
+	"""Convert the list of connections from list to tuple format, keeping the full connection on the edge."""
 
-	map_func = lambda x: (x['from'], x['to'], {'routes':x['routes'], 'length': x['length']} )
+	map_func = lambda x: (x['from'], x['to'], {'routes':x['routes'], 'length': x['length'],
+		'road_length': x['road_length'], 'travel_time': x['travel_time'], 'connection': x} )
 
 	return list(map(map_func, connections_list))
 
 
+def create_routing_network(network):
+	"""Compile the connections of a CompactNetwork into a CSR adjacency of stop ids, for fast shortest path searches.
+
+	Returns:
+		A dictionary with the stops count, the CSR index pointers and neighbours arrays, the sorted
+		(from id * stops count + to id) keys of the edges and the connection ids in the same order.
+
+	"""
+
+	import numpy
+
+	stops_count = len(network.stop_tags)
+	from_ids = network.connections['stops'][:, 0]
+	to_ids = network.connections['stops'][:, 1]
+
+	# The last connection between two stops wins, as in the directed network, and the edges are sorted by stops
+	keys = from_ids.astype(numpy.int64) * stops_count + to_ids
+	_, last = numpy.unique(keys[::-1], return_index=True)
+	order = len(keys) - 1 - last
+
+	return {'stops_count': stops_count,
+		'indptr': numpy.searchsorted(from_ids[order], numpy.arange(stops_count + 1)).astype(numpy.int32),
+		'indices': numpy.asarray(to_ids[order], dtype=numpy.int32),
+		'keys': keys[order],
+		'connections': order}
+
+
+def get_connection_ids(routing_network, stop_ids):
+	"""Find the ids of the connections between every two consecutive stops of a sequence of stop ids."""
+
+	import numpy
+
+	stop_ids = numpy.asarray(stop_ids, dtype=numpy.int64)
+	keys = stop_ids[:-1] * routing_network['stops_count'] + stop_ids[1:]
+
+	return routing_network['connections'][numpy.searchsorted(routing_network['keys'], keys)]
+
+
+# ===============================================
+# =				Journey Planning				=
+# ===============================================
+
+def create_route_slots(network, routing_network):
+	"""Compile every route into its own copy of the stops it serves (slots), for plan_journeys.
+
+	Riding a route is moving along the connections between its slots, so a route can branch
+	or loop freely. Routes without a known wait time can't be planned with and are left out.
+
+	Returns:
+		A dictionary with the stop id, route id and expected wait (half the mean headway) of every
+		slot, and the CSR index pointers, neighbours and travel times of the connections between slots.
+
+	"""
+
+	import numpy
+
+	from_ids = numpy.repeat(numpy.arange(routing_network['stops_count']), numpy.diff(routing_network['indptr'])).tolist()
+
+	routes_offsets = network.connections['routes_offsets'].tolist()
+	connection_routes = network.connections['routes'].tolist()
+	travel_times = network.connections['travel_times'].tolist()
+	wait_times = network.routes['wait_times'][:, 0]
+	known_wait_times = (wait_times != -1).tolist()
+
+	slots = {}
+	edges = []
+	for from_id, to_id, connection in zip(from_ids, routing_network['indices'].tolist(), routing_network['connections'].tolist()):
+		for route in connection_routes[routes_offsets[connection]:routes_offsets[connection + 1]]:
+			if route < len(known_wait_times) and known_wait_times[route]:
+				from_slot = slots.setdefault((route, from_id), len(slots))
+				to_slot = slots.setdefault((route, to_id), len(slots))
+				edges.append((from_slot, to_slot, travel_times[connection]))
+
+	edges.sort()
+	routes_array = numpy.array([route for route, stop_id in slots], dtype=numpy.int32)
+
+	return {'stops': numpy.array([stop_id for route, stop_id in slots], dtype=numpy.int32),
+		'routes': routes_array,
+		'waits': numpy.asarray(wait_times[routes_array], dtype=numpy.float64)/2,
+		'indptr': numpy.searchsorted(numpy.array([edge[0] for edge in edges], dtype=numpy.int32),
+			numpy.arange(len(slots) + 1)).astype(numpy.int32),
+		'indices': numpy.array([edge[1] for edge in edges], dtype=numpy.int32),
+		'times': numpy.array([edge[2] for edge in edges], dtype=numpy.float64)}
+
+
+def plan_journeys(route_slots, stops_count, origin_id, max_rounds=8):
+	"""Find the earliest arrival at every stop from an origin, for every number of rides, RAPTOR-style.
+
+	Round k boards every route at the stops improved in round k-1, waiting half the route headway,
+	and rides all of them at once, as one search over the slots from a source boarding them all.
+
+	Returns:
+		A dictionary with the arrival times array of every round (from round 0, only the origin), the slot
+		every stop improved in that round was reached at (-1 where it kept the arrival of the previous round)
+		and the predecessor of every slot on its ride (the source, len(slots), for boarding slots).
+
+	"""
+
+	import numpy
+	from scipy.sparse import csr_matrix
+	from scipy.sparse.csgraph import dijkstra
+
+	slot_stops = route_slots['stops']
+	slots_count = len(slot_stops)
+
+	best = numpy.full(stops_count, numpy.inf)
+	best[origin_id] = 0.0
+	marked = numpy.zeros(stops_count, dtype=bool)
+	marked[origin_id] = True
+	labels = {'arrivals': [best.copy()], 'alights': [], 'predecessors': []}
+
+	for _ in range(0, max_rounds):
+
+		# Board every route at the stops improved in the last round
+		boarding = numpy.nonzero(marked[slot_stops])[0]
+		if len(boarding) == 0:
+			break
+
+		# Built from the arrays directly, so that zero time connections are kept as edges
+		matrix = csr_matrix((numpy.concatenate((route_slots['times'], best[slot_stops[boarding]] + route_slots['waits'][boarding])),
+			numpy.concatenate((route_slots['indices'], boarding)),
+			numpy.append(route_slots['indptr'], len(route_slots['indices']) + len(boarding))),
+			shape=(slots_count + 1, slots_count + 1))
+		distances, predecessors = dijkstra(matrix, indices=slots_count, return_predecessors=True)
+
+		slot_times = distances[:slots_count]
+		arrivals = numpy.full(stops_count, numpy.inf)
+		numpy.minimum.at(arrivals, slot_stops, slot_times)
+
+		marked = arrivals < best
+		if not marked.any():
+			break
+		best[marked] = arrivals[marked]
+
+		# The first slot every improved stop was reached at
+		hits = numpy.nonzero(marked[slot_stops] & (slot_times == arrivals[slot_stops]))[0]
+		hit_stops, first = numpy.unique(slot_stops[hits], return_index=True)
+
+		alights = numpy.full(stops_count, -1, dtype=numpy.int32)
+		alights[hit_stops] = hits[first]
+
+		labels['arrivals'].append(best.copy())
+		labels['alights'].append(alights)
+		labels['predecessors'].append(predecessors.astype(numpy.int32))
+
+	return labels
+
+
+def get_journey(route_slots, labels, destination_id, max_transfers=None):
+	"""Get the journey with the earliest arrival at a stop, and the fewest rides among those.
+
+	With max_transfers, the earliest journey with at most that many transfers, so going through the
+	values gives the journeys that are optimal in both arrival time and transfers.
+
+	Returns:
+		The list of the legs of the journey, each a (route id, stop ids, wait time) tuple, or None if there is no journey.
+
+	"""
+
+	arrivals = labels['arrivals']
+	last_round = len(arrivals) - 1
+	if max_transfers is not None:
+		last_round = min(last_round, max_transfers + 1)
+
+	arrival = arrivals[last_round][destination_id]
+	if arrival == float('inf'):
+		return None
+
+	rides = min([ride for ride in range(0, last_round + 1) if arrivals[ride][destination_id] == arrival])
+
+	# Walk back the rounds from the destination, and every ride back to its boarding slot
+	source = len(route_slots['stops'])
+	legs = []
+	stop_id = destination_id
+	while rides > 0:
+		slot = labels['alights'][rides - 1][stop_id]
+		if slot != -1:
+			predecessors = labels['predecessors'][rides - 1]
+			slots = [int(slot)]
+			while predecessors[slots[-1]] != source:
+				slots.append(int(predecessors[slots[-1]]))
+			slots.reverse()
+
+			legs.append((int(route_slots['routes'][slots[0]]), route_slots['stops'][slots].tolist(),
+				float(route_slots['waits'][slots[0]])))
+			stop_id = int(route_slots['stops'][slots[0]])
+		rides = rides - 1
+
+	return legs[::-1]
+
+
 
@@ -0,0 +1,142 @@
+"""Tests of the road distance lookups of the builder against a local stand-in for the OSRM API."""
+
+import os, sys, json, shutil, tempfile, threading, unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import builder
+
+
+# Points the stand-in has no road route to, and points it fails on with an error page
+unroutable_point = "0.0,0.0"
+broken_point = "9.0,9.0"
+
+
+def get_leg_distance(point_1, point_2):
+	"""Road distance in meters the stand-in answers between two "lon,lat" points."""
+
+	lon_1, lat_1 = [float(value) for value in point_1.split(",")]
+	lon_2, lat_2 = [float(value) for value in point_2.split(",")]
+
+	return round((abs(lon_2 - lon_1) + abs(lat_2 - lat_1)) * 111000, 3)
+
+
+class OSRMHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+
+		waypoints = urlsplit(self.path).path.split("/")[-1].split(";")
+		self.server.requested_waypoints.append(waypoints)
+
+		if broken_point in waypoints:
+			self.send_response(502)
+			self.end_headers()
+			self.wfile.write(b"<html>Bad Gateway</html>")
+			return
+
+		if unroutable_point in waypoints:
+			self.send_response(400)
+			body = {'code': "NoRoute", 'message': "Impossible route between points"}
+		else:
+			self.send_response(200)
+			body = {'code': "Ok", 'routes': [{'legs': [{'distance': get_leg_distance(point_1, point_2)}
+				for point_1, point_2 in zip(waypoints, waypoints[1:])]}]}
+
+		self.send_header("Content-Type", "application/json")
+		self.end_headers()
+		self.wfile.write(json.dumps(body).encode("utf-8"))
+
+	def log_message(self, *args):
+		pass
+
+
+def create_stop(tag, point):
+
+	lon, lat = point.split(",")
+	return {'tag': tag, 'lon': float(lon), 'lat': float(lat)}
+
+
+class DistanceAPITest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+
+		cls.server = HTTPServer(("127.0.0.1", 0), OSRMHandler)
+		cls.server.requested_waypoints = []
+		threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+	@classmethod
+	def tearDownClass(cls):
+
+		cls.server.shutdown()
+		cls.server.server_close()
+
+	def setUp(self):
+
+		self.server.requested_waypoints.clear()
+		self.cache_directory = tempfile.mkdtemp()
+
+		builder.distance_api_base = "http://127.0.0.1:" + str(self.server.server_port) + "/route/v1/driving/"
+		builder.cache_directory = self.cache_directory
+		builder.offline_mode = False
+		builder.requests_per_second = 0
+		builder.retry_delay = 0
+		builder.request_retries = 1
+		builder.max_concurrent_requests = 1
+		builder.http_session = None
+
+	def tearDown(self):
+
+		shutil.rmtree(self.cache_directory)
+
+	def test_pairs_are_packed_and_looked_up_once(self):
+
+		a, b, c = create_stop("a", "1.0,1.0"), create_stop("b", "1.001,1.0"), create_stop("c", "1.001,1.002")
+
+		# b-a and c-b are the same pairs as a-b and b-c in the other direction
+		distances = builder.call_distance_API([a, b, b, c], [b, c, a, b])
+
+		self.assertEqual(len(self.server.requested_waypoints), 1)
+		self.assertEqual(len(self.server.requested_waypoints[0]), 3)
+
+		expected_ab = get_leg_distance("1.0,1.0", "1.001,1.0") * 0.001
+		expected_bc = get_leg_distance("1.001,1.0", "1.001,1.002") * 0.001
+		self.assertEqual(distances, [expected_ab, expected_bc, expected_ab, expected_bc])
+
+	def test_failed_requests_give_no_distance(self):
+
+		a, b = create_stop("a", "1.0,1.0"), create_stop("b", "1.001,1.0")
+		unroutable, broken = create_stop("x", unroutable_point), create_stop("y", broken_point)
+
+		self.assertEqual(builder.call_distance_API([a, b], [unroutable, broken], packed=False), [None, None])
+
+	def test_failed_pairs_are_retried_alone_and_not_cached(self):
+
+		a, b, c = create_stop("a", "1.0,1.0"), create_stop("b", "1.001,1.0"), create_stop("c", "1.001,1.002")
+		unroutable = create_stop("x", unroutable_point)
+
+		# All the pairs are packed into one request, which fails because of x
+		connections_list = [{'from': "a", 'to': "b", 'length': 0.1},
+			{'from': "b", 'to': "x", 'length': 0.5},
+			{'from': "b", 'to': "c", 'length': 0.2}]
+		network = {'stops': [a, b, c, unroutable], 'connections': connections_list}
+
+		builder.calculate_road_distances("test", network)
+
+		# One packed request, then every pair on its own
+		self.assertIn(unroutable_point, self.server.requested_waypoints[0])
+		self.assertEqual([len(waypoints) for waypoints in self.server.requested_waypoints[1:]], [2, 2, 2])
+		self.assertEqual(connections_list[0]['road_length'], get_leg_distance("1.0,1.0", "1.001,1.0") * 0.001)
+		self.assertEqual(connections_list[2]['road_length'], get_leg_distance("1.001,1.0", "1.001,1.002") * 0.001)
+
+		# Without a road route it falls back to the straight distance, and is not kept for next time
+		self.assertEqual(connections_list[1]['road_length'], 0.5)
+		road_distances = builder.read_road_distances_cache()
+		self.assertEqual(len(road_distances), 2)
+		self.assertNotIn(builder.get_stops_pair_key(b, unroutable), road_distances)
+
+
+if __name__ == "__main__":
+	unittest.main()
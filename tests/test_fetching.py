@@ -0,0 +1,104 @@
+"""Tests of the NextBus fetch layer of the builder against a local stand-in for the NextBus API."""
+
+import os, sys, time, threading, unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import builder
+
+
+# Seconds the stand-in takes to answer, longer for the first routes so they finish last
+response_delay = 0.05
+
+
+class NextBusHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+
+		query = parse_qs(urlsplit(self.path).query)
+		route = query['r'][0]
+
+		with self.server.lock:
+			self.server.requests.append((time.monotonic(), query['a'][0], query['command'][0], route))
+			self.server.running = self.server.running + 1
+			self.server.most_running = max(self.server.most_running, self.server.running)
+
+		time.sleep(response_delay * (1 + 1/(1 + int(route))))
+
+		with self.server.lock:
+			self.server.running = self.server.running - 1
+
+		self.send_response(200)
+		self.send_header("Content-Type", "text/xml")
+		self.end_headers()
+		self.wfile.write(("<body><route tag=\"" + route + "\"/></body>").encode("utf-8"))
+
+	def log_message(self, *args):
+		pass
+
+
+class FetchingTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+
+		cls.server = ThreadingHTTPServer(("127.0.0.1", 0), NextBusHandler)
+		cls.server.daemon_threads = True
+		cls.server.lock = threading.Lock()
+		threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+	@classmethod
+	def tearDownClass(cls):
+
+		cls.server.shutdown()
+		cls.server.server_close()
+
+	def setUp(self):
+
+		self.server.requests = []
+		self.server.running = 0
+		self.server.most_running = 0
+
+		builder.cache_directory = None
+		builder.offline_mode = False
+		builder.retry_delay = 0
+		builder.configure_fetching({'nextbus': "http://127.0.0.1:" + str(self.server.server_address[1]) + "/",
+			'workers': 3, 'rate': 0})
+
+	def tearDown(self):
+
+		builder.transit_api_server = None
+
+	def call_route_data(self, routes_count):
+
+		api = builder.cities['toronto']['apis']['ttc']
+
+		return builder.call_transit_APIs([(api, 'route_data', str(route), []) for route in range(routes_count)])
+
+	def test_route_order(self):
+
+		responses = self.call_route_data(12)
+
+		self.assertEqual(responses, ["<body><route tag=\"" + str(route) + "\"/></body>" for route in range(12)])
+		self.assertEqual(sorted([request[1:] for request in self.server.requests]),
+			sorted([("ttc", "routeConfig", str(route)) for route in range(12)]))
+
+	def test_concurrency_bound(self):
+
+		self.call_route_data(12)
+
+		self.assertEqual(self.server.most_running, 3)
+
+	def test_rate_limit(self):
+
+		builder.configure_fetching({'rate': 20})
+		self.call_route_data(10)
+
+		request_times = sorted([request[0] for request in self.server.requests])
+		self.assertGreaterEqual(request_times[-1] - request_times[0], 9/20 - 0.01)
+
+
+if __name__ == "__main__":
+	unittest.main()
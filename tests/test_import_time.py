@@ -0,0 +1,63 @@
+"""Tests that importing the command line scripts stays fast and doesn't load the heavy libraries."""
+
+import os, sys, subprocess, unittest
+
+
+package_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Most time in seconds importing a script may take, several times what it takes today
+import_time_budget = 0.5
+
+# Libraries that must only be imported by the functions that need them
+heavy_modules = ["numpy", "scipy", "networkx", "matplotlib", "requests"]
+
+
+def get_import_times(module):
+	"""Imports a module in a new interpreter and returns the cumulative time in seconds of every
+	module it imported.
+
+	Args:
+		module (str): name of the module to import
+
+	Returns:
+		dict: cumulative import time of every imported module by name
+	"""
+
+	process = subprocess.run(
+		[sys.executable, "-X", "importtime", "-c", "import " + module],
+		cwd=package_directory, capture_output=True, text=True, check=True)
+
+	times = {}
+	for line in process.stderr.splitlines():
+		if not line.startswith("import time:") or "cumulative" in line:
+			continue
+
+		_, cumulative, name = line.split("|")
+		times[name.strip()] = int(cumulative) / 1e6
+
+	return times
+
+
+class ImportTimeTest(unittest.TestCase):
+
+	def check_import(self, module):
+
+		times = get_import_times(module)
+
+		self.assertIn(module, times)
+		self.assertLess(times[module], import_time_budget)
+
+		for name in times:
+			self.assertNotIn(name.split(".")[0], heavy_modules, name + " is imported at startup")
+
+	def test_builder(self):
+
+		self.check_import("builder")
+
+	def test_visualizer(self):
+
+		self.check_import("visualizer")
+
+
+if __name__ == "__main__":
+	unittest.main()
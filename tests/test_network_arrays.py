@@ -0,0 +1,115 @@
+"""Tests of the compact network model and its arrays, and of the routing network and stops index built from them."""
+
+import os, sys, time, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+
+import common
+
+
+def create_connection(from_tag, to_tag, travel_time):
+
+	return {'from': from_tag, 'to': to_tag, 'routes': ["1"], 'length': 0.5, 'road_length': 0.6, 'travel_time': travel_time}
+
+
+class NetworkArraysTest(unittest.TestCase):
+
+	def setUp(self):
+
+		self.directory = tempfile.mkdtemp()
+		for name in ["routes", "stops", "connections"]:
+			open(self.directory + "/" + name + ".csv", "w").close()
+
+		self.routes_list = [{'tag': "1", 'api': "ttc", 'stops_count': 4, 'wait_time_mean': 6.0, 'wait_time_std': 1.0}]
+		self.stops_list = [{'tag': tag, 'title': "Stop " + tag, 'lat': 43.65 + index*0.01, 'lon': -79.38, 'merged': [tag]}
+			for index, tag in enumerate(["a", "b", "c", "d"])]
+
+		# Two connections from b to a, of which the last one is kept
+		self.connections_list = [create_connection("b", "a", 1.0), create_connection("a", "b", 2.0),
+			create_connection("b", "a", 3.0), create_connection("c", "d", 4.0), create_connection("a", "c", 5.0)]
+
+		# The arrays are only up to date when they are newer than the CSV files
+		time.sleep(0.01)
+		common.write_network_arrays(self.directory, self.routes_list, self.stops_list, self.connections_list)
+
+	def tearDown(self):
+
+		shutil.rmtree(self.directory)
+
+	def test_written_atomically(self):
+
+		names = os.listdir(self.directory + "/arrays")
+
+		self.assertIn("stop_positions.npy", names)
+		self.assertEqual([name for name in names if name.endswith(".tmp")], [])
+
+	def test_compact_network(self):
+
+		network = common.create_compact_network(self.routes_list, self.stops_list, self.connections_list + [
+			{'from': "d", 'to': "e", 'routes': ["2"], 'length': 0.1, 'road_length': 0.1, 'travel_time': 1.0}])
+
+		self.assertEqual(network.stop_tags.tags, ["a", "b", "c", "d", "e"])
+		self.assertEqual(network.route_tags.tags, ["1", "2"])
+		self.assertEqual(network.connections['stops'].tolist()[-1], [3, 4])
+		self.assertEqual(network.connections['routes'].tolist(), [0, 0, 0, 0, 0, 1])
+
+		routes_list, stops_list, connections_list = common.convert_compact_network_to_lists(network)
+
+		self.assertEqual(routes_list, self.routes_list)
+		self.assertEqual(stops_list, self.stops_list)
+		self.assertEqual(connections_list[:-1], self.connections_list)
+
+	def test_routing_network(self):
+
+		network = common.create_compact_network(self.routes_list, self.stops_list, self.connections_list)
+		routing_network = common.create_routing_network(network)
+
+		self.assertEqual(routing_network['stops_count'], 4)
+		self.assertEqual(routing_network['indptr'].tolist(), [0, 2, 3, 4, 4])
+		self.assertEqual(routing_network['indices'].tolist(), [1, 2, 0, 3])
+		self.assertEqual(routing_network['connections'].tolist(), [1, 4, 2, 3])
+		self.assertEqual(common.get_connection_ids(routing_network, [1, 0, 2]).tolist(), [2, 4])
+
+	def test_route_slots(self):
+
+		network = common.create_compact_network(self.routes_list, self.stops_list, self.connections_list)
+		routing_network = common.create_routing_network(network)
+		route_slots = common.create_route_slots(network, routing_network)
+
+		labels = common.plan_journeys(route_slots, routing_network['stops_count'], 1)
+		legs = common.get_journey(route_slots, labels, 3)
+
+		self.assertEqual(legs, [(0, [1, 0, 2, 3], 3.0)])
+		self.assertEqual(labels['arrivals'][-1].tolist(), [6.0, 0.0, 11.0, 15.0])
+
+	def test_read_compact_network(self):
+
+		network = common.read_network_arrays(self.directory)
+
+		self.assertIsInstance(network.connections['travel_times'], numpy.memmap)
+		self.assertEqual(network.stop_tags.ids, {"a": 0, "b": 1, "c": 2, "d": 3})
+		self.assertEqual(common.convert_compact_network_to_lists(network),
+			(self.routes_list, self.stops_list, self.connections_list))
+
+		# Outdated arrays are left for the CSV files
+		time.sleep(0.01)
+		common.write_connections_file(self.directory, self.connections_list[:1])
+
+		self.assertIsNone(common.read_network_arrays(self.directory))
+		self.assertEqual(len(common.read_compact_network(self.directory).connections['stops']), 1)
+
+	def test_stops_index(self):
+
+		network = common.read_network_arrays(self.directory)
+		positions = common.create_compact_network(self.routes_list, self.stops_list, self.connections_list).stops['positions']
+
+		stops_index = common.create_stops_index(positions)
+		mapped_stops_index = common.create_stops_index(network.stops['positions'])
+
+		for name in ['lat', 'lon', 'order', 'cell_keys', 'cell_starts', 'cell_ends']:
+			self.assertEqual(stops_index[name].tolist(), mapped_stops_index[name].tolist())
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,101 @@
+"""Tests of the checkpoints of the building pipeline, with stand-in stages that record when they run."""
+
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import builder
+
+
+class StageFailure(Exception):
+	pass
+
+
+class PipelineTest(unittest.TestCase):
+
+	def setUp(self):
+
+		self.working_directory = os.getcwd()
+		self.directory = tempfile.mkdtemp()
+		os.chdir(self.directory)
+		os.mkdir(builder.cities['toronto']['tag'])
+
+		self.pipeline_stages = builder.pipeline_stages
+		self.stages_run = []
+		self.failing_stage = None
+		builder.pipeline_stages = {stage: self.create_stage(stage) for stage in self.pipeline_stages}
+		builder.resume_from_checkpoint = True
+
+	def tearDown(self):
+
+		builder.pipeline_stages = self.pipeline_stages
+		os.chdir(self.working_directory)
+		shutil.rmtree(self.directory)
+
+	def create_stage(self, stage):
+
+		def run_stage(city, network):
+
+			self.stages_run.append(stage)
+			if stage == self.failing_stage:
+				raise StageFailure(stage)
+
+			if network is None:
+				network = {'routes': [{'tag': "1", 'api': "ttc", 'stops_count': 2, 'wait_time_mean': 6.0, 'wait_time_std': 1.0}],
+					'stops': [{'tag': tag, 'title': tag, 'lat': 43.65, 'lon': -79.38, 'merged': [tag]} for tag in ["a", "b"]],
+					'connections': [{'from': "a", 'to': "b", 'routes': ["1"], 'length': 0, 'road_length': 0, 'travel_time': 0}]}
+
+			network['connections'][0]['length'] = network['connections'][0]['length'] + 1
+
+			return network
+
+		return run_stage
+
+	def run_all(self):
+
+		return builder.run_pipeline("toronto", list(self.pipeline_stages), ['static', 'road_distances'])
+
+	def test_resume_after_checkpoint(self):
+
+		self.failing_stage = 'times'
+		self.assertRaises(StageFailure, self.run_all)
+
+		self.stages_run = []
+		self.failing_stage = None
+		self.run_all()
+
+		self.assertEqual(self.stages_run, ['times', 'clean'])
+		self.assertFalse(os.path.isfile("ttc/checkpoint.txt"))
+
+	def test_no_resume_after_other_command(self):
+
+		self.failing_stage = 'times'
+		self.assertRaises(StageFailure, self.run_all)
+
+		# Building the static network again makes the checkpoint of the failed run out of date
+		self.failing_stage = None
+		builder.run_pipeline("toronto", ['static'])
+
+		self.stages_run = []
+		self.run_all()
+
+		self.assertEqual(self.stages_run, list(self.pipeline_stages))
+
+	def test_no_resume_after_files_changed(self):
+
+		self.failing_stage = 'times'
+		self.assertRaises(StageFailure, self.run_all)
+
+		# Writing the network files outside of the pipeline (like consolidate does) also does
+		network = builder.read_network("toronto")
+		builder.write_connections_file("ttc", network['connections'] + network['connections'])
+
+		self.stages_run = []
+		self.failing_stage = None
+		self.run_all()
+
+		self.assertEqual(self.stages_run, list(self.pipeline_stages))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,125 @@
+"""Tests of the incremental static network build against full builds, with a local stand-in for the NextBus API."""
+
+import os, sys, random, shutil, tempfile, threading, unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import builder
+
+
+class NextBusHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+
+		query = parse_qs(urlsplit(self.path).query)
+		routes = self.server.routes
+
+		if query['command'][0] == "routeList":
+			body = "<body>" + "".join(["<route tag=\"" + route + "\"/>" for route in routes]) + "</body>"
+		else:
+			body = get_route_config(query['r'][0], routes[query['r'][0]], self.server.stops)
+
+		self.send_response(200)
+		self.send_header("Content-Type", "text/xml")
+		self.end_headers()
+		self.wfile.write(body.encode("utf-8"))
+
+	def log_message(self, *args):
+		pass
+
+
+def get_route_config(route, stop_tags, stops):
+	"""The routeConfig payload of a route that goes through its stops one way."""
+
+	return ("<body><route tag=\"" + route + "\">"
+		+ "".join(["<stop tag=\"" + tag + "\" title=\"Stop " + tag + "\" lat=\"" + stops[tag][0] + "\" lon=\"" + stops[tag][1] + "\"/>"
+			for tag in stop_tags])
+		+ "<direction tag=\"" + route + "_0\">" + "".join(["<stop tag=\"" + tag + "\"/>" for tag in stop_tags]) + "</direction>"
+		+ "</route></body>")
+
+
+def create_routes(generator, stops, routes_count):
+	"""Random routes through the stops, many of which are within walking distance of each other."""
+
+	return {str(route): generator.sample(sorted(stops), generator.randint(6, 12)) for route in range(routes_count)}
+
+
+class IncrementalBuildTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+
+		cls.server = HTTPServer(("127.0.0.1", 0), NextBusHandler)
+		threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+	@classmethod
+	def tearDownClass(cls):
+
+		cls.server.shutdown()
+		cls.server.server_close()
+
+	def setUp(self):
+
+		self.working_directory = os.getcwd()
+		self.directory = tempfile.mkdtemp()
+		os.chdir(self.directory)
+
+		builder.cache_directory = None
+		builder.offline_mode = False
+		builder.configure_fetching({'nextbus': "http://127.0.0.1:" + str(self.server.server_address[1]), 'workers': 1, 'rate': 0})
+
+	def tearDown(self):
+
+		builder.transit_api_server = None
+		builder.incremental_build = False
+		os.chdir(self.working_directory)
+		shutil.rmtree(self.directory)
+
+	def build(self, routes, incremental):
+
+		self.server.routes = routes
+		builder.incremental_build = incremental
+
+		return builder.run_pipeline("toronto", ['static'])
+
+	def get_network_summary(self, network):
+		"""The stops with their positions and merged stops, and the connections with their routes."""
+
+		stops = {stop['tag']: (round(float(stop['lat']), 9), round(float(stop['lon']), 9), tuple(sorted(stop['merged'])))
+			for stop in network['stops']}
+		connections = {(connection['from'], connection['to']): tuple(sorted(connection['routes']))
+			for connection in network['connections']}
+
+		return stops, connections
+
+	def test_same_as_full_build(self):
+
+		for seed in range(20):
+			generator = random.Random(seed)
+
+			# Stops in a 300m square, many of them within walking distance of each other
+			self.server.stops = {"p%03d" % index: ("%.6f" % (43.65 + generator.random()*0.0027),
+				"%.6f" % (-79.38 + generator.random()*0.0037)) for index in range(70)}
+			routes = create_routes(generator, self.server.stops, 8)
+
+			self.build(routes, False)
+			old_network = builder.read_network("toronto")
+			old_fingerprints = builder.read_fingerprints_file("ttc")
+
+			# Change one route and remove another one
+			routes = dict(routes)
+			routes["0"] = generator.sample(sorted(self.server.stops), 9)
+			del routes["7"]
+
+			full_network = self.build(routes, False)
+			builder.write_network("toronto", old_network)
+			builder.write_fingerprints_file("ttc", old_network['routes'], old_fingerprints)
+			incremental_network = self.build(routes, True)
+
+			self.assertEqual(self.get_network_summary(incremental_network), self.get_network_summary(full_network), "seed " + str(seed))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -1,10 +1,31 @@
-import sys,random,math,numpy
-import networkx as nx
-import matplotlib.pyplot as plt
-from pprint import pprint
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 from common import *
 
+# Points drawn at once by the coverage and trip metrics
+coverage_batch_size = 2**16
+
+# Most label entries kept in the cached journeys of the trip metrics (4 to 8 bytes each)
+journeys_cache_size = 2**25
+
+# Master seed of the random streams of the sampling workers (None for a fresh one every run)
+sampling_seed = None
+# Worker processes the samples of every metric are split across
+sampling_workers = 1
+# Relative half width of the 95% confidence intervals the metrics sample until (0 for fixed sampling)
+sampling_target_ci = 0
+# Half width under which a confidence interval is narrow enough whatever its mean, for means near 0
+sampling_min_ci = 0.01
+# Most samples of every metric (None for the requested samples)
+sampling_max_samples = None
+# Fewest samples of every round of adaptive sampling
+sampling_min_round = 100
+
+# The network data of the metric a worker process samples, installed once by install_sampling_data
+worker_data = None
+
 
 
 def main():
@@ -15,38 +36,44 @@ def main():
 
 		city - 
 
+		--seed=N - seed the random samples of the metrics, for reproducible results
+		--workers=N - split the samples of every metric across N processes
+		--ci=X - stop sampling a metric once its confidence interval is within X of its mean (e.g. 0.05),
+			instead of always taking the requested samples
+		--max-samples=N - with --ci, take up to N samples for a metric instead of the requested samples
+
 	"""
 
+	arguments, options = parse_arguments(sys.argv)
+	configure_sampling(options)
+
 	# With the "draw" argument, draw the network
-	if len(sys.argv) > 2 and (sys.argv[1] == "draw" or sys.argv[1] == "-d" ):
+	if len(arguments) > 2 and (arguments[1] == "draw" or arguments[1] == "-d" ):
 
 		draw_static_network(G,stops_list)
 
 
 	# With the "poi" argument, calculate poi statistics
-	elif len(sys.argv) > 2 and (sys.argv[1] == "poi" or sys.argv[1] == "-p" ):
+	elif len(arguments) > 2 and (arguments[1] == "poi" or arguments[1] == "-p" ):
 
 
 		metrics = []
 
-		for city in sys.argv[2].split(","):
+		for city in arguments[2].split(","):
 
 			# Read the network files
-			routes_list = read_routes_file(cities[city]['tag'])
-			stops_list = read_stops_file(cities[city]['tag'])
-			connections_list = read_connections_file(cities[city]['tag'])
+			network = read_compact_network(cities[city]['tag'])
 			poi_list = read_poi_file(cities[city]['tag'])
 
-			sample_size = sys.argv[3]
-			sample_size = sys.argv[4]
+			sample_size = arguments[3]
+			sample_size = arguments[4]
 
-			G = create_directed_network(stops_list, connections_list)
 			radius = cities[city]['radius']
 			area = cities[city]['area']
 
 
 			# ------------ Points Of Interest -----------
-			poi = calculate_poi_uniform(G, routes_list, stops_list, connections_list, poi_list,
+			poi = calculate_poi_uniform(network, create_stops_index(network.stops['positions']), poi_list,
 				radius, sample_size, repetitions, poi_type)
 		
 			print(poi)
@@ -55,23 +82,19 @@ def main():
 
 
 	# With the "metrics" argument, calculate all metrics
-	elif len(sys.argv) > 2 and (sys.argv[1] == "metrics" or sys.argv[1] == "-m" ):
+	elif len(arguments) > 2 and (arguments[1] == "metrics" or arguments[1] == "-m" ):
 
 		metrics = []
 
-		for city in sys.argv[2].split(","):
+		for city in arguments[2].split(","):
 
-			# Read the network files
-			routes_list = read_routes_file(cities[city]['tag'])
-			stops_list = read_stops_file(cities[city]['tag'])
-			connections_list = read_connections_file(cities[city]['tag'])
+			# Read the network
+			network = read_compact_network(cities[city]['tag'])
 
-			sample_size = int(sys.argv[3])
-			repetitions = int(sys.argv[4])
+			sample_size = int(arguments[3])
+			repetitions = int(arguments[4])
 
-			G = create_directed_network(stops_list, connections_list)
-			
-			city_metrics = calculate_city_metrics(G, routes_list, stops_list, connections_list, city, sample_size, repetitions)
+			city_metrics = calculate_city_metrics(network, city, sample_size, repetitions)
 			metrics.append(city + "," + ",".join(str(value) for value in city_metrics.values()))
 			write_metrics_file(city, "city," + ",".join(str(value) for value in city_metrics.keys())
 				+ "\n".join(metrics) + "\n")
@@ -85,10 +108,10 @@ def main():
 		# print(metrics_text)
 
 	# With the "evaluation" argument, calculate some paths for evaluation
-	elif len(sys.argv) > 2 and (sys.argv[1] == "evaluation" or sys.argv[1] == "-e" ):
+	elif len(arguments) > 2 and (arguments[1] == "evaluation" or arguments[1] == "-e" ):
 
-		city = sys.argv[2]
-		sample_size = int(sys.argv[3])
+		city = arguments[2]
+		sample_size = int(arguments[3])
 		repetitions = 1
 
 		# Area and earth radius presets
@@ -96,25 +119,28 @@ def main():
 		area = cities[city]['area']
 
 		# Read the network files
-		routes_list = read_routes_file(cities[city]['tag'])
-		stops_list = read_stops_file(cities[city]['tag'])
-		connections_list = read_connections_file(cities[city]['tag'])
+		network = read_compact_network(cities[city]['tag'])
 		sectors_list = read_demographics_file(cities[city]['tag'])
 
-		G = create_directed_network(stops_list, connections_list)
+		stops_index = create_stops_index(network.stops['positions'])
+		paths_cache = create_paths_cache(network)
 
-		calculate_trip_uniform(G, routes_list, stops_list, connections_list, radius, sample_size, repetitions)
-		calculate_trip_population(G, routes_list, stops_list, connections_list, sectors_list, radius, sample_size, repetitions)
+		calculate_trip_uniform(network, stops_index, radius, sample_size, repetitions, paths_cache)
+		calculate_trip_population(network, stops_index, sectors_list, radius, sample_size, repetitions, paths_cache)
 
 	# With wrong arguments, print usage help message
 	else:
-		print("Usage: visualizer <metrics|evaluation|draw|poi> <city>[,<city_2>,...]")
+		print("Usage: visualizer <metrics|evaluation|draw|poi> <city>[,<city_2>,...] [--seed=N] [--workers=N] [--ci=X] [--max-samples=N]")
+		print("With --ci=X, metrics stop sampling once their 95% confidence intervals are within X of their means")
+		print("(or " + str(sampling_min_ci) + " for means near 0), taking at most the requested samples or --max-samples")
 
 		
 
 def create_directed_network(stops_list, connections_list):
 	"""Draw an image for the pre-built static network of the transport system."""
 
+	import networkx as nx
+
 
 	# Build the graph object, add stops and connections
 	G = nx.DiGraph()
@@ -131,7 +157,9 @@ def create_directed_network(stops_list, connections_list):
 # =				Metrics Calculation				=
 # ===============================================
 
-def calculate_city_metrics(G, routes_list, stops_list, connections_list, city, sample_size, repetitions):
+def calculate_city_metrics(network, city, sample_size, repetitions):
+
+	import numpy
 
 	sectors_list = read_demographics_file(cities[city]['tag'])
 
@@ -141,31 +169,40 @@ def calculate_city_metrics(G, routes_list, stops_list, connections_list, city, s
 
 	metrics = {}
 
+	# Index the stops and cache the shortest paths once, for all the metrics
+	stops_index = create_stops_index(network.stops['positions'])
+	paths_cache = create_paths_cache(network)
+
 
 	# ----------- General Statistics ------------
-	metrics['routes_count'] = len(routes_list)
-	metrics['stops_count'] = len(stops_list)
-	metrics['connections_count'] = len(connections_list)
+	metrics['routes_count'] = len(network.routes['apis'])
+	metrics['stops_count'] = len(network.stops['positions'])
+	metrics['connections_count'] = len(network.connections['stops'])
 
-	metrics['total_length'] = sum(connection['length'] for connection in connections_list)
+	metrics['total_length'] = float(numpy.sum(network.connections['lengths']))
 	# metrics['total_length_normalized'] = metrics['total_length']/area
 	metrics['connection_length_average'] = metrics['total_length']/metrics['connections_count']
 
-	metrics['total_travel_time'] = sum([connection['travel_time'] for connection in connections_list])
+	metrics['total_travel_time'] = float(numpy.sum(network.connections['travel_times']))
 	metrics['connection_travel_time_average'] = metrics['total_travel_time']/metrics['connections_count']
 
 	metrics['connection_speed_average'] = 60*metrics['total_length']/metrics['total_travel_time']
 
-	metrics['wait_time_average'] = numpy.mean([route['wait_time_mean'] for route in routes_list])/2
-	metrics['wait_time_std'] = numpy.std([route['wait_time_mean'] for route in routes_list])/2
+	metrics['wait_time_average'] = numpy.mean(network.routes['wait_times'][:, 0])/2
+	metrics['wait_time_std'] = numpy.std(network.routes['wait_times'][:, 0])/2
 
 
 	# --------- Shortest Times & Paths ----------
 	(metrics['average_trip_time_uniform'],
 		metrics['average_trip_length_uniform'],
 		metrics['average_transfers_uniform'],
-		metrics['average_straight_distance_uniform']) = (
-		calculate_trip_uniform(G, routes_list, stops_list, connections_list, radius, sample_size, repetitions))
+		metrics['average_straight_distance_uniform'],
+		(metrics['average_trip_time_uniform_ci'],
+			metrics['average_trip_length_uniform_ci'],
+			metrics['average_transfers_uniform_ci'],
+			metrics['average_straight_distance_uniform_ci']),
+		metrics['trip_uniform_samples']) = (
+		calculate_trip_uniform(network, stops_index, radius, sample_size, repetitions, paths_cache))
 
 	metrics['average_trip_length_normalized_uniform'] = metrics['average_trip_length_uniform']/metrics['average_straight_distance_uniform']
 	metrics['average_time_normalized_uniform'] = metrics['average_trip_time_uniform']/metrics['average_straight_distance_uniform']
@@ -177,8 +214,13 @@ def calculate_city_metrics(G, routes_list, stops_list, connections_list, city, s
 	(metrics['average_trip_time_population'],
 		metrics['average_trip_length_population'],
 		metrics['average_transfers_population'],
-		metrics['average_straight_distance_population']) = (
-		calculate_trip_population(G, routes_list, stops_list, connections_list, sectors_list, radius, sample_size, repetitions))
+		metrics['average_straight_distance_population'],
+		(metrics['average_trip_time_population_ci'],
+			metrics['average_trip_length_population_ci'],
+			metrics['average_transfers_population_ci'],
+			metrics['average_straight_distance_population_ci']),
+		metrics['trip_population_samples']) = (
+		calculate_trip_population(network, stops_index, sectors_list, radius, sample_size, repetitions, paths_cache))
 
 	metrics['average_trip_length_normalized_population'] = metrics['average_trip_length_population']/metrics['average_straight_distance_population']
 	metrics['average_time_normalized_population'] = metrics['average_trip_time_population']/metrics['average_straight_distance_population']
@@ -187,10 +229,14 @@ def calculate_city_metrics(G, routes_list, stops_list, connections_list, city, s
 
 
 	# ----------------- Coverage ----------------
-	metrics['uniform_coverage_stops'], metrics['uniform_coverage_distance'] = (
-		calculate_uniform_coverage(stops_list, radius, sample_size, repetitions))
-	metrics['population_coverage_stops'], metrics['population_coverage_distance'] = (
-		calculate_population_coverage(stops_list, sectors_list, radius, sample_size, repetitions))
+	(metrics['uniform_coverage_stops'], metrics['uniform_coverage_distance'],
+		(metrics['uniform_coverage_stops_ci'], metrics['uniform_coverage_distance_ci']),
+		metrics['uniform_coverage_samples']) = (
+		calculate_uniform_coverage(stops_index, radius, sample_size, repetitions))
+	(metrics['population_coverage_stops'], metrics['population_coverage_distance'],
+		(metrics['population_coverage_stops_ci'], metrics['population_coverage_distance_ci']),
+		metrics['population_coverage_samples']) = (
+		calculate_population_coverage(stops_index, sectors_list, radius, sample_size, repetitions))
 
 
 	# -------- Clustering & Connectivity --------
@@ -201,359 +247,377 @@ def calculate_city_metrics(G, routes_list, stops_list, connections_list, city, s
 	return metrics
 
 
-def calculate_uniform_coverage(stops_list, radius, sample_size, repetitions):
+def calculate_uniform_coverage(stops_index, radius, sample_size, repetitions):
 
-	cutoff_high_deg = 0.0072	# 800m
 	cutoff_low_deg = 0.0036  	# 400m
-	walk_km = 0.4				# 400m
 
-	lat_list = [float(stop['lat']) for stop in stops_list]
-	lon_list = [float(stop['lon']) for stop in stops_list]
+	lat_list = stops_index['lat'].tolist()
+	lon_list = stops_index['lon'].tolist()
 
 	bounding_box = { 'left': min(lon_list) - cutoff_low_deg,
 		'right': max(lon_list) + cutoff_low_deg,
 		'top': max(lat_list) + cutoff_low_deg,
 		'bottom': min(lat_list) - cutoff_low_deg}
 
-	close_stops = 0
-	least_distance = 0
+	data = {'name': "area", 'stops_index': stops_index, 'radius': radius, 'bounding_box': bounding_box}
+	statistics = run_adaptive_sampling(sample_coverage, data, sample_size*repetitions)
 
-	# Average over several seeds
-	for i in range(0,repetitions):
+	close_stops, least_distance = statistics['mean'].tolist()
+	return close_stops, least_distance, get_confidence_intervals(statistics), statistics['count']
 
-		random.seed()
-		for x in range(0,sample_size):
 
-			random_lat, random_lon = select_random_point_uniform(bounding_box)
+def calculate_population_coverage(stops_index, sectors_list, radius, sample_size, repetitions):
 
-			# Make sure we are within the service area (within 800m of nearest stop)
-			cutoff_square_stops = get_stops_in_square(stops_list, random_lat, random_lon, cutoff_high_deg)
-			while (len(cutoff_square_stops) == 0):
-				random_lat, random_lon = select_random_point_uniform(bounding_box)
-				cutoff_square_stops = get_stops_in_square(stops_list, random_lat, random_lon, cutoff_high_deg)
+	data = {'name': "population", 'stops_index': stops_index, 'radius': radius, 'sectors_arrays': create_sectors_arrays(sectors_list)}
+	statistics = run_adaptive_sampling(sample_coverage, data, sample_size*repetitions)
 
-			# Calculate number of close stops and least distance
-			close_stops_count, close_stops_distances = (
-				calculate_close_stops(cutoff_square_stops, random_lat, random_lon, cutoff_low_deg, radius))
-			least_distance_stop = calculate_least_distance(random_lat, random_lon, close_stops_distances, cutoff_square_stops, radius)
+	close_stops, least_distance = statistics['mean'].tolist()
+	return close_stops, least_distance, get_confidence_intervals(statistics), statistics['count']
 
-			close_stops = close_stops + close_stops_count
-			least_distance = least_distance + least_distance_stop
-			print("Calculated area coverage for " + str(x + i*sample_size) + "/" + str(sample_size*repetitions), end="\r")
 
-	return close_stops/(sample_size*repetitions), least_distance/(sample_size*repetitions)
+def calculate_trip_uniform(network, stops_index, radius, sample_size, repetitions, paths_cache=None):
 
+	cutoff_low_deg = 0.0036  	# 400m
 
-def calculate_population_coverage(stops_list, sectors_list, radius, sample_size, repetitions):
+	lat_list = stops_index['lat'].tolist()
+	lon_list = stops_index['lon'].tolist()
 
-	population_distribution = [sector['population'] for sector in sectors_list]
+	bounding_box = { 'left': min(lon_list) - cutoff_low_deg,
+		'right': max(lon_list) + cutoff_low_deg,
+		'top': max(lat_list) + cutoff_low_deg,
+		'bottom': min(lat_list) - cutoff_low_deg}
 
-	cutoff_high_deg = 0.0072	# 800m
-	cutoff_low_deg = 0.0036  	# 400m
+	return calculate_trip_stats(network, stops_index, {'bounding_box': bounding_box}, radius, sample_size, repetitions, paths_cache)
 
-	close_stops = 0
-	least_distance = 0
 
-	# Average over several seeds
-	for i in range(0,repetitions):
+def calculate_trip_population(network, stops_index, sectors_list, radius, sample_size, repetitions, paths_cache=None):
+
+	sectors_arrays = create_sectors_arrays(sectors_list)
 
-		random.seed()
-		for x in range(0,sample_size):
+	return calculate_trip_stats(network, stops_index, {'sectors_arrays': sectors_arrays}, radius, sample_size, repetitions, paths_cache)
 
-			random_lat, random_lon = select_random_point_population(population_distribution, sectors_list)
 
-			# Make sure we are within the service area (within 800m of nearest stop)
-			cutoff_square_stops = get_stops_in_square(stops_list, random_lat, random_lon, cutoff_high_deg)
-			while (len(cutoff_square_stops) == 0):
-				random_lat, random_lon = select_random_point_population(population_distribution, sectors_list)
-				cutoff_square_stops = get_stops_in_square(stops_list, random_lat, random_lon, cutoff_high_deg)
+def calculate_trip_stats(network, stops_index, points_data, radius, sample_size, repetitions, paths_cache=None):
 
-			# Calculate number of close stops and least distance
-			close_stops_count, close_stops_distances = (
-				calculate_close_stops(cutoff_square_stops, random_lat, random_lon, cutoff_low_deg, radius))
-			least_distance_stop = calculate_least_distance(random_lat, random_lon, close_stops_distances, cutoff_square_stops, radius)
+	if paths_cache is None:
+		paths_cache = create_paths_cache(network)
+
+	# Every worker process keeps its own journeys cache, so only the network is sent to them
+	if sampling_workers > 1:
+		paths_cache = dict(paths_cache, journeys=OrderedDict(), entries=0)
+
+	data = dict(points_data, stops_index=stops_index, radius=radius, paths_cache=paths_cache)
+	statistics = run_adaptive_sampling(sample_trips, data, sample_size*repetitions)
+
+	print("")
 
-			close_stops = close_stops + close_stops_count
-			least_distance = least_distance + least_distance_stop
-			print("Calculated population coverage for " + str(x + i*sample_size) + "/" + str(sample_size*repetitions), end="\r")
+	trip_time, trip_distance, trip_transfers, trip_straight_distance = statistics['mean'].tolist()
+	return (trip_time, trip_distance, trip_transfers, trip_straight_distance,
+		get_confidence_intervals(statistics), statistics['count'])
 
-	return close_stops/(sample_size*repetitions), least_distance/(sample_size*repetitions)
 
+def calculate_poi_uniform(network, stops_index, poi_list, radius, sample_size, repetitions, poi_type, paths_cache=None):
 
-def calculate_trip_uniform(G, routes_list, stops_list, connections_list, radius, sample_size, repetitions):
+	import numpy
 
 	cutoff_high_deg = 0.0072	# 800m
 	cutoff_low_deg = 0.0036  	# 400m
-	# Adjust the result by 30% due to greedy path bias
-	adjustment_weight = 0.7
 
-	lat_list = [float(stop['lat']) for stop in stops_list]
-	lon_list = [float(stop['lon']) for stop in stops_list]
+	lat_list = stops_index['lat'].tolist()
+	lon_list = stops_index['lon'].tolist()
 
-	routes_dict = {route['tag']:route for route in routes_list}
+	travel_times = network.connections['travel_times']
+
+	if paths_cache is None:
+		paths_cache = create_paths_cache(network)
 
 	bounding_box = { 'left': min(lon_list) - cutoff_low_deg,
 		'right': max(lon_list) + cutoff_low_deg,
 		'top': max(lat_list) + cutoff_low_deg,
 		'bottom': min(lat_list) - cutoff_low_deg}
 
-	trip_time = 0
-	trip_distance = 0
-	trip_transfers = 0
-	trip_straight_distance = 0
+	# The stops closest to the points of interest are the same for every sample
+	poi_stops = [get_closest_stop_index(stops_index, poi['lat'], poi['lon'], radius) for poi in poi_list]
+
+	closest_poi_trip_time = 0
 
 	# Average over several seeds
+	streams = numpy.random.SeedSequence(sampling_seed).spawn(repetitions)
 	for i in range(0,repetitions):
 
-		random.seed()
+		generator = numpy.random.default_rng(streams[i])
 		x=0
-		while x < sample_size:
-
-			random_lat_1, random_lon_1 = select_random_point_uniform(bounding_box)
-			random_lat_2, random_lon_2 = select_random_point_uniform(bounding_box)
-
-			# Make sure first point is within the service area (within 800m of nearest stop)
-			cutoff_square_stops = get_stops_in_square(stops_list, random_lat_1, random_lon_1, cutoff_high_deg)
-			while (len(cutoff_square_stops) == 0):
-				random_lat_1, random_lon_1 = select_random_point_uniform(bounding_box)
-				cutoff_square_stops = get_stops_in_square(stops_list, random_lat_1, random_lon_1, cutoff_high_deg)
+		j=0
+		while x < sample_size and j < 1000:
 
-			stop_1 = get_closest_stop(random_lat_1, random_lon_1, cutoff_square_stops, radius)
+			# Make sure the points are within the service area (within 800m of nearest stop)
+			count = min(sample_size - x, 1000 - j)
+			_, _, stops_1 = select_random_stops(stops_index,
+				lambda count: select_random_points_uniform(generator, bounding_box, count), count, cutoff_high_deg, radius)
 
-			# Make sure second point is within the service area (within 800m of nearest stop)
-			cutoff_square_stops = get_stops_in_square(stops_list, random_lat_2, random_lon_2, cutoff_high_deg)
-			while (len(cutoff_square_stops) == 0):
-				random_lat_2, random_lon_2 = select_random_point_uniform(bounding_box)
-				cutoff_square_stops = get_stops_in_square(stops_list, random_lat_2, random_lon_2, cutoff_high_deg)
+			# Find earliest journeys to every point of interest
+			origins = [stop for stop in stops_1.tolist() for poi_stop in poi_stops]
+			trips = calculate_trips(paths_cache, origins, poi_stops * count)
 
-			stop_2 = get_closest_stop(random_lat_2, random_lon_2, cutoff_square_stops, radius)
+			for index in range(0, count):
 
-			# Find shortest path (forward or backwards)
-			try:
-				path = nx.shortest_path(G, stop_1['tag'], stop_2['tag'], 'travel_time')
-			except nx.NetworkXNoPath:
-				try:
-					path = nx.shortest_path(G, stop_2['tag'], stop_1['tag'], 'travel_time')
-				except nx.NetworkXNoPath:
-					path = -1
+				trip_times = [wait_time + travel_times[connection_ids].sum()
+					for connection_ids, transfers, wait_time in
+					[trip for trip in trips[index*len(poi_stops):(index + 1)*len(poi_stops)] if trip is not None]]
 
-			# pprint(path)
+				if(trip_times):
+					closest_poi_trip_time = closest_poi_trip_time + min(trip_times)
 
-			# If it exists, get data on it
-			if(path != -1):
-
-				connections_seq =  convert_stops_seq_to_connections_seq(path, connections_list)
-				transfers, trip_legs = count_route_transfers(connections_seq, routes_dict)
-
-				wait_time = 0
-				for leg_routes in trip_legs:
-					
-					wait_times_list = [routes_dict[route]['wait_time_mean'] for route in leg_routes]
-					if(wait_times_list):
-						wait_time = wait_time + min(wait_times_list)/2
-					else:
-						transfers = -1
-			
-				if(transfers != -1):
-					print("Trip:                                ")
-					print("From: " + str(random_lat_1) + "," + str(random_lon_1) + " to: " + str(random_lat_2) + "," + str(random_lon_2))
-					print("Time: ")
-					print(adjustment_weight*wait_time + sum([connection['travel_time'] for connection in connections_seq]))
-					print("Distance: ")
-					print(sum([connection['road_length'] for connection in connections_seq]))
-					print("Transfers: ")
-					print(transfers)
-					print("Straight Distance: ")
-					print(calculate_straight_distance(stop_1['lat'], stop_1['lon'], stop_2['lat'], stop_2['lon'], radius))
-					print(" ")
-
-					trip_time = trip_time + adjustment_weight*wait_time + sum([connection['travel_time'] for connection in connections_seq])
-					trip_distance = trip_distance + sum([connection['road_length'] for connection in connections_seq])
-					trip_transfers = trip_transfers + transfers
-					trip_straight_distance = (trip_straight_distance + 
-						calculate_straight_distance(stop_1['lat'], stop_1['lon'], stop_2['lat'], stop_2['lon'], radius))
 					x = x + 1
 					print("Calculated trip stats for " + str(x + i*sample_size) + "/" + str(sample_size*repetitions), end="\r")
+				j = j + 1
 
-	print("")
+	return closest_poi_trip_time/(sample_size*repetitions)
 
-	return (trip_time/(sample_size*repetitions),
-		trip_distance/(sample_size*repetitions),
-		trip_transfers/(sample_size*repetitions),
-		trip_straight_distance/(sample_size*repetitions))
 
+# ===============================================
+# =				Monte Carlo Sampling			=
+# ===============================================
 
-def calculate_trip_population(G, routes_list, stops_list, connections_list, sectors_list, radius, sample_size, repetitions):
+def configure_sampling(options):
+	"""Set the sampling seed, worker processes and stopping rule from the command line options
+	(--seed=N, --workers=N, --ci=relative width, --max-samples=N)."""
 
-	# Adjust the result by 30% due to greedy path bias
-	adjustment_weight = 0.7
+	global sampling_seed, sampling_workers, sampling_target_ci, sampling_max_samples
 
-	population_distribution = [sector['population'] for sector in sectors_list]
-	
-	routes_dict = {route['tag']:route for route in routes_list}
+	if 'seed' in options:
+		sampling_seed = int(options['seed'])
+	if 'workers' in options:
+		sampling_workers = max(int(options['workers']), 1)
+	if 'ci' in options:
+		sampling_target_ci = float(options['ci'])
+	if 'max-samples' in options:
+		sampling_max_samples = max(int(options['max-samples']), 1)
 
-	cutoff_high_deg = 0.0072	# 800m
-	cutoff_low_deg = 0.0036  	# 400m
 
-	trip_time = 0
-	trip_distance = 0
-	trip_transfers = 0
-	trip_straight_distance = 0
+def run_adaptive_sampling(sample_function, data, samples_count):
+	"""Run a Monte Carlo estimator in rounds until the confidence intervals of all its values are narrow enough.
 
-	# Average over several seeds
-	for i in range(0,repetitions):
+	Without --ci it takes exactly the requested samples at once. With it, every round takes a tenth of
+	the requested samples (at least sampling_min_round), and the estimator stops once the 95% confidence
+	interval of every value is within --ci of its mean (or sampling_min_ci, for means near 0), or at
+	--max-samples (the requested samples by default).
 
-		random.seed()
-		x=0
-		while x < sample_size:
+	Returns:
+		The statistics of the values over all the samples (see create_statistics).
 
-			random_lat_1, random_lon_1 = select_random_point_population(population_distribution, sectors_list)
-			random_lat_2, random_lon_2 = select_random_point_population(population_distribution, sectors_list)
+	"""
 
-			# Make sure first point is within the service area (within 800m of nearest stop)
-			cutoff_square_stops = get_stops_in_square(stops_list, random_lat_1, random_lon_1, cutoff_high_deg)
-			while (len(cutoff_square_stops) == 0):
-				random_lat_1, random_lon_1 = select_random_point_population(population_distribution, sectors_list)
-				cutoff_square_stops = get_stops_in_square(stops_list, random_lat_1, random_lon_1, cutoff_high_deg)
+	import numpy
 
-			stop_1 = get_closest_stop(random_lat_1, random_lon_1, cutoff_square_stops, radius)
+	if sampling_target_ci > 0:
+		max_samples = sampling_max_samples if sampling_max_samples is not None else samples_count
+		round_size = max(samples_count // 10, sampling_min_round)
+	else:
+		max_samples = samples_count
+		round_size = samples_count
 
-			# Make sure second point is within the service area (within 800m of nearest stop)
-			cutoff_square_stops = get_stops_in_square(stops_list, random_lat_2, random_lon_2, cutoff_high_deg)
-			while (len(cutoff_square_stops) == 0):
-				random_lat_2, random_lon_2 = select_random_point_population(population_distribution, sectors_list)
-				cutoff_square_stops = get_stops_in_square(stops_list, random_lat_2, random_lon_2, cutoff_high_deg)
+	# The worker processes get the data once and keep it, with their caches, for all the rounds
+	executor = None
+	if sampling_workers > 1:
+		executor = ProcessPoolExecutor(max_workers=sampling_workers, initializer=install_sampling_data, initargs=(data,))
 
-			stop_2 = get_closest_stop(random_lat_2, random_lon_2, cutoff_square_stops, radius)
+	try:
+		seed_sequence = numpy.random.SeedSequence(sampling_seed)
+		statistics = {'count': 0}
+		while statistics['count'] < max_samples:
 
-			# Find shortest path (forward or backwards)
-			try:
-				path = nx.shortest_path(G, stop_1['tag'], stop_2['tag'], 'travel_time')
-			except nx.NetworkXNoPath:
-				try:
-					path = nx.shortest_path(G, stop_2['tag'], stop_1['tag'], 'travel_time')
-				except nx.NetworkXNoPath:
-					path = -1
+			statistics = merge_statistics(statistics,
+				run_sampling(sample_function, data, min(round_size, max_samples - statistics['count']), seed_sequence, executor))
 
-			# If it exists, get data on it
-			if(path != -1):
-
-				connections_seq =  convert_stops_seq_to_connections_seq(path, connections_list)
-				transfers, trip_legs = count_route_transfers(connections_seq, routes_dict)
-
-				wait_time = 0
-				for leg_routes in trip_legs:
-					
-					wait_times_list = [routes_dict[route]['wait_time_mean'] for route in leg_routes]
-					if(wait_times_list):
-						wait_time = wait_time + min(wait_times_list)/2
-					else:
-						transfers = -1
-			
-				if(transfers != -1):
-
-					print("Trip:                                ")
-					print("From: " + str(random_lat_1) + "," + str(random_lon_1) + " to: " + str(random_lat_2) + "," + str(random_lon_2))
-					print("Time: ")
-					print(adjustment_weight*wait_time + sum([connection['travel_time'] for connection in connections_seq]))
-					print("Distance: ")
-					print(sum([connection['road_length'] for connection in connections_seq]))
-					print("Transfers: ")
-					print(transfers)
-					print("Straight Distance: ")
-					print(calculate_straight_distance(stop_1['lat'], stop_1['lon'], stop_2['lat'], stop_2['lon'], radius))
-					print(" ")
-
-					trip_time = trip_time + adjustment_weight*wait_time + sum([connection['travel_time'] for connection in connections_seq])
-					trip_distance = trip_distance + sum([connection['road_length'] for connection in connections_seq])
-					trip_transfers = trip_transfers + transfers
-					trip_straight_distance = (trip_straight_distance + 
-						calculate_straight_distance(stop_1['lat'], stop_1['lon'], stop_2['lat'], stop_2['lon'], radius))
-					x = x + 1
-					print("Calculated trip stats for " + str(x + i*sample_size) + "/" + str(sample_size*repetitions), end="\r")
+			# Stop once every interval is narrow enough, but not on too few samples to tell
+			if sampling_target_ci > 0 and statistics['count'] >= 30 and numpy.all(
+				get_confidence_intervals(statistics) <= numpy.maximum(sampling_target_ci * numpy.abs(statistics['mean']), sampling_min_ci)):
+				break
 
-	print("")
+	finally:
+		if executor is not None:
+			executor.shutdown()
 
-	return (trip_time/(sample_size*repetitions),
-		trip_distance/(sample_size*repetitions),
-		trip_transfers/(sample_size*repetitions),
-		trip_straight_distance/(sample_size*repetitions))
+	return statistics
 
 
-def calculate_poi_uniform(G, routes_list, stops_list, connections_list, poi_list, radius, sample_size, repetitions, poi_type):
+def run_sampling(sample_function, data, samples_count, seed_sequence, executor=None):
+	"""Run a Monte Carlo estimator over a number of samples, split across the sampling worker processes.
 
-	cutoff_high_deg = 0.0072	# 800m
-	cutoff_low_deg = 0.0036  	# 400m
+	Every worker gets its own random stream spawned from the seed sequence and its statistics are
+	merged in order, so the results are the same for the same seed and number of workers.
 
-	lat_list = [float(stop['lat']) for stop in stops_list]
-	lon_list = [float(stop['lon']) for stop in stops_list]
+	Args:
+		sample_function: A function that takes the data, a random generator and a number of samples,
+			and returns the statistics of its values over those samples.
+		data: The dictionary of the network data the estimator needs.
+		executor: The pool of the worker processes, with the data installed (see install_sampling_data).
 
-	routes_dict = {route['tag']:route for route in routes_list}
+	Returns:
+		The statistics of the values over all the samples.
 
-	bounding_box = { 'left': min(lon_list) - cutoff_low_deg,
-		'right': max(lon_list) + cutoff_low_deg,
-		'top': max(lat_list) + cutoff_low_deg,
-		'bottom': min(lat_list) - cutoff_low_deg}
+	"""
 
-	closest_poi_trip_time = 0
+	import numpy
 
-	# Average over several seeds
-	for i in range(0,repetitions):
+	streams = seed_sequence.spawn(sampling_workers)
+	generators = [numpy.random.default_rng(stream) for stream in streams]
+	counts = [samples_count // sampling_workers + (1 if index < samples_count % sampling_workers else 0)
+		for index in range(0, sampling_workers)]
 
-		random.seed()
-		x=0
-		j=0
-		while x < sample_size and j < 1000:
+	if executor is None:
+		partial_statistics_list = [sample_function(data, generators[0], counts[0])]
+	else:
+		partial_statistics_list = list(executor.map(sample_in_worker, [sample_function]*sampling_workers, generators, counts))
+
+	statistics = partial_statistics_list[0]
+	for partial_statistics in partial_statistics_list[1:]:
+		statistics = merge_statistics(statistics, partial_statistics)
+
+	return statistics
+
+
+def install_sampling_data(data):
+	"""Keep the network data of a metric in a worker process, for sample_in_worker."""
+
+	global worker_data
 
-			random_lat_1, random_lon_1 = select_random_point_uniform(bounding_box)
+	worker_data = data
 
-			trip_times = []
 
-			for poi in poi_list:
+def sample_in_worker(sample_function, generator, samples_count):
+	"""Run an estimator over the network data installed in the worker process."""
 
-				# Make sure first point is within the service area (within 800m of nearest stop)
-				cutoff_square_stops = get_stops_in_square(stops_list, random_lat_1, random_lon_1, cutoff_high_deg)
-				while (len(cutoff_square_stops) == 0):
-					random_lat_1, random_lon_1 = select_random_point_uniform(bounding_box)
-					cutoff_square_stops = get_stops_in_square(stops_list, random_lat_1, random_lon_1, cutoff_high_deg)
+	return sample_function(worker_data, generator, samples_count)
 
-				stop_1 = get_closest_stop(random_lat_1, random_lon_1, cutoff_square_stops, radius)
 
-				stop_2 = get_closest_stop(poi['lat'], poi['lon'], stops_list, radius)
-				# pprint(stop_2)
+def create_statistics(values_count):
+	"""Create the running statistics of a number of values: the samples count, and the means and sums of
+	squared deviations of the values (Welford)."""
 
-				# Find shortest path (forward or backwards)
-				try:
-					path = nx.shortest_path(G, stop_1['tag'], stop_2['tag'], 'travel_time')
-				except nx.NetworkXNoPath:
-					path = -1
+	import numpy
 
-				# If it exists, get data on it
-				if(path != -1):
+	return {'count': 0, 'mean': numpy.zeros(values_count), 'm2': numpy.zeros(values_count)}
 
-					connections_seq =  convert_stops_seq_to_connections_seq(path, connections_list)
-					transfers, trip_legs = count_route_transfers(connections_seq, routes_dict)
 
-				wait_time = 0
-				for leg_routes in trip_legs:
-					
-					wait_times_list = [routes_dict[route]['wait_time_mean'] for route in leg_routes]
-					if(wait_times_list):
-						wait_time = wait_time + min(wait_times_list)/2
-					else:
-						transfers = -1
-			
-				if(transfers != -1):
-						trip_times.append(wait_time + sum([connection['travel_time'] for connection in connections_seq]))
+def update_statistics(statistics, values):
+	"""Add the values of one sample to the running statistics."""
 
-			if(not trip_times):
-				closest_poi_trip_time = closest_poi_trip_time + min(trip_times)
+	statistics['count'] = statistics['count'] + 1
+	delta = values - statistics['mean']
+	statistics['mean'] = statistics['mean'] + delta/statistics['count']
+	statistics['m2'] = statistics['m2'] + delta*(values - statistics['mean'])
 
+
+def get_batch_statistics(values_array):
+	"""Get the statistics of a batch of samples at once, from the array of their values (a row per sample)."""
+
+	mean = values_array.mean(axis=0)
+
+	return {'count': len(values_array), 'mean': mean, 'm2': ((values_array - mean)**2).sum(axis=0)}
+
+
+def merge_statistics(statistics_1, statistics_2):
+	"""Merge the statistics of two sets of samples."""
+
+	if statistics_2['count'] == 0:
+		return statistics_1
+	if statistics_1['count'] == 0:
+		return statistics_2
+
+	count = statistics_1['count'] + statistics_2['count']
+	delta = statistics_2['mean'] - statistics_1['mean']
+
+	return {'count': count,
+		'mean': statistics_1['mean'] + delta*statistics_2['count']/count,
+		'm2': statistics_1['m2'] + statistics_2['m2'] + delta**2*statistics_1['count']*statistics_2['count']/count}
+
+
+def get_confidence_intervals(statistics):
+	"""Get the half width of the 95% confidence interval of the mean of every value."""
+
+	import numpy
+
+	if statistics['count'] < 2:
+		return numpy.full(len(statistics['mean']), numpy.inf)
+
+	return 1.96 * numpy.sqrt(statistics['m2'] / (statistics['count'] - 1) / statistics['count'])
+
+
+def sample_coverage(data, generator, samples_count):
+	"""Get the statistics of the close stops counts and least distances of random points within the service area, for run_sampling."""
+
+	import numpy
+
+	cutoff_high_deg = 0.0072	# 800m
+	cutoff_low_deg = 0.0036  	# 400m
+
+	statistics = create_statistics(2)
+	sampled = 0
+	while sampled < samples_count:
+
+		# Select a batch of random points at once
+		random_lat, random_lon = select_random_points(generator, data, min(coverage_batch_size, samples_count - sampled))
+
+		# Calculate number of close stops and least distance of the points within the service area
+		close_stops_counts, least_distances = (
+			calculate_batch_coverage(data['stops_index'], random_lat, random_lon, cutoff_high_deg, cutoff_low_deg, data['radius']))
+		if len(least_distances) == 0:
+			continue
+
+		statistics = merge_statistics(statistics,
+			get_batch_statistics(numpy.column_stack((close_stops_counts, least_distances)).astype(numpy.float64)))
+		sampled = sampled + len(least_distances)
+		print("Calculated " + data['name'] + " coverage for " + str(sampled) + "/" + str(samples_count), end="\r")
+
+	return statistics
+
+
+def sample_trips(data, generator, samples_count):
+	"""Get the statistics of the time, distance, transfers and straight distance of random trips within the service area, for run_sampling."""
+
+	import numpy
+
+	cutoff_high_deg = 0.0072	# 800m
+
+	stops_index = data['stops_index']
+	network = data['paths_cache']['network']
+	radius = data['radius']
+
+	statistics = create_statistics(4)
+
+	x=0
+	while x < samples_count:
+
+		# Select all the remaining trips at once, both ends within the service area (within 800m of nearest stop)
+		_, _, stops_1 = select_random_stops(stops_index,
+			lambda count: select_random_points(generator, data, count), samples_count - x, cutoff_high_deg, radius)
+		_, _, stops_2 = select_random_stops(stops_index,
+			lambda count: select_random_points(generator, data, count), samples_count - x, cutoff_high_deg, radius)
+
+		# Find earliest journeys (forward or backwards)
+		trips = calculate_trips(data['paths_cache'], stops_1.tolist(), stops_2.tolist(), reverse=True)
+
+		for index, trip in enumerate(trips):
+
+			# If it exists, get data on it
+			if(trip is not None):
+
+				connection_ids, transfers, wait_time = trip
+				stop_1 = stops_1[index]
+				stop_2 = stops_2[index]
+
+				update_statistics(statistics, numpy.array([
+					wait_time + network.connections['travel_times'][connection_ids].sum(),
+					network.connections['road_lengths'][connection_ids].sum(),
+					transfers,
+					calculate_straight_distance(stops_index['lat'][stop_1], stops_index['lon'][stop_1],
+						stops_index['lat'][stop_2], stops_index['lon'][stop_2], radius)]))
 				x = x + 1
-				print("Calculated trip stats for " + str(x + i*sample_size) + "/" + str(sample_size*repetitions), end="\r")
-			j = j + 1
+				print("Calculated trip stats for " + str(x) + "/" + str(samples_count), end="\r")
 
-	return closest_poi_trip_time/(sample_size*repetitions)
+	return statistics
 
 
 # ===============================================
@@ -561,144 +625,220 @@ def calculate_poi_uniform(G, routes_list, stops_list, connections_list, poi_list
 # ===============================================
 
 
-def get_stops_in_square(stops_list, random_lat, random_lon, cutoff):
+def calculate_batch_coverage(stops_index, lat_array, lon_array, cutoff_high_deg, cutoff_low_deg, radius):
+	"""Calculate the coverage of a batch of points at once.
 
-	return [ stop for stop in stops_list if (
-			(random_lat < float(stop['lat'])+cutoff and random_lat > float(stop['lat'])-cutoff)
-			and (random_lon < float(stop['lon'])+cutoff and random_lon > float(stop['lon'])-cutoff))]
+	Returns:
+		The arrays of close stops counts and least distances of the points within the service area
+		(with a stop in their 800m square), in the order of the points.
 
+	"""
 
-def calculate_close_stops(stops_list, random_lat, random_lon, cutoff_low_deg, radius):
+	import numpy
 
 	walk_km = 0.4		# 400m
 
-	close_square_stops = get_stops_in_square(stops_list, random_lat, random_lon, cutoff_low_deg)
-	
-	close_stops_distances = (
-			[calculate_straight_distance(random_lat, random_lon, stop['lat'], stop['lon'], radius) for stop in close_square_stops])
+	points, stops = get_stops_pairs_in_boxes(stops_index, lat_array, lon_array, cutoff_high_deg)
+	distances = calculate_pairwise_distances(lat_array[points], lon_array[points],
+		stops_index['lat'][stops], stops_index['lon'][stops], radius)
 
-	close_stops_count = len([distance for distance in close_stops_distances if distance < walk_km])
+	# The pairs that are also in the 400m square of the point
+	stops_lat = stops_index['lat'][stops]
+	stops_lon = stops_index['lon'][stops]
+	close = ((lat_array[points] < stops_lat + cutoff_low_deg) & (lat_array[points] > stops_lat - cutoff_low_deg)
+		& (lon_array[points] < stops_lon + cutoff_low_deg) & (lon_array[points] > stops_lon - cutoff_low_deg))
 
-	return close_stops_count, close_stops_distances
+	close_stops_counts = numpy.bincount(points[close & (distances < walk_km)], minlength=len(lat_array))
 
+	# The least distance is within the 400m square if there are stops in it, otherwise within the 800m one
+	least_distances = numpy.full(len(lat_array), numpy.inf)
+	numpy.minimum.at(least_distances, points, distances)
+	close_least_distances = numpy.full(len(lat_array), numpy.inf)
+	numpy.minimum.at(close_least_distances, points[close], distances[close])
+	least_distances = numpy.where(numpy.isfinite(close_least_distances), close_least_distances, least_distances)
 
-def calculate_least_distance(random_lat, random_lon, close_stops_distances, cutoff_square_stops, radius):
+	in_area = numpy.bincount(points, minlength=len(lat_array)) > 0
 
-	if(close_stops_distances):
+	return close_stops_counts[in_area], least_distances[in_area]
 
-		least_distance = min(close_stops_distances)
 
-	else:
-		cutoff_stops_distances = (
-			[calculate_straight_distance(random_lat, random_lon, stop['lat'], stop['lon'], radius) for stop in cutoff_square_stops])
-		least_distance = min(cutoff_stops_distances)
+def select_random_stops(stops_index, select_points, count, cutoff, radius):
+	"""Select random points within the service area (with a stop in their cutoff degrees square) and their closest stops.
 
-	return least_distance
+	Args:
+		select_points: A function that selects a number of random points as lat and lon arrays.
+		count: The number of points to select.
 
+	Returns:
+		The lat and lon arrays of the points and the array of the indices of their closest stops.
 
-def get_closest_stop(random_lat, random_lon, cutoff_square_stops, radius):
+	"""
 
-	stops_distances = (
-		[{'distance': calculate_straight_distance(random_lat, random_lon, stop['lat'], stop['lon'], radius), 'stop': stop}
-			for stop in cutoff_square_stops])
-	least_distance = min([stop['distance'] for stop in stops_distances])
+	import numpy
 
-	closest_stop = [stop['stop'] for stop in stops_distances if (stop['distance']==least_distance)][0]
-	return closest_stop
+	lat_list = []
+	lon_list = []
+	stops_list = []
+	selected = 0
+	drawn = 0
+	while selected < count:
 
+		# Draw twice the points still missing, given the share of the points so far that were within the area
+		draw_count = min(coverage_batch_size, 2*(count - selected)*(drawn + 1)//(selected + 1) + 16)
+		random_lat, random_lon = select_points(draw_count)
+		closest_stops = get_closest_stops_in_squares(stops_index, random_lat, random_lon, cutoff, radius)
+		drawn = drawn + draw_count
 
-def convert_stops_seq_to_connections_seq(stops_seq, connections_list):
+		in_area = numpy.nonzero(closest_stops != -1)[0][:count - selected]
+		lat_list.append(random_lat[in_area])
+		lon_list.append(random_lon[in_area])
+		stops_list.append(closest_stops[in_area])
+		selected = selected + len(in_area)
 
-	connections_seq = []
+	return numpy.concatenate(lat_list), numpy.concatenate(lon_list), numpy.concatenate(stops_list)
 
-	for index in range(0, len(stops_seq) - 1):
 
-		from_stop = stops_seq[index]
-		to_stop = stops_seq[index + 1]
+def get_closest_stops_in_squares(stops_index, lat_array, lon_array, cutoff, radius):
+	"""Find the closest stop in the cutoff degrees square of each of many points.
 
-		connection = [connection for connection in connections_list
-			if (connection['from'] == from_stop and connection['to'] == to_stop)][0]
+	Returns:
+		The array of the indices of the closest stops, -1 for the points without stops in their square.
 
-		connections_seq.append(connection)
+	"""
 
-	return connections_seq
+	import numpy
 
+	points, stops = get_stops_pairs_in_boxes(stops_index, lat_array, lon_array, cutoff)
+	distances = calculate_pairwise_distances(lat_array[points], lon_array[points],
+		stops_index['lat'][stops], stops_index['lon'][stops], radius)
 
-def count_route_transfers(connections_seq, routes_dict):
+	# The first of the stops with the least distance to every point
+	order = numpy.lexsort((stops, distances, points))
+	points = points[order]
+	stops = stops[order]
+	first = numpy.ones(len(points), dtype=bool)
+	first[1:] = points[1:] != points[:-1]
 
-	# Adjust the result by 30% due to greedy path bias
-	adjustment_weight = 0.7
+	closest_stops = numpy.full(len(lat_array), -1, dtype=numpy.int64)
+	closest_stops[points[first]] = stops[first]
 
-	# Impossible if empty list
-	if(not connections_seq):
-		return -1, []
+	return closest_stops
 
-	candidate_routes = [route for route in connections_seq[0]['routes']
-		if (route in routes_dict and routes_dict[route]['wait_time_mean'] != -1)]
-	last_candidates = []
-	final_routes = []
-	changes = 0
 
-	for connection in connections_seq:
+def create_paths_cache(network):
+	"""Create an empty cache of the journeys from the origins of a CompactNetwork, to share between the trip metrics."""
+
+	routing_network = create_routing_network(network)
+
+	return {'network': network, 'routing': routing_network, 'slots': create_route_slots(network, routing_network),
+		'journeys': OrderedDict(), 'entries': 0}
+
+
+def get_journeys_labels(paths_cache, origin_id):
+	"""Get the journey labels of every stop from the origin (see plan_journeys), planning them only on a cache miss."""
+
+	journeys = paths_cache['journeys']
+	if origin_id in journeys:
+		journeys.move_to_end(origin_id)
+		return journeys[origin_id]
+
+	labels = plan_journeys(paths_cache['slots'], paths_cache['routing']['stops_count'], origin_id)
+	size = sum([array.size for arrays in labels.values() for array in arrays])
+
+	# Forget the least recently used labels while over the memory cap
+	journeys[origin_id] = labels
+	paths_cache['entries'] = paths_cache['entries'] + size
+	while paths_cache['entries'] > journeys_cache_size and len(journeys) > 1:
+		_, old_labels = journeys.popitem(last=False)
+		paths_cache['entries'] = paths_cache['entries'] - sum([array.size for arrays in old_labels.values() for array in arrays])
+
+	return labels
 
-		new_candidate_routes = []
-	
-		for candidate_route in candidate_routes:
 
-			# If a route doesn't go all the way to the previous change
-			if (candidate_route not in connection['routes']):
+def calculate_trips(paths_cache, origins, destinations, reverse=False):
+	"""Find the earliest trips between pairs of stops, planning the journeys once per distinct origin.
 
-				# print(candidate_routes)
-				# Remove it from the possible all-the-way routes
-				last_candidates.append(candidate_route)
-				# candidate_routes.remove(candidate_route)
-			else:
-				new_candidate_routes.append(candidate_route)
+	Args:
+		paths_cache: The journeys of the network (see create_paths_cache).
+		origins, destinations: The lists of the stop ids at the two ends of every trip.
+		reverse: Whether to take the trip backwards when there is no journey forward.
 
-		# if there is no possible route for the last trip leg
-		if (not new_candidate_routes):
+	Returns:
+		The list of the trips in the order of the pairs, each a (connection ids array, transfers, wait time)
+		tuple, or None when it is impossible.
 
-			# We have a change, remember the routes that were left
-			changes = changes + 1
-			final_routes.append(last_candidates)
-			candidate_routes = [route for route in connection['routes']
-				if (route in routes_dict and routes_dict[route]['wait_time_mean'] != -1)]
-			last_candidates = list(candidate_routes)
+	"""
+
+	journeys = [None] * len(origins)
+
+	# Go through the trips grouped by origin, so every origin is planned for all of its trips at once
+	for index in sorted(range(len(origins)), key=lambda index: origins[index]):
+		journeys[index] = get_journey(paths_cache['slots'],
+			get_journeys_labels(paths_cache, origins[index]), destinations[index])
+
+	# Then backwards for the ones without a journey, grouped by destination
+	if reverse:
+		for index in sorted([index for index in range(len(origins)) if journeys[index] is None], key=lambda index: destinations[index]):
+			journeys[index] = get_journey(paths_cache['slots'],
+				get_journeys_labels(paths_cache, destinations[index]), origins[index])
+
+	return [get_trip(paths_cache, legs) if legs else None for legs in journeys]
 
-	final_routes.append(last_candidates)
 
-	# Test if route was possible (due to having invalid routes)
-	for leg in final_routes:
-		if(not leg):
-			changes = -1
+def get_trip(paths_cache, legs):
+	"""Get the connection ids, transfers and wait time of the legs of a journey."""
 
+	import numpy
 
+	connection_ids = numpy.concatenate([get_connection_ids(paths_cache['routing'], stop_ids) for route, stop_ids, wait_time in legs])
 
-	return int((changes-1)*adjustment_weight),final_routes
+	return connection_ids, len(legs) - 1, sum([wait_time for route, stop_ids, wait_time in legs])
 
 
-def select_random_point_uniform(bounding_box):
+def select_random_points_uniform(generator, bounding_box, count):
 
-	# Uniformly select a random point within the boundaries
-	random_lat = random.uniform(bounding_box['top'], bounding_box['bottom'])
-	random_lon = random.uniform(bounding_box['left'], bounding_box['right'])
+	# Uniformly select random points within the boundaries
+	random_lat = generator.uniform(bounding_box['bottom'], bounding_box['top'], count)
+	random_lon = generator.uniform(bounding_box['left'], bounding_box['right'], count)
 
 	return random_lat, random_lon
 
 
-def select_random_point_population(population_distribution, sectors_list):
+def create_sectors_arrays(sectors_list):
+
+	import numpy
+
+	population_array = numpy.array([sector['population'] for sector in sectors_list], dtype=numpy.float64)
+
+	return {'weights': population_array/population_array.sum(),
+		'lat': numpy.array([sector['lat'] for sector in sectors_list], dtype=numpy.float64),
+		'lon': numpy.array([sector['lon'] for sector in sectors_list], dtype=numpy.float64),
+		'side': numpy.sqrt(numpy.array([sector['area'] for sector in sectors_list], dtype=numpy.float64)) * 0.0045 #degrees
+		}
+
 
-	# Select a random sector based on population distribution
-	random_sector = random.choices(sectors_list, weights=population_distribution)[0]
-	random_square_side = math.sqrt(random_sector['area']) * 0.0045 #degrees
+def select_random_points_population(generator, sectors_arrays, count):
 
-	# Uniformly select a random point within that sector
-	random_lat = random.uniform(random_sector['lat'] - random_square_side, random_sector['lat'] + random_square_side)
-	random_lon = random.uniform(random_sector['lon'] - random_square_side, random_sector['lon'] + random_square_side)
+	# Select random sectors based on population distribution
+	random_sectors = generator.choice(len(sectors_arrays['weights']), count, p=sectors_arrays['weights'])
+	random_square_sides = sectors_arrays['side'][random_sectors]
+
+	# Uniformly select a random point within each sector
+	random_lat = sectors_arrays['lat'][random_sectors] + generator.uniform(-1, 1, count) * random_square_sides
+	random_lon = sectors_arrays['lon'][random_sectors] + generator.uniform(-1, 1, count) * random_square_sides
 
 	return random_lat, random_lon
 
 
+def select_random_points(generator, data, count):
+
+	# From the population sectors if the estimator has them, uniformly within its bounding box otherwise
+	if 'sectors_arrays' in data:
+		return select_random_points_population(generator, data['sectors_arrays'], count)
+
+	return select_random_points_uniform(generator, data['bounding_box'], count)
+
+
 
 
 # ===============================================
@@ -707,6 +847,9 @@ def select_random_point_population(population_distribution, sectors_list):
 
 def draw_static_network(G,stops_list):
 
+	import networkx as nx
+	import matplotlib.pyplot as plt
+
 	nx.draw_networkx(
 		G,
 		node_size=0.1,
@@ -737,6 +880,8 @@ def draw_static_network(G,stops_list):
 
 def get_graph_bridges(G):
 
+	import networkx as nx
+
 	bridges = list(nx.bridges(G))
 	non_bridges = [edge for edge in G.edges if edge not in bridges]
 
@@ -749,6 +894,8 @@ def get_graph_bridges(G):
 
 def get_graph_center(G):
 
+	import networkx as nx
+
 	center= nx.center(G)
 	non_center = [node for node in G.nodes if node not in center]
 